@@ -4,13 +4,25 @@ import datetime
 import logging
 import click 
 import os 
-from flask import Flask, render_template, request, jsonify, g, redirect, url_for, flash, session
-from functools import wraps 
-import requests
-import qrcode # For QR code generation
+import threading
+import queue
+import time
+import bisect
+from collections import OrderedDict
+from flask import Flask, render_template, request, jsonify, g, redirect, url_for, flash, session, stream_with_context
+from flask.sessions import SecureCookieSessionInterface
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+# requests, qrcode and concurrent.futures are imported where they are used: together
+# they are about a third of the import time, and most workers need none of them
+# until the first barcode lookup, UPI QR or queued bill.
 import io # To handle image in memory
-import base64 # To encode image for HTML display
+import hashlib # For QR code ETags
 import urllib.parse # For encoding UPI URL parameters
+import csv
+import json
+import re
+import zlib # Streaming gzip for exports
 
 # --- API Configuration ---
 try:
@@ -22,31 +34,971 @@ except (ImportError, AttributeError) as e:
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24) 
-DATABASE = 'inventory.db'
+app.config['SECRET_KEY'] = None # Session signing key; when unset, one is generated once and kept in the instance folder
+app.config['EXPIRY_SOON_DAYS'] = 30 # Window for the "Expires Soon" status
+app.config['REORDER_LEVEL_DEFAULT'] = 10 # Usable units at or below which a product is low on stock, unless it has its own level
+app.config['DATABASE'] = 'inventory.db'
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL' # DELETE for a database on a network filesystem, where WAL cannot work
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000 # How long a writer waits for the lock before "database is locked"
+app.config['SQLITE_CACHE_SIZE_KIB'] = 16384 # Page cache per connection
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024 # 0 disables memory-mapped reads
+app.config['SQLITE_CACHED_STATEMENTS'] = 256 # Prepared statements kept per connection
+app.config['SETTINGS_RECHECK_SECONDS'] = 2.0 # How stale another worker's settings change may be seen; 0 checks on every read
+app.config['SEARCH_CACHE_SIZE'] = 512 # Billing search results kept per process; 0 disables the cache
+app.config['BARCODE_CACHE_TTL_SECONDS'] = 30 * 24 * 3600 # Found UPCs
+app.config['BARCODE_NEGATIVE_TTL_SECONDS'] = 24 * 3600 # UPCs the API did not know
+app.config['UPC_API_TIMEOUT_SECONDS'] = 10
+app.config['UPC_API_RETRIES'] = 2 # Retries with exponential backoff on connection errors, 429 and 5xx
+app.config['BILL_WRITER_ENABLED'] = False # Queue bill writes to one writer thread that group-commits them
+app.config['BILL_WRITER_MAX_BATCH'] = 64 # Most bills committed in one transaction
+app.config['BILL_WRITER_MAX_WAIT_MS'] = 0 # Extra wait for more bills before committing; 0 commits whatever is queued
+app.config['BILL_WRITER_TIMEOUT_SECONDS'] = 30 # How long a request waits for its bill to be queued and committed
+app.config['METRICS_ENABLED'] = True # Request/SQL timing and the /metrics endpoint
+app.config['METRICS_TOKEN'] = None # Lets scrapers read /metrics with "Authorization: Bearer <token>"
+app.config['METRICS_PUBLIC'] = False # Serve /metrics without a token or an admin session
+app.config['SLOW_QUERY_MS'] = 100 # Statements slower than this are logged
+app.config['SLOW_REQUEST_MS'] = 1000 # Requests slower than this are logged with their SQL totals
+app.config['COMPRESS_MIN_BYTES'] = 1024 # Smaller responses are sent uncompressed
+app.config['COMPRESS_LEVEL'] = 6 # gzip level (brotli uses its own scale, 0-11, at level 5)
+app.config['STATIC_MAX_AGE_SECONDS'] = 365 * 24 * 3600 # Cache lifetime of versioned static URLs (url_for adds ?v=<mtime>)
+app.config['ARCHIVE_DIR'] = None # Monthly bill archive files; defaults to an 'archive' folder next to DATABASE
+app.config['ARCHIVE_AFTER_DAYS'] = 365 # flask archive-bills moves bills older than this out of the live database
+app.config['ARCHIVE_INTERVAL_HOURS'] = None # Also archive from a background thread this often; None leaves it to cron
+app.config['SYNC_TOKEN'] = None # Shared secret for the /sync endpoints ("Authorization: Bearer <token>"); unset disables them
+app.config['SYNC_BATCH_SIZE'] = 500 # Change-log entries per sync request
+app.config['SYNC_TIMEOUT_SECONDS'] = 60 # Per HTTP request when syncing with a remote node
+# Any of the above can be overridden with FLASK_-prefixed environment variables,
+# e.g. FLASK_DATABASE=/srv/pharmacy/inventory.db
+app.config.from_prefixed_env()
+
+def load_secret_key(path=None):
+    """Returns the session key stored in the instance folder, creating it on first
+    start. Used when SECRET_KEY is not configured."""
+    path = path or os.path.join(app.instance_path, 'secret_key')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(os.urandom(32))
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, path) # Fails if a worker starting alongside got there first; then use its key
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        logging.warning(f"Could not store a secret key at {path} ({e}); sessions will not survive a restart. Set FLASK_SECRET_KEY.")
+        return os.urandom(32)
+
+class StoredKeySessionInterface(SecureCookieSessionInterface):
+    """Loads the stored key when the first session is opened, so every entry point
+    (flask run, app:app, create_app()) has one without importing having side effects."""
+    def get_signing_serializer(self, app):
+        if not app.config['SECRET_KEY']:
+            app.config['SECRET_KEY'] = load_secret_key()
+        return super().get_signing_serializer(app)
+
+app.session_interface = StoredKeySessionInterface()
 
 # --- Logging Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s [%(pathname)s:%(lineno)d]')
 
+# --- Metrics ---
+# In-process, Prometheus-style counters and histograms, rendered as text by
+# /metrics. Each worker process keeps its own, so scrape every worker. Observing
+# is a bisect and a few additions under a lock, cheap enough to leave on.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+METRICS = []
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name, self.help_text, self.label_names = name, help_text, label_names
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.label_names, labels)} {value}" for labels, value in values)
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.label_names, self.buckets = name, help_text, label_names, buckets
+        self._series = {} # label values -> per-bucket counts (last one is +Inf) followed by the sum
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            all_series = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in all_series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series[:-1]):
+                cumulative += count
+                bucket_label = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+REQUEST_DURATION = Histogram('pharmabill_request_duration_seconds', 'Time to build the response, by endpoint.', ('endpoint', 'method'))
+REQUESTS_TOTAL = Counter('pharmabill_requests_total', 'Requests by endpoint and status.', ('endpoint', 'method', 'status'))
+REQUEST_SQL_STATEMENTS = Histogram('pharmabill_request_sql_statements', 'SQL statements executed per request.', ('endpoint',), SQL_COUNT_BUCKETS)
+REQUEST_SQL_DURATION = Histogram('pharmabill_request_sql_seconds', 'Total SQL execution time per request.', ('endpoint',))
+SLOW_QUERIES_TOTAL = Counter('pharmabill_sql_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.')
+QR_RENDER_DURATION = Histogram('pharmabill_qr_render_seconds', 'UPI QR encodes (cache misses only).', ('format',))
+BILL_WRITER_BATCH_SIZE = Histogram('pharmabill_bill_writer_batch_size', 'Bills per group-commit transaction.', (), (1, 2, 4, 8, 16, 32, 64, 128))
+UPC_API_DURATION = Histogram('pharmabill_upc_api_seconds', 'Upstream UPC API calls, including retries.', ('outcome',))
+SEARCH_CACHE_LOOKUPS = Counter('pharmabill_search_cache_lookups_total', 'Billing search cache lookups.', ('result',))
+SYNC_CHANGES_TOTAL = Counter('pharmabill_sync_changes_total', 'Change-log entries exchanged with other nodes.', ('direction', 'result'))
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Counts and times statements run through execute()/executemany(), on the
+    connection or its cursors. Times cover stepping to the first row; rows fetched
+    afterwards are not included."""
+    sql_count = 0
+    sql_seconds = 0.0
+    slow_query_seconds = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def _record(self, sql, elapsed):
+        self.sql_count += 1
+        self.sql_seconds += elapsed
+        if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+            SLOW_QUERIES_TOTAL.inc()
+            app.logger.warning(f"Slow query ({elapsed * 1000:.1f} ms): {' '.join(sql.split())[:500]}")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Records statements run on db.cursor() with the connection's counters."""
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection._record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection._record(sql, time.perf_counter() - started)
+
+@app.before_request
+def start_request_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return
+    g._request_started = time.perf_counter()
+    db = getattr(_db_local, 'connection', None)
+    if isinstance(db, InstrumentedConnection): # The pooled connection outlives requests; count this one from zero
+        db.sql_count, db.sql_seconds = 0, 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('_request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    db = g.get('_database')
+    sql_count, sql_seconds = (db.sql_count, db.sql_seconds) if isinstance(db, InstrumentedConnection) else (0, 0.0)
+    REQUEST_DURATION.observe(elapsed, endpoint, request.method)
+    REQUESTS_TOTAL.inc(endpoint, request.method, str(response.status_code))
+    REQUEST_SQL_STATEMENTS.observe(sql_count, endpoint)
+    REQUEST_SQL_DURATION.observe(sql_seconds, endpoint)
+    response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.2f}, db;dur={sql_seconds * 1000:.2f};desc="{sql_count} statements"'
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning(f"Slow request {request.method} {request.path}: {elapsed * 1000:.1f} ms, "
+                           f"{sql_count} SQL statements ({sql_seconds * 1000:.1f} ms)")
+    return response
+
 # --- Database Helper Functions ---
+# Each worker thread keeps one long-lived connection instead of reconnecting per
+# request; the request context only borrows it. Connections are tagged with the
+# pid so a forked worker never reuses its parent's handle.
+_db_local = threading.local()
+
+def connect_db(path=None):
+    """Opens a tuned connection: WAL (SQLITE_JOURNAL_MODE) so readers don't block on the billing
+    writer, synchronous=NORMAL (durable in WAL mode), and a busy timeout instead of failing fast."""
+    db = sqlite3.connect(path or app.config['DATABASE'], uri=True, timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+                         cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+                         factory=InstrumentedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection)
+    db.row_factory = sqlite3.Row 
+    if app.config['METRICS_ENABLED'] and app.config['SLOW_QUERY_MS'] is not None:
+        db.slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+    db.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    try:
+        db.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    except sqlite3.OperationalError as e:
+        app.logger.warning(f"Could not switch database to {app.config['SQLITE_JOURNAL_MODE']} mode: {e}")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_SIZE_KIB'])}")
+    db.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    return db
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row 
+        db = getattr(_db_local, 'connection', None)
+        if db is None or _db_local.pid != os.getpid() or _db_local.path != app.config['DATABASE']:
+            db = _db_local.connection = connect_db()
+            _db_local.pid, _db_local.path = os.getpid(), app.config['DATABASE']
+        g._database = db
     return db
 
+def close_db():
+    """Closes this thread's pooled connection, e.g. before the database file is replaced."""
+    db = getattr(_db_local, 'connection', None)
+    if db is not None and _db_local.pid == os.getpid():
+        db.close()
+    _db_local.connection = None
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        # Never hand a half-finished transaction to the next request on this thread.
+        db.rollback()
 
-def table_exists(table_name):
-    db = get_db()
+def table_exists(table_name, db=None):
+    db = db or get_db()
     cur = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
     return cur.fetchone() is not None
 
+# --- Schema Migrations ---
+# schema.sql creates the base tables, which are schema version 1. Everything
+# added since is an ordered, idempotent migration recorded in schema_version,
+# so an existing inventory.db is upgraded in place (`flask migrate-db`) rather
+# than re-initialized. A migration step is either an SQL script or a callable
+# taking the connection; either way it runs inside one transaction.
+REQUIRED_TABLES = ['medicines', 'customers', 'bills', 'bill_items', 'app_settings']
+BASE_SCHEMA_VERSION = 1
+
+# Trigram FTS5 index over the searchable medicine columns, kept in sync with
+# the medicines table by triggers. The NOCASE index on medicineName serves the
+# prefix pass of the billing typeahead (and queries shorter than a trigram),
+# the barcode index serves scanner input. The expiry index (which implicitly
+# ends in id) drives the keyset-paginated inventory listing.
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_medicines_name_nocase ON medicines (medicineName COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_medicines_barcode ON medicines (barcode);
+CREATE INDEX IF NOT EXISTS idx_medicines_expiry ON medicines (expiryDate);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS medicines_fts USING fts5(
+    medicineName, shop_id, barcode,
+    content='medicines', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS medicines_fts_ai AFTER INSERT ON medicines BEGIN
+    INSERT INTO medicines_fts (rowid, medicineName, shop_id, barcode)
+    VALUES (new.id, new.medicineName, new.shop_id, new.barcode);
+END;
+
+CREATE TRIGGER IF NOT EXISTS medicines_fts_ad AFTER DELETE ON medicines BEGIN
+    INSERT INTO medicines_fts (medicines_fts, rowid, medicineName, shop_id, barcode)
+    VALUES ('delete', old.id, old.medicineName, old.shop_id, old.barcode);
+END;
+
+CREATE TRIGGER IF NOT EXISTS medicines_fts_au AFTER UPDATE OF medicineName, shop_id, barcode ON medicines BEGIN
+    INSERT INTO medicines_fts (medicines_fts, rowid, medicineName, shop_id, barcode)
+    VALUES ('delete', old.id, old.medicineName, old.shop_id, old.barcode);
+    INSERT INTO medicines_fts (rowid, medicineName, shop_id, barcode)
+    VALUES (new.id, new.medicineName, new.shop_id, new.barcode);
+END;
+
+INSERT INTO medicines_fts (medicines_fts) VALUES ('rebuild');
+"""
+
+# Per-table generation counters bumped by triggers, so a process can tell that
+# cached data changed (including from another worker) with one primary-key read.
+CHANGE_COUNTERS_SQL = """
+CREATE TABLE IF NOT EXISTS change_counters (
+    name TEXT PRIMARY KEY NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO change_counters (name) VALUES ('app_settings');
+
+CREATE TRIGGER IF NOT EXISTS app_settings_changed_ai AFTER INSERT ON app_settings BEGIN
+    UPDATE change_counters SET generation = generation + 1 WHERE name = 'app_settings';
+END;
+CREATE TRIGGER IF NOT EXISTS app_settings_changed_au AFTER UPDATE ON app_settings BEGIN
+    UPDATE change_counters SET generation = generation + 1 WHERE name = 'app_settings';
+END;
+CREATE TRIGGER IF NOT EXISTS app_settings_changed_ad AFTER DELETE ON app_settings BEGIN
+    UPDATE change_counters SET generation = generation + 1 WHERE name = 'app_settings';
+END;
+"""
+
+# Local cache of UPC lookups, seeded from the barcodes already on the shelf.
+BARCODE_CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS barcode_cache (
+    upc TEXT PRIMARY KEY NOT NULL,
+    found INTEGER NOT NULL,
+    title TEXT,
+    brand TEXT,
+    manufacturer TEXT,
+    message TEXT,
+    source TEXT NOT NULL, -- 'api' or 'inventory'
+    fetched_at REAL NOT NULL -- Unix time
+);
+
+INSERT OR IGNORE INTO barcode_cache (upc, found, title, brand, source, fetched_at)
+SELECT barcode, 1, medicineName, supplier, 'inventory', strftime('%s', 'now')
+FROM medicines
+WHERE id IN (SELECT MAX(id) FROM medicines WHERE barcode IS NOT NULL AND barcode != '' GROUP BY barcode);
+
+CREATE TRIGGER IF NOT EXISTS medicines_barcode_cache_ai AFTER INSERT ON medicines
+WHEN new.barcode IS NOT NULL AND new.barcode != '' BEGIN
+    INSERT OR REPLACE INTO barcode_cache (upc, found, title, brand, source, fetched_at)
+    VALUES (new.barcode, 1, new.medicineName, new.supplier, 'inventory', strftime('%s', 'now'));
+END;
+"""
+
+# Daily sales rollups, maintained by insert triggers in the same transaction as
+# the bill, so reports read a few rows per day instead of scanning bill history.
+# Bills without a billed_from_shop_id roll up under shop_id ''.
+SALES_ROLLUP_SQL = """
+CREATE TABLE IF NOT EXISTS sales_daily_medicine (
+    sale_date TEXT NOT NULL,
+    medicine_id INTEGER NOT NULL,
+    medicine_name TEXT NOT NULL, -- Latest name snapshot seen that day
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (sale_date, medicine_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_shop (
+    sale_date TEXT NOT NULL,
+    shop_id TEXT NOT NULL,
+    bill_count INTEGER NOT NULL DEFAULT 0,
+    items_sold INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (sale_date, shop_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS bills_sales_rollup_ai AFTER INSERT ON bills BEGIN
+    INSERT INTO sales_daily_shop (sale_date, shop_id, bill_count, revenue)
+    VALUES (date(new.bill_date), COALESCE(new.billed_from_shop_id, ''), 1, new.total_amount)
+    ON CONFLICT (sale_date, shop_id) DO UPDATE SET
+        bill_count = bill_count + 1, revenue = revenue + excluded.revenue;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bill_items_sales_rollup_ai AFTER INSERT ON bill_items BEGIN
+    INSERT INTO sales_daily_medicine (sale_date, medicine_id, medicine_name, quantity, revenue)
+    SELECT date(b.bill_date), new.medicine_id, new.medicine_name_snapshot, new.quantity_billed, new.total_price_for_item
+    FROM bills b WHERE b.id = new.bill_id
+    ON CONFLICT (sale_date, medicine_id) DO UPDATE SET
+        medicine_name = excluded.medicine_name,
+        quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue;
+    UPDATE sales_daily_shop SET items_sold = items_sold + new.quantity_billed
+    WHERE (sale_date, shop_id) = (SELECT date(bill_date), COALESCE(billed_from_shop_id, '') FROM bills WHERE id = new.bill_id);
+END;
+"""
+
+# Bill history lookups: receipts by id fetch their items via bill_id, and
+# listings page through (bill_date, id) newest first, optionally per customer.
+BILL_HISTORY_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_bill_items_bill_id ON bill_items (bill_id);
+CREATE INDEX IF NOT EXISTS idx_bills_bill_date ON bills (bill_date);
+CREATE INDEX IF NOT EXISTS idx_bills_customer_date ON bills (customer_id, bill_date);
+CREATE INDEX IF NOT EXISTS idx_bills_phone_temp_date ON bills (customer_phone_temp, bill_date);
+"""
+
+def rebuild_sales_rollups(db, with_archives=False):
+    """Recomputes the daily rollups from bills/bill_items. With with_archives, the
+    totals of archived months staged by stage_archived_sales() are added back.
+    Runs inside the caller's transaction."""
+    db.execute("DELETE FROM sales_daily_medicine")
+    db.execute("DELETE FROM sales_daily_shop")
+    db.execute("""
+        INSERT INTO sales_daily_shop (sale_date, shop_id, bill_count, revenue)
+        SELECT date(bill_date), COALESCE(billed_from_shop_id, ''), COUNT(*), SUM(total_amount)
+        FROM bills GROUP BY 1, 2
+    """)
+    db.execute("""
+        UPDATE sales_daily_shop SET items_sold = totals.items_sold
+        FROM (SELECT date(b.bill_date) AS sale_date, COALESCE(b.billed_from_shop_id, '') AS shop_id, SUM(bi.quantity_billed) AS items_sold
+              FROM bill_items bi JOIN bills b ON b.id = bi.bill_id GROUP BY 1, 2) AS totals
+        WHERE sales_daily_shop.sale_date = totals.sale_date AND sales_daily_shop.shop_id = totals.shop_id
+    """)
+    db.execute("""
+        INSERT INTO sales_daily_medicine (sale_date, medicine_id, medicine_name, quantity, revenue)
+        SELECT date(b.bill_date), bi.medicine_id, MAX(bi.medicine_name_snapshot), SUM(bi.quantity_billed), SUM(bi.total_price_for_item)
+        FROM bill_items bi JOIN bills b ON b.id = bi.bill_id GROUP BY 1, 2
+    """)
+    if with_archives:
+        db.execute("""
+            INSERT INTO sales_daily_shop (sale_date, shop_id, bill_count, items_sold, revenue)
+            SELECT sale_date, shop_id, SUM(bill_count), SUM(items_sold), SUM(revenue) FROM temp.archived_sales_shop GROUP BY 1, 2
+            ON CONFLICT (sale_date, shop_id) DO UPDATE SET
+                bill_count = bill_count + excluded.bill_count, items_sold = items_sold + excluded.items_sold,
+                revenue = revenue + excluded.revenue
+        """)
+        db.execute("""
+            INSERT INTO sales_daily_medicine (sale_date, medicine_id, medicine_name, quantity, revenue)
+            SELECT sale_date, medicine_id, MAX(medicine_name), SUM(quantity), SUM(revenue) FROM temp.archived_sales_medicine GROUP BY 1, 2
+            ON CONFLICT (sale_date, medicine_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue
+        """)
+
+def _migrate_sales_rollups(db):
+    for statement in _split_sql_script(SALES_ROLLUP_SQL):
+        db.execute(statement)
+    rebuild_sales_rollups(db)
+
+def _migrate_customer_search(db):
+    """Adds customers.phone_normalized (digits only, see normalize_phone) and the
+    prefix-search indexes for the customer directory."""
+    if not column_exists(db, 'customers', 'phone_normalized'):
+        db.execute("ALTER TABLE customers ADD COLUMN phone_normalized TEXT")
+    db.executemany("UPDATE customers SET phone_normalized = ? WHERE id = ?",
+                   ((normalize_phone(row['phone_number']), row['id'])
+                    for row in db.execute("SELECT id, phone_number FROM customers").fetchall()))
+    db.execute("CREATE INDEX IF NOT EXISTS idx_customers_phone_normalized ON customers (phone_normalized)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_customers_name_nocase ON customers (name COLLATE NOCASE)")
+
+# Change log for delta sync between shop databases (see Delta Sync below).
+# Every database is a node with its own id. Rows are known across nodes by a
+# uid '<creating node>:<id there>': rows created here leave sync_uid NULL (their
+# uid is derived from the current node id), replicated rows store the uid they
+# arrived with. Triggers append one log entry per change; stock changes are
+# logged as deltas (op 'Q') so concurrent sales on two terminals add up instead
+# of overwriting each other. While a peer's batch is replayed, sync_applying
+# holds the origin of the change being applied so the triggers record it and
+# the entry can be relayed onward without echoing back.
+SYNC_TABLES = ('medicines', 'customers', 'bills', 'bill_items')
+SYNC_COLUMNS = { # Replicated columns; ids, stock and references are handled separately
+    'medicines': ('barcode', 'medicineName', 'batchNo', 'mrp', 'sellingPrice', 'mfgDate', 'expiryDate',
+                  'supplier', 'shelfNo', 'boxNo', 'shop_id', 'timestamp'),
+    'customers': ('name', 'phone_number', 'phone_normalized', 'email', 'address', 'registered_at'),
+    'bills': ('customer_phone_temp', 'customer_name_temp', 'total_amount', 'bill_date', 'billed_from_shop_id'),
+    'bill_items': ('medicine_name_snapshot', 'quantity_billed', 'price_per_unit_at_billing', 'total_price_for_item'),
+}
+SYNC_REFERENCES = {'bills': {'customer_id': 'customers'}, 'bill_items': {'bill_id': 'bills', 'medicine_id': 'medicines'}}
+
+CHANGE_LOG_SQL = """
+CREATE TABLE IF NOT EXISTS sync_node (
+    node_id TEXT NOT NULL -- Single row: this database's identity
+);
+
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    row_id INTEGER NOT NULL, -- Local id
+    row_uid TEXT NOT NULL,
+    op TEXT NOT NULL, -- 'I'nsert, 'U'pdate, 'D'elete, or 'Q' (stock delta)
+    qty_delta INTEGER, -- 'Q': stock change; medicine 'I': initial stock
+    origin_node TEXT, -- NULL for changes made on this node
+    origin_seq INTEGER -- The change's seq on its origin node
+);
+
+CREATE TABLE IF NOT EXISTS sync_applying (
+    origin_node TEXT NOT NULL,
+    origin_seq INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_peers (
+    peer_node TEXT PRIMARY KEY NOT NULL,
+    pulled_seq INTEGER NOT NULL DEFAULT 0, -- Position in the peer's change log
+    pushed_seq INTEGER NOT NULL DEFAULT 0, -- Position in ours
+    last_sync_at DATETIME
+);
+
+CREATE TABLE IF NOT EXISTS sync_origins (
+    origin_node TEXT PRIMARY KEY NOT NULL,
+    applied_seq INTEGER NOT NULL -- Highest origin_seq replayed here, whichever peer relayed it
+);
+
+CREATE TABLE IF NOT EXISTS sync_uid_alias (
+    table_name TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    local_id INTEGER NOT NULL, -- e.g. the customer who already had that phone number here
+    PRIMARY KEY (table_name, uid)
+);
+"""
+
+def _change_log_trigger(table, name, event, op, qty_delta='NULL', when=None):
+    ref = 'old' if event == 'DELETE' else 'new'
+    return f"""
+CREATE TRIGGER IF NOT EXISTS {table}_change_log_{name} AFTER {event} ON {table}{f' WHEN {when}' if when else ''} BEGIN
+    INSERT INTO change_log (table_name, row_id, row_uid, op, qty_delta, origin_node, origin_seq)
+    VALUES ('{table}', {ref}.id, COALESCE({ref}.sync_uid, (SELECT node_id FROM sync_node) || ':' || {ref}.id), '{op}', {qty_delta},
+            (SELECT origin_node FROM sync_applying), (SELECT origin_seq FROM sync_applying));
+END;
+"""
+
+def _columns_changed_sql(table):
+    columns = SYNC_COLUMNS[table]
+    return f"({', '.join('new.' + c for c in columns)}) IS NOT ({', '.join('old.' + c for c in columns)})"
+
+# Bills and bill items are append-only as far as sync is concerned: removing
+# them locally (e.g. archiving) never deletes them on other nodes.
+CHANGE_LOG_TRIGGERS_SQL = ''.join([
+    _change_log_trigger('medicines', 'ai', 'INSERT', 'I', qty_delta='new.quantity'),
+    _change_log_trigger('medicines', 'au', 'UPDATE', 'U', when=_columns_changed_sql('medicines')),
+    _change_log_trigger('medicines', 'stock', 'UPDATE OF quantity', 'Q', qty_delta='new.quantity - old.quantity',
+                        when='new.quantity IS NOT old.quantity'),
+    _change_log_trigger('medicines', 'ad', 'DELETE', 'D'),
+    _change_log_trigger('customers', 'ai', 'INSERT', 'I'),
+    _change_log_trigger('customers', 'au', 'UPDATE', 'U', when=_columns_changed_sql('customers')),
+    _change_log_trigger('customers', 'ad', 'DELETE', 'D'),
+    _change_log_trigger('bills', 'ai', 'INSERT', 'I'),
+    _change_log_trigger('bill_items', 'ai', 'INSERT', 'I'),
+])
+
+def _migrate_change_log(db):
+    for table in SYNC_TABLES:
+        if not column_exists(db, table, 'sync_uid'):
+            db.execute(f"ALTER TABLE {table} ADD COLUMN sync_uid TEXT")
+        db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_sync_uid ON {table} (sync_uid) WHERE sync_uid IS NOT NULL")
+    for statement in _split_sql_script(CHANGE_LOG_SQL + CHANGE_LOG_TRIGGERS_SQL):
+        db.execute(statement)
+    if not db.execute("SELECT 1 FROM sync_node").fetchone():
+        db.execute("INSERT INTO sync_node (node_id) VALUES (?)", (new_node_id(),))
+
+# Per-product stock across batches. Each medicines row is one batch; a product
+# is every batch with the same name (trimmed, case-insensitive). Triggers keep
+# the totals current in the writing transaction. usable_quantity counts batches
+# not expired as of stock_expiry_state.as_of; roll_stock_expiry() moves that
+# date forward by subtracting the batches that expired in between, found through
+# idx_medicines_expiry. The partial indexes let the low-stock query range-scan
+# straight to the products at or under their reorder level.
+PRODUCT_STOCK_SQL = """
+CREATE TABLE IF NOT EXISTS product_stock (
+    product_key TEXT PRIMARY KEY NOT NULL, -- lower(trim(medicineName))
+    medicine_name TEXT NOT NULL,
+    barcode TEXT, -- Latest non-empty barcode seen
+    batch_count INTEGER NOT NULL DEFAULT 0,
+    total_quantity INTEGER NOT NULL DEFAULT 0,
+    usable_quantity INTEGER NOT NULL DEFAULT 0,
+    reorder_level INTEGER -- NULL uses REORDER_LEVEL_DEFAULT
+);
+
+CREATE TABLE IF NOT EXISTS stock_expiry_state (
+    as_of TEXT NOT NULL -- Single row, YYYY-MM-DD
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_stock_barcode ON product_stock (barcode);
+CREATE INDEX IF NOT EXISTS idx_product_stock_default_level ON product_stock (usable_quantity) WHERE reorder_level IS NULL;
+CREATE INDEX IF NOT EXISTS idx_product_stock_own_level ON product_stock (usable_quantity - reorder_level) WHERE reorder_level IS NOT NULL;
+
+CREATE TRIGGER IF NOT EXISTS medicines_stock_ai AFTER INSERT ON medicines BEGIN
+    INSERT INTO product_stock (product_key, medicine_name, barcode, batch_count, total_quantity, usable_quantity)
+    VALUES (lower(trim(new.medicineName)), new.medicineName, NULLIF(new.barcode, ''), 1, new.quantity,
+            CASE WHEN new.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN new.quantity ELSE 0 END)
+    ON CONFLICT (product_key) DO UPDATE SET
+        medicine_name = excluded.medicine_name, barcode = COALESCE(excluded.barcode, barcode),
+        batch_count = batch_count + 1, total_quantity = total_quantity + excluded.total_quantity,
+        usable_quantity = usable_quantity + excluded.usable_quantity;
+END;
+
+CREATE TRIGGER IF NOT EXISTS medicines_stock_ad AFTER DELETE ON medicines BEGIN
+    UPDATE product_stock SET batch_count = batch_count - 1, total_quantity = total_quantity - old.quantity,
+        usable_quantity = usable_quantity - CASE WHEN old.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN old.quantity ELSE 0 END
+    WHERE product_key = lower(trim(old.medicineName));
+END;
+
+-- Sales and restocks: one update of the product's totals.
+CREATE TRIGGER IF NOT EXISTS medicines_stock_qty AFTER UPDATE OF quantity ON medicines
+WHEN new.quantity IS NOT old.quantity AND new.medicineName IS old.medicineName AND new.expiryDate IS old.expiryDate BEGIN
+    UPDATE product_stock SET total_quantity = total_quantity + new.quantity - old.quantity,
+        usable_quantity = usable_quantity + CASE WHEN new.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN new.quantity - old.quantity ELSE 0 END
+    WHERE product_key = lower(trim(new.medicineName));
+END;
+
+-- Renamed or re-dated batches move out of their old totals and into the new ones.
+CREATE TRIGGER IF NOT EXISTS medicines_stock_au AFTER UPDATE OF medicineName, expiryDate ON medicines
+WHEN new.medicineName IS NOT old.medicineName OR new.expiryDate IS NOT old.expiryDate BEGIN
+    UPDATE product_stock SET batch_count = batch_count - 1, total_quantity = total_quantity - old.quantity,
+        usable_quantity = usable_quantity - CASE WHEN old.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN old.quantity ELSE 0 END
+    WHERE product_key = lower(trim(old.medicineName));
+    INSERT INTO product_stock (product_key, medicine_name, barcode, batch_count, total_quantity, usable_quantity)
+    VALUES (lower(trim(new.medicineName)), new.medicineName, NULLIF(new.barcode, ''), 1, new.quantity,
+            CASE WHEN new.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN new.quantity ELSE 0 END)
+    ON CONFLICT (product_key) DO UPDATE SET
+        medicine_name = excluded.medicine_name, barcode = COALESCE(excluded.barcode, barcode),
+        batch_count = batch_count + 1, total_quantity = total_quantity + excluded.total_quantity,
+        usable_quantity = usable_quantity + excluded.usable_quantity;
+END;
+"""
+
+def rebuild_product_stock(db):
+    """Recomputes the stock aggregate from medicines, keeping reorder levels.
+    Runs inside the caller's transaction."""
+    db.execute("UPDATE product_stock SET batch_count = 0, total_quantity = 0, usable_quantity = 0")
+    db.execute("""
+        INSERT INTO product_stock (product_key, medicine_name, barcode, batch_count, total_quantity, usable_quantity)
+        SELECT lower(trim(medicineName)), MAX(medicineName), MAX(NULLIF(barcode, '')), COUNT(*), SUM(quantity),
+               SUM(CASE WHEN expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN quantity ELSE 0 END)
+        FROM medicines WHERE true GROUP BY 1
+        ON CONFLICT (product_key) DO UPDATE SET
+            medicine_name = excluded.medicine_name, barcode = COALESCE(excluded.barcode, barcode),
+            batch_count = excluded.batch_count, total_quantity = excluded.total_quantity,
+            usable_quantity = excluded.usable_quantity
+    """)
+
+def _migrate_product_stock(db):
+    for statement in _split_sql_script(PRODUCT_STOCK_SQL):
+        db.execute(statement)
+    if not db.execute("SELECT 1 FROM stock_expiry_state").fetchone():
+        db.execute("INSERT INTO stock_expiry_state (as_of) VALUES (?)", (datetime.date.today().isoformat(),))
+    rebuild_product_stock(db)
+
+# Change counters (with the time of the last change) for conditional GETs.
+DATA_VERSION_TABLES = ('app_settings', 'medicines', 'customers', 'bills')
+
+def _migrate_data_versions(db):
+    if not column_exists(db, 'change_counters', 'changed_at'):
+        db.execute("ALTER TABLE change_counters ADD COLUMN changed_at INTEGER") # Unix time of the last change
+    for table in DATA_VERSION_TABLES:
+        db.execute("INSERT OR IGNORE INTO change_counters (name) VALUES (?)", (table,))
+        for event, suffix in (('INSERT', 'ai'), ('UPDATE', 'au'), ('DELETE', 'ad')):
+            db.execute(f"DROP TRIGGER IF EXISTS {table}_changed_{suffix}")
+            db.execute(f"""
+                CREATE TRIGGER {table}_changed_{suffix} AFTER {event} ON {table} BEGIN
+                    UPDATE change_counters SET generation = generation + 1, changed_at = strftime('%s', 'now') WHERE name = '{table}';
+                END
+            """)
+    db.execute("UPDATE change_counters SET changed_at = strftime('%s', 'now') WHERE changed_at IS NULL")
+
+# Bills older than ARCHIVE_AFTER_DAYS move to one SQLite file per month (see Bill
+# Archive below). bill_archives records each file with its totals, and the id
+# range used to find an archived bill's month.
+BILL_ARCHIVE_SQL = """
+CREATE TABLE IF NOT EXISTS bill_archives (
+    month TEXT PRIMARY KEY, -- 'YYYY-MM'; the file is bills-<month>.db in the archive folder
+    bill_count INTEGER NOT NULL DEFAULT 0,
+    item_count INTEGER NOT NULL DEFAULT 0,
+    total_amount REAL NOT NULL DEFAULT 0,
+    min_bill_id INTEGER,
+    max_bill_id INTEGER,
+    archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Ledger of stock takes and restocks (see Stock Adjustments below): one row per
+# adjusted line, with the quantity before and after, so every manual change to
+# a batch's stock can be audited.
+STOCK_ADJUSTMENT_SQL = """
+CREATE TABLE IF NOT EXISTS stock_adjustments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reference TEXT NOT NULL, -- Groups the lines of one adjustment request
+    medicine_id INTEGER NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('count', 'delta')), -- Counted quantity, or a relative change
+    quantity_before INTEGER NOT NULL,
+    quantity_after INTEGER NOT NULL,
+    reason TEXT,
+    user_id TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_stock_adjustments_medicine ON stock_adjustments (medicine_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_stock_adjustments_reference ON stock_adjustments (reference);
+"""
+
+# Reorder levels are not medicines writes, so the stock views also check this counter.
+REORDER_LEVEL_VERSION_SQL = """
+INSERT OR IGNORE INTO change_counters (name, changed_at) VALUES ('product_stock', strftime('%s', 'now'));
+
+CREATE TRIGGER IF NOT EXISTS product_stock_changed_au AFTER UPDATE OF reorder_level ON product_stock
+WHEN new.reorder_level IS NOT old.reorder_level BEGIN
+    UPDATE change_counters SET generation = generation + 1, changed_at = strftime('%s', 'now') WHERE name = 'product_stock';
+END;
+"""
+
+# Stock inserts name their barcode (title only: a supplier is not a brand). They
+# refresh entries that came from the inventory or a "not found" answer, never an
+# API result. Every entry expires after BARCODE_CACHE_TTL_SECONDS.
+BARCODE_CACHE_TRIGGER_SQL = """
+UPDATE barcode_cache SET brand = NULL WHERE source = 'inventory';
+
+DROP TRIGGER IF EXISTS medicines_barcode_cache_ai;
+CREATE TRIGGER medicines_barcode_cache_ai AFTER INSERT ON medicines
+WHEN new.barcode IS NOT NULL AND new.barcode != '' BEGIN
+    INSERT INTO barcode_cache (upc, found, title, source, fetched_at)
+    VALUES (new.barcode, 1, new.medicineName, 'inventory', strftime('%s', 'now'))
+    ON CONFLICT (upc) DO UPDATE SET found = 1, title = excluded.title, message = NULL, source = 'inventory', fetched_at = excluded.fetched_at
+    WHERE barcode_cache.source = 'inventory' OR NOT barcode_cache.found;
+END;
+"""
+
+# Medicines triggers as (event, when, statement over {rows}). While bulk_write_mode
+# has a row (only inside a bulk write) they are skipped and run once per batch instead.
+INSERTED_ROW = "(SELECT * FROM medicines WHERE id = new.id)"
+BULK_INSERTED_ROWS = "(SELECT * FROM medicines WHERE id > ?)"
+MEDICINES_INSERT_TRIGGERS = {
+    'medicines_fts_ai': ('INSERT', None, """
+        INSERT INTO medicines_fts (rowid, medicineName, shop_id, barcode)
+        SELECT id, medicineName, shop_id, barcode FROM {rows}
+    """),
+    'medicines_barcode_cache_ai': ('INSERT', None, """
+        INSERT INTO barcode_cache (upc, found, title, source, fetched_at)
+        SELECT barcode, 1, medicineName, 'inventory', strftime('%s', 'now')
+        FROM {rows} WHERE barcode IS NOT NULL AND barcode != '' ORDER BY id
+        ON CONFLICT (upc) DO UPDATE SET found = 1, title = excluded.title, message = NULL, source = 'inventory', fetched_at = excluded.fetched_at
+        WHERE barcode_cache.source = 'inventory' OR NOT barcode_cache.found
+    """),
+    'medicines_change_log_ai': ('INSERT', None, """
+        INSERT INTO change_log (table_name, row_id, row_uid, op, qty_delta, origin_node, origin_seq)
+        SELECT 'medicines', id, COALESCE(sync_uid, (SELECT node_id FROM sync_node) || ':' || id), 'I', quantity,
+               (SELECT origin_node FROM sync_applying), (SELECT origin_seq FROM sync_applying)
+        FROM {rows} ORDER BY id
+    """),
+    'medicines_stock_ai': ('INSERT', None, """
+        INSERT INTO product_stock (product_key, medicine_name, barcode, batch_count, total_quantity, usable_quantity)
+        SELECT lower(trim(medicineName)), MAX(medicineName), MAX(NULLIF(barcode, '')), COUNT(*), SUM(quantity),
+               SUM(CASE WHEN expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN quantity ELSE 0 END)
+        FROM {rows} GROUP BY 1
+        ON CONFLICT (product_key) DO UPDATE SET
+            medicine_name = excluded.medicine_name, barcode = COALESCE(excluded.barcode, barcode),
+            batch_count = batch_count + excluded.batch_count, total_quantity = total_quantity + excluded.total_quantity,
+            usable_quantity = usable_quantity + excluded.usable_quantity
+    """),
+    'medicines_changed_ai': ('INSERT', None, """
+        UPDATE change_counters SET generation = generation + 1, changed_at = strftime('%s', 'now')
+        WHERE name = 'medicines' AND EXISTS (SELECT 1 FROM {rows})
+    """),
+}
+
+# Quantity triggers as (event, when, per-row statement). A single-row update, the
+# common small bill, runs the plain per-row bodies; update_stock_quantities() runs
+# BULK_STOCK_UPDATE_STATEMENTS once over temp.stock_updates (id, quantity_before,
+# quantity_after) instead.
+MEDICINES_STOCK_UPDATE_TRIGGERS = {
+    'medicines_change_log_stock': ('UPDATE OF quantity', 'new.quantity IS NOT old.quantity', """
+        INSERT INTO change_log (table_name, row_id, row_uid, op, qty_delta, origin_node, origin_seq)
+        VALUES ('medicines', new.id, COALESCE(new.sync_uid, (SELECT node_id FROM sync_node) || ':' || new.id), 'Q',
+                new.quantity - old.quantity, (SELECT origin_node FROM sync_applying), (SELECT origin_seq FROM sync_applying))
+    """),
+    'medicines_stock_qty': ('UPDATE OF quantity',
+                            'new.quantity IS NOT old.quantity AND new.medicineName IS old.medicineName AND new.expiryDate IS old.expiryDate', """
+        UPDATE product_stock SET total_quantity = total_quantity + new.quantity - old.quantity,
+            usable_quantity = usable_quantity + CASE WHEN new.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN new.quantity - old.quantity ELSE 0 END
+        WHERE product_key = lower(trim(new.medicineName))
+    """),
+    'medicines_changed_au': ('UPDATE', None, """
+        UPDATE change_counters SET generation = generation + 1, changed_at = strftime('%s', 'now') WHERE name = 'medicines'
+    """),
+}
+BULK_STOCK_UPDATE_STATEMENTS = {
+    'medicines_change_log_stock': """
+        INSERT INTO change_log (table_name, row_id, row_uid, op, qty_delta, origin_node, origin_seq)
+        SELECT 'medicines', m.id, COALESCE(m.sync_uid, (SELECT node_id FROM sync_node) || ':' || m.id), 'Q',
+               u.quantity_after - u.quantity_before, (SELECT origin_node FROM sync_applying), (SELECT origin_seq FROM sync_applying)
+        FROM temp.stock_updates u JOIN medicines m ON m.id = u.id WHERE u.quantity_after IS NOT u.quantity_before ORDER BY u.id
+    """,
+    'medicines_stock_qty': """
+        UPDATE product_stock SET total_quantity = total_quantity + d.total_delta, usable_quantity = usable_quantity + d.usable_delta
+        FROM (SELECT lower(trim(m.medicineName)) AS product_key, SUM(u.quantity_after - u.quantity_before) AS total_delta,
+                     SUM(CASE WHEN m.expiryDate >= (SELECT as_of FROM stock_expiry_state) THEN u.quantity_after - u.quantity_before ELSE 0 END) AS usable_delta
+              FROM temp.stock_updates u JOIN medicines m ON m.id = u.id GROUP BY 1) AS d
+        WHERE product_stock.product_key = d.product_key
+    """,
+    'medicines_changed_au': """
+        UPDATE change_counters SET generation = generation + 1, changed_at = strftime('%s', 'now')
+        WHERE name = 'medicines' AND EXISTS (SELECT 1 FROM temp.stock_updates)
+    """,
+}
+
+def _create_bulk_triggers(db, triggers, rows=None):
+    db.execute("CREATE TABLE IF NOT EXISTS bulk_write_mode (active INTEGER NOT NULL)")
+    for name, (event, when, statement) in triggers.items():
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"""
+            CREATE TRIGGER {name} AFTER {event} ON medicines
+            WHEN {f'{when} AND ' if when else ''}NOT EXISTS (SELECT 1 FROM bulk_write_mode) BEGIN
+                {statement.format(rows=rows) if rows else statement};
+            END
+        """)
+
+def _migrate_bulk_insert_triggers(db):
+    _create_bulk_triggers(db, MEDICINES_INSERT_TRIGGERS, INSERTED_ROW)
+
+def _migrate_bulk_stock_update_triggers(db):
+    _create_bulk_triggers(db, MEDICINES_STOCK_UPDATE_TRIGGERS)
+
+def _migrate_normalize_dates(db):
+    """Older versions stored dates as posted, e.g. '2025-1-5'; the expiry filters
+    compare them as strings, so they are rewritten as YYYY-MM-DD."""
+    updates = []
+    for row in db.execute("SELECT id, mfgDate, expiryDate FROM medicines WHERE length(mfgDate) != 10 OR length(expiryDate) != 10"):
+        try:
+            updates.append((parse_date(row['mfgDate']).isoformat(), parse_date(row['expiryDate']).isoformat(), row['id']))
+        except (ValueError, TypeError):
+            app.logger.warning(f"Medicine ID {row['id']} has an unreadable date ({row['mfgDate']!r}, {row['expiryDate']!r}); left as is.")
+    db.executemany("UPDATE medicines SET mfgDate = ?, expiryDate = ? WHERE id = ?", updates)
+    if updates:
+        rebuild_product_stock(db)
+
+MIGRATIONS = [
+    (2, "Search and expiry indexes on medicines", INDEX_SQL),
+    (3, "Change counters for app_settings", CHANGE_COUNTERS_SQL),
+    (4, "Barcode lookup cache", BARCODE_CACHE_SQL),
+    (5, "Daily sales rollups", _migrate_sales_rollups),
+    (6, "Bill history indexes", BILL_HISTORY_INDEX_SQL),
+    (7, "Customer search columns and indexes", _migrate_customer_search),
+    (8, "Change log for delta sync", _migrate_change_log),
+    (9, "Per-product stock aggregate", _migrate_product_stock),
+    (10, "Change counters for conditional responses", _migrate_data_versions),
+    (11, "Bill archive catalogue", BILL_ARCHIVE_SQL),
+    (12, "Stock adjustment ledger", STOCK_ADJUSTMENT_SQL),
+    (13, "Change counter for reorder levels", REORDER_LEVEL_VERSION_SQL),
+    (14, "Barcode cache entries from inventory no longer replace API answers", BARCODE_CACHE_TRIGGER_SQL),
+    (15, "Bulk write mode for medicines insert triggers", _migrate_bulk_insert_triggers),
+    (16, "Bulk write mode for stock update triggers", _migrate_bulk_stock_update_triggers),
+    (17, "Zero-padded medicine dates", _migrate_normalize_dates),
+    (18, "Per-row stock update triggers without the set-based join", _migrate_bulk_stock_update_triggers),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def column_exists(db, table_name, column_name):
+    return any(row['name'] == column_name for row in db.execute(f"PRAGMA table_info({table_name})"))
+
+def get_schema_version(db):
+    """Returns the applied schema version, 0 for an uninitialized database. A database
+    created before versioning (base tables but no schema_version) counts as version 1."""
+    if not table_exists('schema_version', db):
+        return BASE_SCHEMA_VERSION if all(table_exists(t, db) for t in REQUIRED_TABLES) else 0
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def _split_sql_script(script):
+    """Splits a migration script into single statements (trigger bodies stay whole)."""
+    statements, buffer = [], ''
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+def migrate_db(db):
+    """Applies pending migrations in order, each atomically. Returns the versions applied.
+    Every step re-checks schema_version under the write lock, so workers starting
+    at the same time never apply a migration twice."""
+    if get_schema_version(db) < BASE_SCHEMA_VERSION:
+        raise RuntimeError("Database is not initialized. Run 'flask init-db' first.")
+    db.execute("BEGIN IMMEDIATE")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db.execute("INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)", (BASE_SCHEMA_VERSION, "Base schema (schema.sql)"))
+    db.commit()
+    applied = []
+    for version, description, step in MIGRATIONS:
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                db.rollback()
+                continue
+            if callable(step):
+                step(db)
+            else:
+                for statement in _split_sql_script(step):
+                    db.execute(statement)
+            db.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            db.commit()
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        app.logger.info(f"Applied schema migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+PAGE_ENDPOINTS = {'index_redirect', 'home', 'admin_home', 'inventory', 'customers', 'billing_page'}
+
+def check_schema(db):
+    """Verifies the schema once per process, applying any pending migrations.
+    Returns False while the database is uninitialized."""
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return True
+        version = get_schema_version(db)
+        if version < BASE_SCHEMA_VERSION:
+            return False
+        if version < LATEST_SCHEMA_VERSION:
+            app.logger.info(f"Database schema is at version {version}; migrating to {LATEST_SCHEMA_VERSION}.")
+            migrate_db(db)
+        _schema_ready = True
+        return True
+
+@app.before_request
+def ensure_schema_ready():
+    if _schema_ready or request.endpoint in ('static', 'login', 'logout', 'metrics'):
+        return None
+    if check_schema(get_db()):
+        return None
+    message = "Database not initialized. Please run 'flask init-db'."
+    app.logger.error(message)
+    if request.method == 'GET' and request.endpoint in PAGE_ENDPOINTS:
+        flash(message, "error")
+        return render_template('home.html'), 503
+    return jsonify({"success": False, "message": message}), 503
+
 def init_db():
     with app.app_context():
         db = get_db()
@@ -54,8 +1006,9 @@ def init_db():
             with app.open_resource('schema.sql', mode='r') as f:
                 db.cursor().executescript(f.read())
             db.commit()
+            migrate_db(db)
             app.logger.info("Database initialized successfully using schema.sql.")
-            required_tables = ['medicines', 'customers', 'bills', 'bill_items', 'app_settings']
+            required_tables = REQUIRED_TABLES
             for table in required_tables:
                 if not table_exists(table):
                     app.logger.error(f"CRITICAL: '{table}' table NOT created after init_db.")
@@ -75,52 +1028,142 @@ def init_db():
 
 @app.cli.command('init-db')
 def init_db_command():
-    if os.path.exists(DATABASE):
-        click.echo(f"WARNING: Database file '{DATABASE}' already exists. Re-initializing will clear ALL data.")
+    database = app.config['DATABASE']
+    if os.path.exists(database):
+        click.echo(f"WARNING: Database file '{database}' already exists. Re-initializing will clear ALL data.")
         if not click.confirm("Do you want to continue and re-initialize the database?"):
             click.echo("Database initialization cancelled.")
             return
         try:
-            os.remove(DATABASE) 
-            click.echo(f"Removed existing database '{DATABASE}'.")
+            close_db()
+            os.remove(database) 
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(database + suffix):
+                    os.remove(database + suffix)
+            click.echo(f"Removed existing database '{database}'.")
         except OSError as e:
             click.echo(f"Error removing existing database: {e}. Please remove it manually and try again.")
             return
     init_db()
     click.echo('Initialized the database.')
 
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Upgrades an existing database to the latest schema version without data loss."""
+    with app.app_context():
+        db = get_db()
+        try:
+            applied = migrate_db(db)
+        except (RuntimeError, sqlite3.Error) as e:
+            click.echo(f"Migration failed: {e}")
+            return
+    if applied:
+        click.echo(f"Applied migrations: {', '.join(str(v) for v in applied)}. Schema is at version {LATEST_SCHEMA_VERSION}.")
+    else:
+        click.echo(f"Database schema is already up to date (version {LATEST_SCHEMA_VERSION}).")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recomputes the daily sales rollups from the full bill history (archived
+    months included) and the per-product stock aggregate from medicines."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        archived_months = stage_archived_sales(db)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rebuild_sales_rollups(db, with_archives=bool(archived_months))
+            rebuild_product_stock(db)
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            click.echo(f"Rebuilding rollups failed: {e}")
+            return
+        days = db.execute("SELECT COUNT(*) FROM sales_daily_shop").fetchone()[0]
+        products = db.execute("SELECT COUNT(*) FROM product_stock").fetchone()[0]
+    click.echo(f"Rebuilt sales rollups ({days} shop-day rows) and stock totals ({products} products).")
+
 # --- Utility Functions ---
+EXPIRY_STATUSES = {
+    'expired': {"statusText": "Expired", "statusClass": "badge-danger", "statusKey": "expired"},
+    'soon': {"statusText": "Expires Soon", "statusClass": "badge-warning", "statusKey": "soon"},
+    'good': {"statusText": "Good", "statusClass": "badge-success", "statusKey": "good"},
+}
+
+@lru_cache(maxsize=8)
+def _expiry_boundaries_for(today, soon_days):
+    return today.strftime('%Y-%m-%d'), (today + datetime.timedelta(days=soon_days)).strftime('%Y-%m-%d')
+
+def expiry_boundaries(soon_days=None):
+    """Returns (today, soon_cutoff) as ISO date strings, computed once per day and window."""
+    if soon_days is None:
+        soon_days = app.config['EXPIRY_SOON_DAYS']
+    return _expiry_boundaries_for(datetime.date.today(), soon_days)
+
+def expiry_status_sql(column='expiryDate'):
+    """SQL CASE classifying a row's expiry; binds (today, soon_cutoff)."""
+    return f"CASE WHEN {column} < ? THEN 'expired' WHEN {column} <= ? THEN 'soon' ELSE 'good' END"
+
 def get_expiry_status(expiry_date_str):
     if not expiry_date_str:
         return {"statusText": "N/A", "statusClass": "badge-secondary", "statusKey": "unknown"}
-    today = datetime.date.today()
     try:
-        expiry_date = datetime.datetime.strptime(str(expiry_date_str), '%Y-%m-%d').date()
+        expiry_date_str = parse_date(str(expiry_date_str)).isoformat()
     except ValueError:
         return {"statusText": "Invalid Date", "statusClass": "badge-danger", "statusKey": "invalid"}
-    if expiry_date < today:
-        return {"statusText": "Expired", "statusClass": "badge-danger", "statusKey": "expired"}
-    elif expiry_date <= (today + datetime.timedelta(days=30)): 
-        return {"statusText": "Expires Soon", "statusClass": "badge-warning", "statusKey": "soon"}
+    today_str, soon_cutoff_str = expiry_boundaries()
+    if expiry_date_str < today_str:
+        return EXPIRY_STATUSES['expired']
+    elif expiry_date_str <= soon_cutoff_str:
+        return EXPIRY_STATUSES['soon']
     else:
-        return {"statusText": "Good", "statusClass": "badge-success", "statusKey": "good"}
+        return EXPIRY_STATUSES['good']
 
-def get_app_setting(key):
+# --- Settings Cache ---
+# app_settings is loaded once per process and served from memory. Writes go
+# through update_app_setting(), which refreshes the cache in the same step; other
+# workers notice via the 'app_settings' change counter, re-read at most every
+# SETTINGS_RECHECK_SECONDS. The tuple is replaced atomically, never mutated.
+_settings_cache = (None, None, 0.0) # (values, generation, checked_at)
+
+def read_generation(db, name):
+    """Current change_counters generation of a table; 0 if it is not counted."""
+    row = db.execute("SELECT generation FROM change_counters WHERE name = ?", (name,)).fetchone()
+    return row['generation'] if row else 0
+
+def _read_settings_generation(db):
+    return read_generation(db, 'app_settings')
+
+def _read_settings(db):
+    return {row['setting_key']: row['setting_value'] for row in db.execute("SELECT setting_key, setting_value FROM app_settings")}
+
+def get_app_settings():
+    global _settings_cache
+    values, generation, checked_at = _settings_cache
+    now = time.monotonic()
+    if values is not None and now - checked_at < app.config['SETTINGS_RECHECK_SECONDS']:
+        return values
     db = get_db()
-    if not table_exists('app_settings'):
-        app.logger.warning("app_settings table does not exist. Returning None.")
-        return None
-    row = db.execute("SELECT setting_value FROM app_settings WHERE setting_key = ?", (key,)).fetchone()
-    return row['setting_value'] if row else None
+    current_generation = _read_settings_generation(db)
+    if values is None or current_generation != generation:
+        # Read the generation first: a write landing in between only costs one extra reload later.
+        values = _read_settings(db)
+    _settings_cache = (values, current_generation, now)
+    return values
+
+def get_app_setting(key):
+    return get_app_settings().get(key)
 
 def update_app_setting(key, value):
+    global _settings_cache
     db = get_db()
-    if not table_exists('app_settings'):
-        app.logger.error("Cannot update setting: app_settings table does not exist.")
-        return False
     try:
         db.execute("INSERT OR REPLACE INTO app_settings (setting_key, setting_value) VALUES (?, ?)", (key, value))
+        generation, values = _read_settings_generation(db), _read_settings(db)
         db.commit()
+        _settings_cache = (values, generation, time.monotonic())
         return True
     except sqlite3.Error as e:
         app.logger.error(f"Database error updating app setting '{key}': {e}")
@@ -157,6 +1200,108 @@ def login_required(role=None):
         return decorated_function
     return decorator
 
+# --- Conditional Responses and Compression ---
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json',
+                          'application/javascript', 'application/x-ndjson', 'image/svg+xml'}
+_brotli_module = None
+
+@lru_cache(maxsize=1)
+def code_version():
+    """(token, mtime) of app.py and the templates; part of every ETag."""
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    paths = [os.path.abspath(__file__)] + [os.path.join(template_dir, name) for name in sorted(os.listdir(template_dir))]
+    stamps = [(path, os.stat(path).st_mtime_ns) for path in paths]
+    return hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()[:8], int(max(stamp for _, stamp in stamps) / 1e9)
+
+def read_data_versions(db, tables):
+    rows = db.execute(f"SELECT name, generation, changed_at FROM change_counters WHERE name IN ({','.join('?' * len(tables))}) ORDER BY name",
+                      tables).fetchall()
+    return [tuple(row) for row in rows]
+
+def conditional(*tables, daily=False):
+    """Answers GETs with 304 while the change counters of `tables` (and, with daily=True, the date) are unchanged."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'): # Pending flash messages must be rendered
+                return f(*args, **kwargs)
+            versions = read_data_versions(get_db(), tables) if tables else []
+            code_token, code_mtime = code_version()
+            today = datetime.date.today()
+            etag_source = repr((request.full_path, session.get('user_id'), session.get('role'), versions, code_token, today.isoformat() if daily else ''))
+            etag = hashlib.sha1(etag_source.encode('utf-8')).hexdigest()[:24]
+            last_modified = max([code_mtime] + [changed_at or 0 for _, _, changed_at in versions] +
+                                ([int(time.mktime(today.timetuple()))] if daily else []))
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None and request.if_modified_since.timestamp() >= last_modified
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Only whole seconds that are over: a write later in the current second would share the timestamp.
+            if last_modified < int(time.time()):
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return decorated_function
+    return decorator
+
+def _brotli():
+    global _brotli_module
+    if _brotli_module is None:
+        try:
+            import brotli
+            _brotli_module = brotli
+        except ImportError:
+            _brotli_module = False
+    return _brotli_module or None
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is None or response.content_length < app.config['COMPRESS_MIN_BYTES']:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if _brotli() else ['gzip'])
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if encoding == 'br':
+        response.set_data(_brotli().compress(data, quality=5))
+    else:
+        compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31) # 31: gzip container
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak: # The bytes differ from the uncompressed representation
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        try:
+            values['v'] = int(os.stat(os.path.join(app.static_folder, values['filename'])).st_mtime)
+        except OSError:
+            pass
+
+@app.after_request
+def cache_static_files(response):
+    if request.endpoint == 'static' and 'v' in request.args and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE_SECONDS']
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
 # --- Authentication Routes ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -207,6 +1352,7 @@ def index_redirect():
 
 @app.route('/admin/home') 
 @login_required(role='admin') 
+@conditional('app_settings')
 def admin_home():
     upi_id = get_app_setting('upi_id')
     payee_name = get_app_setting('payee_name')
@@ -229,71 +1375,209 @@ def admin_upi_settings():
 
 @app.route('/home')
 @login_required() 
+@conditional()
 def home():
     if session.get('role') == 'admin':
          pass 
     return render_template('home.html')
 
 
+INVENTORY_PAGE_SIZE = 50
+INVENTORY_MAX_PAGE_SIZE = 500
+INVENTORY_STATUS_KEYS = ('expired', 'soon', 'good')
+
 @app.route('/inventory')
 @login_required()
+@conditional()
 def inventory():
+    return render_template('inventory.html', page_size=INVENTORY_PAGE_SIZE)
+
+def _inventory_filters(args, today, soon_cutoff):
+    """Builds the WHERE clauses shared by the inventory page query and its counts."""
+    clauses, params = [], []
+    supplier = args.get('supplier', '').strip()
+    if supplier:
+        clauses.append("supplier = ? COLLATE NOCASE"); params.append(supplier)
+    shelf = args.get('shelf', '').strip()
+    if shelf:
+        clauses.append("shelfNo = ? COLLATE NOCASE"); params.append(shelf)
+    name = args.get('name', '').strip()
+    if name:
+        if len(name) >= 3:
+            clauses.append("id IN (SELECT rowid FROM medicines_fts WHERE medicines_fts MATCH ?)")
+            params.append('medicineName : "' + name.replace('"', '""') + '"')
+        else:
+            clauses.append("medicineName LIKE ? ESCAPE '\\'"); params.append(_escape_like(name) + '%')
+    status_clauses, status_params = [], []
+    status = args.get('status', 'all')
+    if status == 'expired':
+        status_clauses.append("expiryDate < ?"); status_params.append(today)
+    elif status == 'soon':
+        status_clauses.append("expiryDate BETWEEN ? AND ?"); status_params.extend([today, soon_cutoff])
+    elif status == 'good':
+        status_clauses.append("expiryDate > ?"); status_params.append(soon_cutoff)
+    return clauses, params, status_clauses, status_params
+
+@app.route('/inventory_data', methods=['GET'])
+@login_required()
+@conditional('medicines', daily=True)
+def inventory_data():
+    """One keyset page of inventory ordered by (expiryDate, id), with server-side filters.
+    Pass the returned next_cursor back as ?cursor= to get the following page; counts are
+    only computed for the first page."""
+    status = request.args.get('status', 'all')
+    if status != 'all' and status not in INVENTORY_STATUS_KEYS:
+        return jsonify({"success": False, "message": f"Invalid status filter: {status}."}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', INVENTORY_PAGE_SIZE)), 1), INVENTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid page size."}), 400
+    cursor = request.args.get('cursor', '').strip()
+    after = None
+    if cursor:
+        cursor_expiry, _, cursor_id = cursor.rpartition('|')
+        if not cursor_id.isdigit():
+            return jsonify({"success": False, "message": "Invalid cursor."}), 400
+        after = (cursor_expiry, int(cursor_id))
+
+    today_str, soon_cutoff_str = expiry_boundaries()
+    clauses, params, status_clauses, status_params = _inventory_filters(request.args, today_str, soon_cutoff_str)
+
     db = get_db()
-    if not table_exists('medicines'):
-        flash("The 'medicines' table is missing. Please initialize the database.", "error")
-        return render_template('inventory.html', medicines=[]), 500
-    cur = db.execute("SELECT id, barcode, medicineName, batchNo, mrp, sellingPrice, mfgDate, expiryDate, quantity, supplier, shelfNo, boxNo, shop_id FROM medicines ORDER BY expiryDate ASC")
-    medicines_from_db = cur.fetchall()
-    medicines_with_status = []
-    for row in medicines_from_db:
-        med_dict = dict(row) 
-        status_info = get_expiry_status(med_dict.get('expiryDate'))
-        full_med_info = {**med_dict, **status_info}
-        medicines_with_status.append(full_med_info)
-    return render_template('inventory.html', medicines=medicines_with_status)
+    try:
+        page_clauses, page_params = clauses + status_clauses, params + status_params
+        if after:
+            page_clauses.append("(expiryDate, id) > (?, ?)"); page_params.extend(after)
+        where_sql = f"WHERE {' AND '.join(page_clauses)}" if page_clauses else ""
+        rows = db.execute(f"""
+            SELECT id, barcode, medicineName, batchNo, mrp, sellingPrice, mfgDate, expiryDate, quantity, supplier, shelfNo, boxNo, shop_id,
+                   {expiry_status_sql()} AS statusKey
+            FROM medicines {where_sql}
+            ORDER BY expiryDate, id LIMIT ?
+        """, (today_str, soon_cutoff_str, *page_params, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        medicines = [{**dict(row), **EXPIRY_STATUSES[row['statusKey']]} for row in rows]
+        result = {
+            "success": True,
+            "medicines": medicines,
+            "next_cursor": f"{rows[-1]['expiryDate']}|{rows[-1]['id']}" if has_more else None,
+        }
+        if not after:
+            count_where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+            counts = db.execute(f"""
+                SELECT COUNT(*) AS total,
+                       COALESCE(SUM(expiryDate < ?), 0) AS expired,
+                       COALESCE(SUM(expiryDate BETWEEN ? AND ?), 0) AS soon,
+                       COALESCE(SUM(expiryDate > ?), 0) AS good
+                FROM medicines {count_where}
+            """, (today_str, today_str, soon_cutoff_str, soon_cutoff_str, *params)).fetchone()
+            result["counts"] = dict(counts)
+            result["total"] = counts[status] if status != 'all' else counts['total']
+        return jsonify(result)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error listing inventory: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
 
-@app.route('/add_medicine', methods=['POST'])
+EXPIRY_SUMMARY_LIST_LIMIT = 20
+
+@app.route('/expiry_summary', methods=['GET'])
 @login_required()
-def add_medicine_route():
-    if not table_exists('medicines'):
-        return jsonify({"success": False, "message": "Database not initialized: 'medicines' table missing."}), 500
-    data = request.get_json()
-    if not data:
-        return jsonify({"success": False, "message": "Invalid JSON data received."}), 400
+@conditional('medicines', daily=True)
+def expiry_summary():
+    """Expired / expiring-within-N-days / good counts plus the first batches of each."""
+    try:
+        soon_days = int(request.args.get('days', app.config['EXPIRY_SOON_DAYS']))
+        limit = min(max(int(request.args.get('limit', EXPIRY_SUMMARY_LIST_LIMIT)), 0), INVENTORY_MAX_PAGE_SIZE)
+        if soon_days < 0:
+            return jsonify({"success": False, "message": "Days cannot be negative."}), 400
+        today_str, soon_cutoff_str = expiry_boundaries(soon_days)
+    except (ValueError, OverflowError):
+        return jsonify({"success": False, "message": "Invalid days or limit parameter."}), 400
+    ranges = {
+        'expired': ("expiryDate < ?", (today_str,), "expiryDate DESC, id DESC"),
+        'soon': ("expiryDate BETWEEN ? AND ?", (today_str, soon_cutoff_str), "expiryDate, id"),
+        'good': ("expiryDate > ?", (soon_cutoff_str,), "expiryDate, id"),
+    }
+    db = get_db()
+    try:
+        counts, lists = {}, {}
+        for key, (predicate, params, order_by) in ranges.items():
+            counts[key] = db.execute(f"SELECT COUNT(*) FROM medicines WHERE {predicate}", params).fetchone()[0]
+            rows = db.execute(f"""
+                SELECT id, medicineName, batchNo, expiryDate, quantity, shelfNo, boxNo, shop_id
+                FROM medicines WHERE {predicate} ORDER BY {order_by} LIMIT ?
+            """, (*params, limit)).fetchall()
+            lists[key] = [{**dict(row), **EXPIRY_STATUSES[key]} for row in rows]
+        return jsonify({"success": True, "days": soon_days, "today": today_str, "soon_cutoff": soon_cutoff_str,
+                        "counts": counts, "medicines": lists})
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error building expiry summary: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+
+MEDICINE_INSERT_SQL = """
+    INSERT INTO medicines (barcode, medicineName, batchNo, mrp, sellingPrice, mfgDate, expiryDate, quantity, supplier, shelfNo, boxNo, shop_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def parse_date(value):
+    """Parses YYYY-MM-DD (month/day may be unpadded, as strptime allows) several
+    times faster than strptime, which matters on bulk imports."""
+    parts = value.split('-')
+    if len(parts) != 3 or len(parts[0]) != 4 or not all(p.isdigit() and len(p) <= 4 for p in parts):
+        raise ValueError(f"Invalid date: {value!r}")
+    return datetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
+
+def _text_field(data, field):
+    value = data.get(field)
+    return str(value).strip() if value is not None else ''
+
+def validate_medicine(data):
+    """Validates one medicine record (add form, CSV row or JSONL object).
+    Returns (values for MEDICINE_INSERT_SQL, None) or (None, error message).
+    Dates are stored normalized to YYYY-MM-DD so expiry comparisons stay string-safe."""
     required_fields = ['medicineName', 'batchNo', 'mfgDate', 'expiryDate', 'quantity']
     missing_fields = [field for field in required_fields if not data.get(field) or (isinstance(data.get(field), str) and not data.get(field).strip())]
     if missing_fields:
-        return jsonify({"success": False, "message": f"Missing required fields: {', '.join(missing_fields)}."}), 400
+        return None, f"Missing required fields: {', '.join(missing_fields)}."
     try:
-        mfg_date = datetime.datetime.strptime(data['mfgDate'].strip(), '%Y-%m-%d').date()
-        expiry_date = datetime.datetime.strptime(data['expiryDate'].strip(), '%Y-%m-%d').date()
+        mfg_date = parse_date(_text_field(data, 'mfgDate'))
+        expiry_date = parse_date(_text_field(data, 'expiryDate'))
         if mfg_date > expiry_date:
-            return jsonify({"success": False, "message": "Manufacturing date cannot be after expiry date."}), 400
+            return None, "Manufacturing date cannot be after expiry date."
         quantity = int(data['quantity'])
         if quantity < 0:
-            return jsonify({"success": False, "message": "Quantity cannot be negative."}), 400
+            return None, "Quantity cannot be negative."
         mrp = float(data.get('mrp')) if data.get('mrp') else None
         if mrp is not None and mrp < 0:
-            return jsonify({"success": False, "message": "MRP cannot be negative."}), 400
+            return None, "MRP cannot be negative."
         selling_price = float(data.get('sellingPrice')) if data.get('sellingPrice') else None
         if selling_price is not None and selling_price < 0:
-            return jsonify({"success": False, "message": "Selling Price cannot be negative."}), 400
-    except ValueError:
-        return jsonify({"success": False, "message": "Invalid data format for date, quantity, or price."}), 400
-    shop_id_val = data.get('shopId', '').strip()
+            return None, "Selling Price cannot be negative."
+    except (ValueError, TypeError):
+        return None, "Invalid data format for date, quantity, or price."
+    shop_id_val = _text_field(data, 'shopId')
+    return (
+        _text_field(data, 'barcode'), _text_field(data, 'medicineName'), _text_field(data, 'batchNo'),
+        mrp, selling_price,
+        mfg_date.isoformat(), expiry_date.isoformat(), quantity,
+        _text_field(data, 'supplier'), _text_field(data, 'shelfNo'), _text_field(data, 'boxNo'),
+        shop_id_val if shop_id_val else None 
+    ), None
+
+@app.route('/add_medicine', methods=['POST'])
+@login_required()
+def add_medicine_route():
+    data = request.get_json()
+    if not data:
+        return jsonify({"success": False, "message": "Invalid JSON data received."}), 400
+    values, error = validate_medicine(data)
+    if error:
+        return jsonify({"success": False, "message": error}), 400
     db = get_db()
     try:
         cur = db.cursor()
-        cur.execute("""
-            INSERT INTO medicines (barcode, medicineName, batchNo, mrp, sellingPrice, mfgDate, expiryDate, quantity, supplier, shelfNo, boxNo, shop_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data.get('barcode', '').strip(), data['medicineName'].strip(), data['batchNo'].strip(),
-            mrp, selling_price,
-            data['mfgDate'].strip(), data['expiryDate'].strip(), quantity,
-            data.get('supplier', '').strip(), data.get('shelfNo', '').strip(), data.get('boxNo', '').strip(),
-            shop_id_val if shop_id_val else None 
-        ))
+        cur.execute(MEDICINE_INSERT_SQL, values)
         new_medicine_id = cur.lastrowid
         db.commit()
         new_med_row = db.execute("SELECT * FROM medicines WHERE id = ?", (new_medicine_id,)).fetchone()
@@ -307,11 +1591,127 @@ def add_medicine_route():
         app.logger.error(f"Database error on adding medicine: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"Database error: {e}"}), 500
 
+# --- Bulk Import ---
+IMPORT_BATCH_SIZE = 2000
+IMPORT_MAX_REPORTED_ERRORS = 1000
+
+def iter_import_records(stream, file_format):
+    """Yields (row_number, record or None, parse_error) from a binary CSV or JSONL stream."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        # Row numbers count the header as row 1, matching what a spreadsheet shows.
+        for row_number, record in enumerate(csv.DictReader(text), start=2):
+            yield row_number, record, None
+    else:
+        for row_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row_number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield row_number, None, "Each JSONL line must be an object."
+                continue
+            yield row_number, record, None
+
+def bulk_insert_medicines(db, rows):
+    """Inserts validated MEDICINE_INSERT_SQL rows in one write transaction."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM medicines").fetchone()[0]
+        db.execute("INSERT INTO bulk_write_mode (active) VALUES (1)")
+        db.executemany(MEDICINE_INSERT_SQL, rows)
+        db.execute("DELETE FROM bulk_write_mode")
+        for _, _, statement in MEDICINES_INSERT_TRIGGERS.values():
+            db.execute(statement.format(rows=BULK_INSERTED_ROWS), (last_id,))
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+def import_medicines(db, records, batch_size=IMPORT_BATCH_SIZE):
+    """Validates and inserts records in executemany() batches, one transaction per
+    batch. Bad rows are reported and skipped. A database or read error stops the
+    import; the report then covers the batches committed before it."""
+    imported, failed, errors, batch = 0, 0, [], []
+    read_error = database_error = None
+    try:
+        for row_number, record, parse_error in records:
+            values, error = (None, parse_error) if parse_error else validate_medicine(record)
+            if error:
+                failed += 1
+                if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                    errors.append({"row": row_number, "message": error})
+                continue
+            batch.append(values)
+            if len(batch) >= batch_size:
+                bulk_insert_medicines(db, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            bulk_insert_medicines(db, batch)
+            imported += len(batch)
+    except (UnicodeDecodeError, csv.Error) as e:
+        read_error = str(e)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error during medicine import after {imported} rows: {e}", exc_info=True)
+        database_error = str(e)
+    return {"imported": imported, "failed": failed, "errors": errors,
+            "errors_truncated": failed > len(errors), "read_error": read_error, "database_error": database_error}
+
+def _import_format(filename, requested_format):
+    if requested_format:
+        return requested_format.lower()
+    return 'jsonl' if filename and filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+@app.route('/import_medicines', methods=['POST'])
+@login_required()
+def import_medicines_route():
+    """Bulk import from an uploaded CSV (header row with the add-medicine field names) or JSONL file."""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({"success": False, "message": "No import file uploaded."}), 400
+    file_format = _import_format(upload.filename, request.form.get('format'))
+    if file_format not in ('csv', 'jsonl'):
+        return jsonify({"success": False, "message": "Unsupported import format. Use csv or jsonl."}), 400
+    report = import_medicines(get_db(), iter_import_records(upload.stream, file_format))
+    if report['read_error']:
+        return jsonify({"success": False, "message": f"Could not read import file after importing {report['imported']} medicines: "
+                                                     f"{report['read_error']}", **report}), 400
+    if report['database_error']:
+        return jsonify({"success": False, "message": f"Database error after importing {report['imported']} medicines: "
+                                                     f"{report['database_error']}", **report}), 500
+    app.logger.info(f"Medicine import by {session.get('user_id')}: {report['imported']} imported, {report['failed']} failed.")
+    return jsonify({"success": True, "message": f"Imported {report['imported']} medicines; {report['failed']} rows failed.", **report})
+
+@app.cli.command('import-medicines')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), help="Defaults to the file extension.")
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help="Rows per transaction.")
+def import_medicines_command(path, file_format, batch_size):
+    """Bulk-imports medicines from a CSV or JSONL file."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        with open(path, 'rb') as f:
+            report = import_medicines(db, iter_import_records(f, _import_format(path, file_format)), batch_size)
+    for error in report['errors']:
+        click.echo(f"Row {error['row']}: {error['message']}")
+    if report['errors_truncated']:
+        click.echo(f"... {report['failed'] - len(report['errors'])} more failed rows not shown.")
+    if report['read_error']:
+        click.echo(f"Could not read import file: {report['read_error']}")
+    if report['database_error']:
+        click.echo(f"Database error: {report['database_error']}")
+    click.echo(f"Imported {report['imported']} medicines; {report['failed']} rows failed.")
+
 @app.route('/delete_medicine/<int:medicine_id>', methods=['DELETE'])
 @login_required()
 def delete_medicine_route(medicine_id):
-    if not table_exists('medicines'):
-        return jsonify({"success": False, "message": "Database not initialized."}), 500
     db = get_db()
     try:
         cur = db.execute("DELETE FROM medicines WHERE id = ?", (medicine_id,))
@@ -325,52 +1725,202 @@ def delete_medicine_route(medicine_id):
         app.logger.error(f"Database error on deleting medicine ID {medicine_id}: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"Database error: {e}"}), 500
 
-@app.route('/fetch_barcode_details', methods=['GET'])
-@login_required()
-def fetch_barcode_details_from_api_route():
-    upc = request.args.get('upc', '').strip()
-    if not upc:
-        return jsonify({"success": False, "message": "UPC (barcode) parameter is missing."}), 400
+# --- Barcode Lookup ---
+# Scans are answered from barcode_cache when possible. Misses go upstream through
+# one pooled Session with retry/backoff, and concurrent misses for the same UPC
+# share a single upstream call: the first caller fetches, the rest wait on it.
+_upc_session = None
+_upc_session_lock = threading.Lock()
+_barcode_inflight = {}
+_barcode_inflight_lock = threading.Lock()
+
+class _InflightLookup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+def get_upc_session():
+    global _upc_session
+    if _upc_session is None:
+        with _upc_session_lock:
+            if _upc_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(total=app.config['UPC_API_RETRIES'], backoff_factor=0.5,
+                              status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']))
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(max_retries=retry, pool_maxsize=16))
+                session.mount('http://', HTTPAdapter(max_retries=retry, pool_maxsize=16))
+                _upc_session = session
+    return _upc_session
+
+def _barcode_result(row):
+    if row['found']:
+        return {"success": True, "title": row['title'] or "", "brand": row['brand'] or "", "manufacturer": row['manufacturer'] or ""}, 200
+    return {"success": False, "message": row['message'] or "Product not found or API error."}, 200
+
+def _read_barcode_cache(db, upc):
+    row = db.execute("SELECT * FROM barcode_cache WHERE upc = ?", (upc,)).fetchone()
+    if not row:
+        return None
+    ttl = app.config['BARCODE_CACHE_TTL_SECONDS'] if row['found'] else app.config['BARCODE_NEGATIVE_TTL_SECONDS']
+    if time.time() - row['fetched_at'] > ttl:
+        return None
+    return _barcode_result(row)
+
+def _fetch_barcode_from_api(db, upc):
+    """Calls the UPC API and caches definitive answers (found / not found). Transport
+    and format errors are returned to the caller but never cached."""
+    import requests
     api_url = f"{UPCITEMDB_TRIAL_BASE_URL}?upc={upc}"
     app.logger.info(f"Fetching barcode details for UPC: {upc} from {api_url}")
+    started, outcome = time.perf_counter(), 'ok'
     try:
-        response = requests.get(api_url, timeout=10) 
+        response = get_upc_session().get(api_url, timeout=app.config['UPC_API_TIMEOUT_SECONDS']) 
         response.raise_for_status() 
         data = response.json()
-        if data.get("code") == "OK" and data.get("items") and len(data["items"]) > 0:
-            item = data["items"][0]
-            app.logger.info(f"Successfully fetched details for UPC {upc}: Title - {item.get('title')}")
-            return jsonify({"success": True, "title": item.get("title", ""),"brand": item.get("brand", ""),"manufacturer": item.get("manufacturer", "")})
-        else:
-            app.logger.warning(f"API call for UPC {upc} did not return 'OK' or no items found. Response: {data.get('message', 'No message')}")
-            return jsonify({"success": False, "message": data.get("message", "Product not found or API error.")})
     except requests.exceptions.Timeout:
+        outcome = 'timeout'
         app.logger.error(f"Timeout error when fetching barcode details for UPC: {upc}", exc_info=True)
-        return jsonify({"success": False, "message": "API request timed out. Please try again."}), 504 
+        return {"success": False, "message": "API request timed out. Please try again."}, 504 
     except requests.exceptions.RequestException as e:
+        outcome = 'error'
         app.logger.error(f"API request error for UPC {upc}: {e}", exc_info=True)
-        return jsonify({"success": False, "message": f"API request error: {e}"}), 503 
+        return {"success": False, "message": f"API request error: {e}"}, 503 
     except ValueError: 
+        outcome = 'invalid_response'
         app.logger.error(f"Invalid JSON response from API for UPC {upc}", exc_info=True)
-        return jsonify({"success": False, "message": "Invalid API response format."}), 500
+        return {"success": False, "message": "Invalid API response format."}, 500
+    finally:
+        UPC_API_DURATION.observe(time.perf_counter() - started, outcome)
+    if data.get("code") == "OK" and data.get("items") and len(data["items"]) > 0:
+        item = data["items"][0]
+        app.logger.info(f"Successfully fetched details for UPC {upc}: Title - {item.get('title')}")
+        entry = (upc, 1, item.get("title", ""), item.get("brand", ""), item.get("manufacturer", ""), None)
+    else:
+        app.logger.warning(f"API call for UPC {upc} did not return 'OK' or no items found. Response: {data.get('message', 'No message')}")
+        entry = (upc, 0, None, None, None, data.get("message", "Product not found or API error."))
+    try:
+        db.execute("""
+            INSERT OR REPLACE INTO barcode_cache (upc, found, title, brand, manufacturer, message, source, fetched_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'api', ?)
+        """, (*entry, time.time()))
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        app.logger.warning(f"Could not cache barcode lookup for UPC {upc}: {e}")
+    return _barcode_result({'found': entry[1], 'title': entry[2], 'brand': entry[3], 'manufacturer': entry[4], 'message': entry[5]})
+
+def lookup_barcode(db, upc):
+    """Returns (payload, status_code) for a UPC, from cache or a coalesced API call."""
+    cached = _read_barcode_cache(db, upc)
+    if cached:
+        return cached
+    with _barcode_inflight_lock:
+        inflight = _barcode_inflight.get(upc)
+        is_leader = inflight is None
+        if is_leader:
+            inflight = _barcode_inflight[upc] = _InflightLookup()
+    if not is_leader:
+        if inflight.done.wait(app.config['UPC_API_TIMEOUT_SECONDS'] * (app.config['UPC_API_RETRIES'] + 1)) and inflight.result:
+            return inflight.result
+        return {"success": False, "message": "API request timed out. Please try again."}, 504
+    try:
+        inflight.result = _fetch_barcode_from_api(db, upc)
+    finally:
+        with _barcode_inflight_lock:
+            _barcode_inflight.pop(upc, None)
+        inflight.done.set()
+    return inflight.result
+
+@app.route('/fetch_barcode_details', methods=['GET'])
+@login_required()
+def fetch_barcode_details_from_api_route():
+    upc = request.args.get('upc', '').strip()
+    if not upc:
+        return jsonify({"success": False, "message": "UPC (barcode) parameter is missing."}), 400
+    try:
+        payload, status_code = lookup_barcode(get_db(), upc)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error looking up UPC {upc}: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify(payload), status_code
 
 # --- Customer Management Routes ---
+CUSTOMER_PAGE_SIZE = 25
+CUSTOMER_MAX_PAGE_SIZE = 200
+PHONE_QUERY_RE = re.compile(r'[\d\s()+.-]+')
+
+def normalize_phone(phone):
+    """Digits only, with a leading 0 or +91 trunk/country prefix dropped from
+    longer numbers, so '+91 98480-22338' and '9848022338' search the same."""
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) > 10 and digits.startswith(('91', '0')):
+        digits = digits[-10:]
+    return digits
+
+def search_customers(db, query='', limit=CUSTOMER_PAGE_SIZE, cursor=None):
+    """Returns (customers, next_cursor) for one keyset page of the directory.
+    Phone-shaped queries are a prefix range over phone_normalized; anything else
+    is a case-insensitive name prefix. An empty query lists everyone by name."""
+    phone_prefix = normalize_phone(query) if query and PHONE_QUERY_RE.fullmatch(query) else ''
+    if phone_prefix:
+        sort_sql, order_by = "phone_normalized", "phone_normalized, id"
+        clauses = ["phone_normalized >= ?", "phone_normalized < ?"]
+        params = [phone_prefix, phone_prefix[:-1] + chr(ord(phone_prefix[-1]) + 1)]
+    else:
+        sort_sql, order_by = "name COLLATE NOCASE", "name COLLATE NOCASE, id"
+        clauses, params = (["name LIKE ? ESCAPE '\\'"], [_escape_like(query) + '%']) if query else ([], [])
+    if cursor:
+        # The plain >= bound lets SQLite seek the index; the row value breaks ties on id.
+        clauses.append(f"{sort_sql} >= ? AND ({sort_sql}, id) > (?, ?)"); params.extend((cursor[0], *cursor))
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = db.execute(f"""
+        SELECT id, name, phone_number, email, address, strftime('%Y-%m-%d %H:%M', registered_at) AS registered_at,
+               {sort_sql} AS sort_key
+        FROM customers {where_sql}
+        ORDER BY {order_by} LIMIT ?
+    """, (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1]['sort_key']}|{rows[-1]['id']}" if has_more else None
+    return [{key: row[key] for key in row.keys() if key != 'sort_key'} for row in rows], next_cursor
+
 @app.route('/customers', methods=['GET'])
 @login_required()
+@conditional()
 def customers():
-    db = get_db()
-    if not table_exists('customers'):
-        flash("The 'customers' table is missing. Please initialize the database.", "error")
-        return render_template('customers.html', customers=[]), 500
-    all_customers = db.execute("SELECT id, name, phone_number, email, address, strftime('%Y-%m-%d %H:%M', registered_at) as registered_at FROM customers ORDER BY name ASC").fetchall()
-    return render_template('customers.html', customers=all_customers)
+    return render_template('customers.html', page_size=CUSTOMER_PAGE_SIZE)
+
+@app.route('/customers/search', methods=['GET'])
+@login_required()
+@conditional('customers')
+def customers_search():
+    """Paginated customer directory / picker. ?q= is a name or phone prefix; pass the
+    returned next_cursor back as ?cursor= to get the following page."""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', CUSTOMER_PAGE_SIZE)), 1), CUSTOMER_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid page size."}), 400
+    cursor = request.args.get('cursor', '').strip()
+    after = None
+    if cursor:
+        cursor_key, _, cursor_id = cursor.rpartition('|')
+        if not cursor_id.isdigit():
+            return jsonify({"success": False, "message": "Invalid cursor."}), 400
+        after = (cursor_key, int(cursor_id))
+    try:
+        customers_page, next_cursor = search_customers(get_db(), query, limit, after)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error searching customers ({query!r}): {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "customers": customers_page, "next_cursor": next_cursor})
 
 @app.route('/add_customer', methods=['POST'])
 @login_required()
 def add_customer():
-    if not table_exists('customers'):
-        flash("Database not initialized: 'customers' table missing.", "error")
-        return redirect(url_for('customers'))
     name = request.form.get('name', '').strip()
     phone_number = request.form.get('phone_number', '').strip()
     email = request.form.get('email', '').strip() or None 
@@ -380,7 +1930,8 @@ def add_customer():
         return redirect(url_for('customers'))
     db = get_db()
     try:
-        db.execute("INSERT INTO customers (name, phone_number, email, address) VALUES (?, ?, ?, ?)", (name, phone_number, email, address))
+        db.execute("INSERT INTO customers (name, phone_number, phone_normalized, email, address) VALUES (?, ?, ?, ?, ?)",
+                   (name, phone_number, normalize_phone(phone_number), email, address))
         db.commit()
         flash(f'Customer "{name}" added successfully!', 'success')
     except sqlite3.IntegrityError: 
@@ -395,56 +1946,148 @@ def add_customer():
 # --- Billing Routes ---
 @app.route('/billing')
 @login_required()
+@conditional()
 def billing_page():
-    required_billing_tables = ['medicines', 'customers', 'bills', 'bill_items', 'app_settings']
-    for table_name in required_billing_tables:
-        if not table_exists(table_name):
-            flash(f"Database error: The '{table_name}' table required for billing is missing. Please initialize the database.", "error")
-            if session.get('role') == 'admin': return redirect(url_for('admin_home'))
-            return redirect(url_for('home'))
     return render_template('billing.html')
 
-@app.route('/search_medicines_for_billing', methods=['GET'])
-@login_required()
-def search_medicines_for_billing():
-    query = request.args.get('query', '').strip()
-    if not query: return jsonify([]) 
-    db = get_db()
-    today_date_str = datetime.date.today().strftime('%Y-%m-%d')
-    try:
-        cur = db.execute("""
-            SELECT id, medicineName, batchNo, sellingPrice, quantity, shop_id 
-            FROM medicines 
-            WHERE (LOWER(medicineName) LIKE LOWER(?) OR LOWER(shop_id) LIKE LOWER(?))
-              AND sellingPrice IS NOT NULL AND sellingPrice > 0 AND quantity > 0 AND expiryDate >= ?
-            ORDER BY medicineName LIMIT 10 
-        """, (f'%{query}%', f'%{query}%', today_date_str))
-        medicines = [dict(row) for row in cur.fetchall()]
-        return jsonify(medicines)
-    except sqlite3.Error as e:
-        app.logger.error(f"Database error searching medicines for billing (query: {query}): {e}", exc_info=True)
-        return jsonify({"error": "Database search error"}), 500
+SEARCH_RESULT_LIMIT = 10
+SEARCH_CANDIDATE_LIMIT = 200
+BARCODE_MIN_LENGTH = 8
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_billable_medicines(db, query, today_date_str, limit=SEARCH_RESULT_LIMIT):
+    """Returns billable batches (priced, in stock, not expired) matching the query.
+    Name-prefix matches come first via the NOCASE index; the trigram index then
+    fills the remaining slots with substring matches on name, shop ID or barcode."""
+    billable_filter = "m.sellingPrice IS NOT NULL AND m.sellingPrice > 0 AND m.quantity > 0 AND m.expiryDate >= ?"
+    results = [dict(row) for row in db.execute(f"""
+        SELECT m.id, m.medicineName, m.batchNo, m.sellingPrice, m.quantity, m.shop_id
+        FROM medicines m
+        WHERE m.medicineName LIKE ? ESCAPE '\\' AND {billable_filter}
+        ORDER BY m.medicineName COLLATE NOCASE LIMIT ?
+    """, (_escape_like(query) + '%', today_date_str, limit))]
+    if len(results) < limit and query.isdigit():
+        # Barcode-shaped input: prefix range over the barcode index.
+        barcode_upper = query[:-1] + chr(ord(query[-1]) + 1)
+        seen_ids = [r['id'] for r in results]
+        exclude_clause = f"AND m.id NOT IN ({','.join('?' * len(seen_ids))})" if seen_ids else ""
+        results.extend(dict(row) for row in db.execute(f"""
+            SELECT m.id, m.medicineName, m.batchNo, m.sellingPrice, m.quantity, m.shop_id
+            FROM medicines m
+            WHERE m.barcode >= ? AND m.barcode < ? AND {billable_filter} {exclude_clause}
+            ORDER BY m.barcode LIMIT ?
+        """, (query, barcode_upper, today_date_str, *seen_ids, limit - len(results))))
+    # Trigram matching needs at least three characters. Long digit strings are
+    # scanner input; their trigrams are too common to be worth intersecting.
+    if len(results) < limit and len(query) >= 3 and not (query.isdigit() and len(query) >= BARCODE_MIN_LENGTH):
+        seen_ids = [r['id'] for r in results]
+        exclude_clause = f"AND m.id NOT IN ({','.join('?' * len(seen_ids))})" if seen_ids else ""
+        fts_query = '"' + query.replace('"', '""') + '"'
+        results.extend(dict(row) for row in db.execute(f"""
+            SELECT m.id, m.medicineName, m.batchNo, m.sellingPrice, m.quantity, m.shop_id
+            FROM medicines_fts f JOIN medicines m ON m.id = f.rowid
+            WHERE medicines_fts MATCH ? AND {billable_filter} {exclude_clause}
+            LIMIT ?
+        """, (fts_query, today_date_str, *seen_ids, SEARCH_CANDIDATE_LIMIT)))
+        # Sorting a bounded candidate set keeps very common trigrams from
+        # turning into a sort over every matching batch.
+        results[len(seen_ids):] = sorted(results[len(seen_ids):], key=lambda r: r['medicineName'].lower())
+    return results[:limit]
+
+# Cashiers type the same few prefixes all day, so search results are cached per
+# process. Entries belong to one (medicines generation, today) pair: any stock,
+# price or batch change bumps the generation through its trigger (in every
+# worker, since it is read from the database on each lookup), and a new day
+# changes which batches have expired. Either empties the whole cache.
+class SearchResultCache:
+    """Bounded LRU of billing search results, valid for a single generation."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, generation, key):
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+                return None
+            results = self._entries.get(key)
+            if results is not None:
+                self._entries.move_to_end(key)
+            return results
+
+    def put(self, generation, key, results):
+        with self._lock:
+            if generation != self._generation:
+                return # Computed against data that has changed since
+            self._entries[key] = results
+            while len(self._entries) > app.config['SEARCH_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = None
+
+_search_cache = SearchResultCache()
+
+def cached_search_billable_medicines(db, query, today_date_str):
+    if app.config['SEARCH_CACHE_SIZE'] <= 0:
+        return search_billable_medicines(db, query, today_date_str)
+    # Every branch of the search is case-insensitive for ASCII (LIKE, trigram, digits).
+    key = query.lower() if query.isascii() else query
+    generation = (read_generation(db, 'medicines'), today_date_str) # Read before searching, so a racing write only discards
+    results = _search_cache.get(generation, key)
+    if results is not None:
+        SEARCH_CACHE_LOOKUPS.inc('hit')
+        return results
+    SEARCH_CACHE_LOOKUPS.inc('miss')
+    results = search_billable_medicines(db, query, today_date_str)
+    _search_cache.put(generation, key, results)
+    return results
+
+@app.route('/search_medicines_for_billing', methods=['GET'])
+@login_required()
+@conditional('medicines', daily=True)
+def search_medicines_for_billing():
+    query = request.args.get('query', '').strip()
+    if not query: return jsonify([]) 
+    db = get_db()
+    today_date_str, _ = expiry_boundaries()
+    try:
+        return jsonify(cached_search_billable_medicines(db, query, today_date_str))
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error searching medicines for billing (query: {query}): {e}", exc_info=True)
+        return jsonify({"error": "Database search error"}), 500
 
 @app.route('/get_customer_for_billing', methods=['GET'])
 @login_required()
+@conditional('customers')
 def get_customer_for_billing():
     phone = request.args.get('phone', '').strip()
     if not phone: return jsonify({"success": False, "message": "Phone number is required."}), 400
     db = get_db()
     try:
         customer_row = db.execute("SELECT id, name, phone_number, email, address FROM customers WHERE phone_number = ?", (phone,)).fetchone()
+        if not customer_row and normalize_phone(phone):
+            # Same number typed with different spacing or a +91/0 prefix.
+            customer_row = db.execute("SELECT id, name, phone_number, email, address FROM customers WHERE phone_normalized = ? ORDER BY id LIMIT 1",
+                                      (normalize_phone(phone),)).fetchone()
         if customer_row: return jsonify({"success": True, "customer": dict(customer_row)})
         else: return jsonify({"success": False, "message": "Customer not found with this phone number."})
     except sqlite3.Error as e:
         app.logger.error(f"Database error fetching customer for billing (phone: {phone}): {e}", exc_info=True)
         return jsonify({"success": False, "message": f"Database error: {e}"}), 500
 
-def generate_upi_qr_code(upi_id, payee_name, amount, bill_id):
-    """Generates a UPI QR code image as a base64 string."""
-    if not upi_id or not payee_name:
-        app.logger.warning("UPI ID or Payee Name is not configured. Cannot generate QR code.")
-        return None, "UPI details not configured by admin."
-    
+UPI_QR_CACHE_SIZE = 256
+UPI_QR_MAX_AGE_SECONDS = 3600
+UPI_QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def build_upi_payment_url(upi_id, payee_name, amount, bill_id):
     formatted_amount = f"{float(amount):.2f}"
 
     params = {
@@ -454,18 +2097,254 @@ def generate_upi_qr_code(upi_id, payee_name, amount, bill_id):
         'tn': urllib.parse.quote(f"Bill ID: {bill_id} - {payee_name}"), 
         'tr': urllib.parse.quote(f"PHARMABILL{bill_id}") 
     }
-    upi_url = f"upi://pay?{urllib.parse.urlencode(params)}"
-    app.logger.info(f"Generated UPI URL: {upi_url}")
+    return f"upi://pay?{urllib.parse.urlencode(params)}"
 
+@lru_cache(maxsize=UPI_QR_CACHE_SIZE)
+def render_upi_qr_code(upi_id, payee_name, amount, bill_id, image_format='png'):
+    """Renders the UPI payment QR for a bill as PNG or SVG bytes. Cached by its
+    inputs, so re-fetching the same bill's QR never re-encodes the image."""
+    import qrcode, qrcode.image.svg
+    started = time.perf_counter()
+    upi_url = build_upi_payment_url(upi_id, payee_name, amount, bill_id)
     qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
     qr.add_data(upi_url)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
     buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return img_str, upi_url
+    if image_format == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffered)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffered, format="PNG")
+    QR_RENDER_DURATION.observe(time.perf_counter() - started, image_format)
+    return buffered.getvalue()
 
+@app.route('/bill/<int:bill_id>/upi_qr', methods=['GET'])
+@login_required()
+def bill_upi_qr(bill_id):
+    image_format = request.args.get('format', 'png').lower()
+    if image_format not in UPI_QR_MIMETYPES:
+        return jsonify({"success": False, "message": "Unsupported QR format. Use png or svg."}), 400
+    upi_id, payee_name = get_app_setting('upi_id'), get_app_setting('payee_name')
+    if not upi_id or not payee_name:
+        app.logger.warning("UPI ID or Payee Name is not configured. Cannot generate QR code.")
+        return jsonify({"success": False, "message": "UPI details not configured by admin."}), 404
+    db = get_db()
+    bill = db.execute("SELECT total_amount FROM bills WHERE id = ?", (bill_id,)).fetchone()
+    if not bill:
+        return jsonify({"success": False, "message": f"Bill with ID {bill_id} not found."}), 404
+    amount = f"{float(bill['total_amount']):.2f}"
+    response = app.response_class(render_upi_qr_code(upi_id, payee_name, amount, bill_id, image_format),
+                                  mimetype=UPI_QR_MIMETYPES[image_format])
+    etag_source = f"{upi_id}|{payee_name}|{amount}|{bill_id}|{image_format}"
+    response.set_etag(hashlib.sha1(etag_source.encode('utf-8')).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = UPI_QR_MAX_AGE_SECONDS
+    return response.make_conditional(request)
+
+class BillError(Exception):
+    """A cart that cannot be billed; carries the client-facing message and HTTP status."""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def write_bill(db, cart_items, total_amount_from_request, customer_id=None, customer_phone_temp=None,
+               customer_name_temp=None, billed_from_shop_id=None):
+    """Validates a cart against current stock and writes the bill, its items and the
+    stock decrements with one batched lookup, executemany() and set-based writes.
+    Must run inside a write transaction (BEGIN IMMEDIATE); on BillError the caller
+    rolls back. Returns (bill_id, final_total_amount)."""
+    for item_data in cart_items:
+        medicine_id = item_data.get('medicine_id') if isinstance(item_data, dict) else None
+        quantity_billed = item_data.get('quantity_billed') if isinstance(item_data, dict) else None
+        price_at_billing_client = item_data.get('price_per_unit_at_billing') if isinstance(item_data, dict) else None
+        if not all([isinstance(medicine_id, int), isinstance(quantity_billed, int), quantity_billed > 0, 
+                    isinstance(price_at_billing_client, (int, float)), price_at_billing_client >= 0]):
+            raise BillError("Invalid item data in cart (ID, quantity, or price).")
+
+    # Several cart lines may draw on the same batch; stock is checked against their sum.
+    quantity_by_medicine = {}
+    for item_data in cart_items:
+        quantity_by_medicine[item_data['medicine_id']] = quantity_by_medicine.get(item_data['medicine_id'], 0) + item_data['quantity_billed']
+    medicine_ids = list(quantity_by_medicine)
+    medicines = {row['id']: row for row in db.execute(f"""
+        SELECT id, medicineName, quantity, expiryDate, sellingPrice FROM medicines WHERE id IN ({','.join('?' * len(medicine_ids))})
+    """, medicine_ids)}
+
+    today_date_str, _ = expiry_boundaries()
+    for medicine_id, quantity_requested in quantity_by_medicine.items():
+        medicine = medicines.get(medicine_id)
+        if not medicine: raise BillError(f"Medicine with ID {medicine_id} not found.")
+        if medicine['quantity'] < quantity_requested: raise BillError(f"Insufficient stock for {medicine['medicineName']}. Available: {medicine['quantity']}, Requested: {quantity_requested}.")
+        if medicine['expiryDate'] < today_date_str: raise BillError(f"Cannot bill expired medicine: {medicine['medicineName']} (Expired on: {medicine['expiryDate']}).")
+        if medicine['sellingPrice'] is None: raise BillError(f"Selling price not set for {medicine['medicineName']}.")
+
+    calculated_total = 0 
+    bill_item_rows = []
+    for item_data in cart_items:
+        medicine = medicines[item_data['medicine_id']]
+        price_at_billing_server = medicine['sellingPrice']
+        calculated_total += item_data['quantity_billed'] * price_at_billing_server
+        bill_item_rows.append((item_data['medicine_id'], medicine['medicineName'], item_data['quantity_billed'],
+                               price_at_billing_server, item_data['quantity_billed'] * price_at_billing_server))
+
+    if abs(calculated_total - total_amount_from_request) > 0.01: 
+        app.logger.warning(f"Bill total mismatch. Client: {total_amount_from_request}, Server: {calculated_total}. Using server total.")
+    final_total_amount = calculated_total 
+
+    bill_cur = db.cursor()
+    bill_cur.execute("""
+        INSERT INTO bills (customer_id, customer_phone_temp, customer_name_temp, total_amount, billed_from_shop_id, bill_date)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (customer_id, customer_phone_temp, customer_name_temp, final_total_amount, billed_from_shop_id, datetime.datetime.now()))
+    bill_id = bill_cur.lastrowid
+
+    db.executemany("""
+        INSERT INTO bill_items (bill_id, medicine_id, medicine_name_snapshot, quantity_billed, price_per_unit_at_billing, total_price_for_item)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(bill_id, *row) for row in bill_item_rows])
+    # The decrement only applies where the quantity is still the one checked above, so
+    # a batch can never go negative even if this ever runs outside an IMMEDIATE transaction.
+    stock_updates = [(medicine_id, medicines[medicine_id]['quantity'], medicines[medicine_id]['quantity'] - qty)
+                     for medicine_id, qty in quantity_by_medicine.items()]
+    if update_stock_quantities(db, stock_updates) != len(stock_updates):
+        raise BillError("Stock changed while the bill was being generated. Please retry.", 409)
+    return bill_id, final_total_amount
+
+# --- Bill Writer (group commit) ---
+# With BILL_WRITER_ENABLED, request threads queue their bill to one writer thread
+# per process. It writes each queued batch in one transaction, one SAVEPOINT per
+# bill, and resolves the callers after the COMMIT.
+class BillWriter:
+    def __init__(self, path, max_batch, max_wait_seconds):
+        self.path, self.max_batch, self.max_wait_seconds = path, max_batch, max_wait_seconds
+        self._queue = queue.Queue()
+        self._closed = None # Set to the exception to fail new bills with once the thread exits
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='bill-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, *bill_args):
+        """Queues write_bill(db, *bill_args); returns a Future of (bill_id, total)."""
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed is not None:
+                future.set_exception(self._closed)
+            else:
+                self._queue.put((future, bill_args))
+        return future
+
+    def is_alive(self):
+        return self._thread.is_alive() and self._closed is None
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while batch[-1] is not None and len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        db, batch, error = None, [], BillError("The billing queue was restarted. Please retry.", 503)
+        try:
+            db = connect_db(self.path)
+            while True:
+                batch = self._next_batch()
+                stopping = batch[-1] is None
+                # Callers that gave up waiting cancel their future; skip those bills.
+                batch = [entry for entry in batch if entry is not None and entry[0].set_running_or_notify_cancel()]
+                if batch:
+                    self._write_batch(db, batch)
+                if stopping:
+                    return
+                batch = []
+        except Exception as e:
+            app.logger.error(f"Bill writer stopped: {e}", exc_info=True)
+            error = e
+        finally:
+            self._fail_pending(batch, error)
+            if db is not None:
+                db.close()
+
+    def _fail_pending(self, batch, error):
+        with self._lock:
+            self._closed = error
+        for future, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not None and entry[0].set_running_or_notify_cancel():
+                entry[0].set_exception(error)
+
+    def _write_batch(self, db, batch):
+        outcomes = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for future, bill_args in batch:
+                db.execute("SAVEPOINT bill")
+                try:
+                    outcomes.append((future, write_bill(db, *bill_args), None))
+                    db.execute("RELEASE bill")
+                except Exception as e:
+                    db.execute("ROLLBACK TO bill")
+                    db.execute("RELEASE bill")
+                    outcomes.append((future, None, e))
+            db.commit()
+        except Exception as e:
+            # The transaction itself failed, so none of this batch was written.
+            if db.in_transaction:
+                db.rollback()
+            app.logger.error(f"Bill writer failed to commit a batch of {len(batch)} bills: {e}", exc_info=True)
+            for future, _ in batch:
+                future.set_exception(e)
+            return
+        BILL_WRITER_BATCH_SIZE.observe(len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+_bill_writer = None
+_bill_writer_pid = None
+_bill_writer_lock = threading.Lock()
+
+def get_bill_writer():
+    """This process's writer thread, started on first use (and again after a fork,
+    a change of DATABASE, or the thread dying)."""
+    global _bill_writer, _bill_writer_pid
+    with _bill_writer_lock:
+        if (_bill_writer is None or _bill_writer_pid != os.getpid() or _bill_writer.path != app.config['DATABASE']
+                or not _bill_writer.is_alive()):
+            if _bill_writer is not None and _bill_writer_pid == os.getpid():
+                _bill_writer.stop()
+            _bill_writer = BillWriter(app.config['DATABASE'], app.config['BILL_WRITER_MAX_BATCH'],
+                                      app.config['BILL_WRITER_MAX_WAIT_MS'] / 1000)
+            _bill_writer_pid = os.getpid()
+        return _bill_writer
+
+def submit_bill(*bill_args):
+    """Writes a bill through the writer thread. Same contract as write_bill inside a
+    committed transaction: returns (bill_id, total) or raises BillError/sqlite3.Error."""
+    import concurrent.futures
+    future = get_bill_writer().submit(*bill_args)
+    try:
+        return future.result(timeout=app.config['BILL_WRITER_TIMEOUT_SECONDS'])
+    except concurrent.futures.TimeoutError:
+        if future.cancel():
+            raise BillError("The billing queue is busy. Please retry.", 503)
+        return future.result() # Already being written; wait for its outcome rather than guess
 
 @app.route('/generate_bill', methods=['POST'])
 @login_required()
@@ -497,70 +2376,38 @@ def generate_bill_route():
     billed_from_shop_id = billed_from_shop_id_raw.strip() if isinstance(billed_from_shop_id_raw, str) else None
 
     db = get_db()
-    calculated_total = 0 
     try:
-        db.execute("BEGIN TRANSACTION")
-        today_date_str = datetime.date.today().strftime('%Y-%m-%d')
-        for item_data in cart_items:
-            medicine_id = item_data.get('medicine_id')
-            quantity_billed = item_data.get('quantity_billed')
-            price_at_billing_client = item_data.get('price_per_unit_at_billing') 
-            if not all([isinstance(medicine_id, int), isinstance(quantity_billed, int), quantity_billed > 0, 
-                        isinstance(price_at_billing_client, (int, float)), price_at_billing_client >= 0]):
-                db.rollback(); return jsonify({"success": False, "message": "Invalid item data in cart (ID, quantity, or price)."}), 400
-            medicine = db.execute("SELECT medicineName, quantity, expiryDate, sellingPrice FROM medicines WHERE id = ?", (medicine_id,)).fetchone()
-            if not medicine: db.rollback(); return jsonify({"success": False, "message": f"Medicine with ID {medicine_id} not found."}), 400
-            if medicine['quantity'] < quantity_billed: db.rollback(); return jsonify({"success": False, "message": f"Insufficient stock for {medicine['medicineName']}. Available: {medicine['quantity']}, Requested: {quantity_billed}."}), 400
-            if medicine['expiryDate'] < today_date_str: db.rollback(); return jsonify({"success": False, "message": f"Cannot bill expired medicine: {medicine['medicineName']} (Expired on: {medicine['expiryDate']})."}), 400
-            if medicine['sellingPrice'] is None: db.rollback(); return jsonify({"success": False, "message": f"Selling price not set for {medicine['medicineName']}."}), 400
-            price_at_billing_server = medicine['sellingPrice']
-            calculated_total += quantity_billed * price_at_billing_server
-            item_data['price_per_unit_at_billing'] = price_at_billing_server 
-            item_data['medicine_name_snapshot'] = medicine['medicineName'] 
-        
-        if abs(calculated_total - total_amount_from_request) > 0.01: 
-            app.logger.warning(f"Bill total mismatch. Client: {total_amount_from_request}, Server: {calculated_total}. Using server total.")
-        final_total_amount = calculated_total 
-        
-        bill_cur = db.cursor()
-        bill_cur.execute("""
-            INSERT INTO bills (customer_id, customer_phone_temp, customer_name_temp, total_amount, billed_from_shop_id, bill_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (customer_id, customer_phone_temp, customer_name_temp, final_total_amount, billed_from_shop_id, datetime.datetime.now()))
-        bill_id = bill_cur.lastrowid
-        
-        for item_data in cart_items:
-            db.execute("""
-                INSERT INTO bill_items (bill_id, medicine_id, medicine_name_snapshot, quantity_billed, price_per_unit_at_billing, total_price_for_item)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (bill_id, item_data['medicine_id'], item_data['medicine_name_snapshot'], item_data['quantity_billed'], item_data['price_per_unit_at_billing'], item_data['quantity_billed'] * item_data['price_per_unit_at_billing']))
-            # Update stock for the current medicine item
-            db.execute("UPDATE medicines SET quantity = quantity - ? WHERE id = ?", (item_data['quantity_billed'], item_data['medicine_id']))
-        
-        upi_id_setting = get_app_setting('upi_id')
+        bill_args = (cart_items, total_amount_from_request, customer_id, customer_phone_temp, customer_name_temp, billed_from_shop_id)
+        if app.config['BILL_WRITER_ENABLED']:
+            bill_id, final_total_amount = submit_bill(*bill_args)
+        else:
+            db.execute("BEGIN IMMEDIATE") # Take the write lock up front; a deferred read-then-write cannot wait out a concurrent writer in WAL mode
+            bill_id, final_total_amount = write_bill(db, *bill_args)
+            db.commit() 
+        app.logger.info(f"Bill (ID: {bill_id}) generated by user {session.get('user_id')} for amount {final_total_amount:.2f}.")
+
+        # The QR is rendered by /bill/<id>/upi_qr after the write lock is released.
         payee_name_setting = get_app_setting('payee_name')
-        qr_code_base64, upi_payment_url = None, None
+        qr_code_url = None
         upi_url_message = "Scan QR to pay. Ensure amount is correct."
-
-        if upi_id_setting and payee_name_setting:
-            qr_code_base64, upi_payment_url = generate_upi_qr_code(upi_id_setting, payee_name_setting, final_total_amount, bill_id)
-            if not qr_code_base64:
-                upi_url_message = "Could not generate QR code. UPI details might be missing or invalid."
+        if get_app_setting('upi_id') and payee_name_setting:
+            qr_code_url = url_for('bill_upi_qr', bill_id=bill_id)
         else:
             upi_url_message = "UPI payment is not configured by admin."
             app.logger.warning(f"UPI QR code not generated for Bill ID {bill_id} as UPI settings are incomplete.")
 
-        db.commit() 
-        app.logger.info(f"Bill (ID: {bill_id}) generated by user {session.get('user_id')} for amount {final_total_amount:.2f}.")
         return jsonify({
             "success": True, 
             "message": "Bill generated successfully!", 
             "bill_id": bill_id, 
             "total_amount": final_total_amount,
-            "qr_code_image": qr_code_base64, 
+            "qr_code_url": qr_code_url, 
             "payee_name": payee_name_setting,
             "upi_url_message": upi_url_message
         })
+    except BillError as e:
+        db.rollback()
+        return jsonify({"success": False, "message": e.message}), e.status_code
     except sqlite3.Error as e:
         db.rollback(); app.logger.error(f"Database error during bill generation: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"Database error: {e}"}), 500
@@ -568,19 +2415,1371 @@ def generate_bill_route():
         db.rollback(); app.logger.error(f"Unexpected error during bill generation: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"An unexpected error occurred: {e}"}), 500
 
+# --- Bill History ---
+BILL_HISTORY_PAGE_SIZE = 50
+BILL_HISTORY_MAX_PAGE_SIZE = 500
+
+def _read_bill_receipt(db, bill_id, schema='main'):
+    bill = db.execute(f"""
+        SELECT b.id, b.bill_date, b.total_amount, b.billed_from_shop_id, b.customer_id,
+               COALESCE(c.name, b.customer_name_temp) AS customer_name,
+               COALESCE(c.phone_number, b.customer_phone_temp) AS customer_phone
+        FROM {schema}.bills b LEFT JOIN main.customers c ON c.id = b.customer_id
+        WHERE b.id = ?
+    """, (bill_id,)).fetchone()
+    if not bill:
+        return None
+    items = db.execute(f"""
+        SELECT medicine_id, medicine_name_snapshot, quantity_billed, price_per_unit_at_billing, total_price_for_item
+        FROM {schema}.bill_items WHERE bill_id = ? ORDER BY id
+    """, (bill_id,)).fetchall()
+    return {**dict(bill), "items": [dict(item) for item in items]}
+
+def get_bill_receipt(db, bill_id):
+    """Returns the bill with its customer and line items as a dict, or None if it does not exist.
+    Bills that have been archived are read from their month's archive file."""
+    receipt = _read_bill_receipt(db, bill_id)
+    if receipt:
+        return receipt
+    for (month,) in db.execute("SELECT month FROM bill_archives WHERE ? BETWEEN min_bill_id AND max_bill_id ORDER BY month DESC",
+                               (bill_id,)).fetchall():
+        with attached_archive(db, month) as schema:
+            receipt = schema and _read_bill_receipt(db, bill_id, schema)
+        if receipt:
+            return receipt
+    return None
+
+@app.route('/bill/<int:bill_id>', methods=['GET'])
+@login_required()
+@conditional('bills', 'customers')
+def bill_receipt(bill_id):
+    try:
+        receipt = get_bill_receipt(get_db(), bill_id)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error fetching bill {bill_id}: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    if not receipt:
+        return jsonify({"success": False, "message": f"Bill with ID {bill_id} not found."}), 404
+    return jsonify({"success": True, "bill": receipt})
+
+@app.route('/bills', methods=['GET'])
+@login_required()
+@conditional('bills', 'customers')
+def bill_history():
+    """One keyset page of bills, newest first, ordered by (bill_date, id).
+    Optional filters: ?phone= (registered or walk-in customer), ?from=/?to= (YYYY-MM-DD, inclusive).
+    Pass the returned next_cursor back as ?cursor= to get the following page."""
+    try:
+        limit = min(max(int(request.args.get('limit', BILL_HISTORY_PAGE_SIZE)), 1), BILL_HISTORY_MAX_PAGE_SIZE)
+        date_from = request.args.get('from', '').strip()
+        date_to = request.args.get('to', '').strip()
+        date_from = parse_date(date_from).isoformat() if date_from else None
+        date_to = (parse_date(date_to) + datetime.timedelta(days=1)).isoformat() if date_to else None
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Invalid bill history parameters: {e}"}), 400
+    cursor = request.args.get('cursor', '').strip()
+    after = None
+    if cursor:
+        cursor_date, _, cursor_id = cursor.rpartition('|')
+        if not cursor_id.isdigit() or not cursor_date:
+            return jsonify({"success": False, "message": "Invalid cursor."}), 400
+        after = (cursor_date, int(cursor_id))
+
+    clauses, params = [], []
+    phone = request.args.get('phone', '').strip()
+    db = get_db()
+    try:
+        if phone:
+            customer = db.execute("SELECT id FROM customers WHERE phone_number = ?", (phone,)).fetchone()
+            if customer:
+                # Bills made before the customer registered only carry the phone number.
+                clauses.append("(b.customer_id = ? OR b.customer_phone_temp = ?)"); params.extend((customer['id'], phone))
+            else:
+                clauses.append("b.customer_phone_temp = ?"); params.append(phone)
+        if date_from:
+            clauses.append("b.bill_date >= ?"); params.append(date_from)
+        if date_to:
+            clauses.append("b.bill_date < ?"); params.append(date_to)
+        if after:
+            clauses.append("(b.bill_date, b.id) < (?, ?)"); params.extend(after)
+        where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = _query_bill_page(db, 'main', where_sql, params, limit + 1)
+        # Archived months that overlap the requested range, newest first, until
+        # the page can no longer change.
+        months = archived_months_between(db, date_from, (after[0] if after and (not date_to or after[0] < date_to) else date_to))
+        for month, month_end in months:
+            if len(rows) > limit and rows[limit]['bill_date'] >= month_end:
+                break
+            with attached_archive(db, month) as schema:
+                if schema:
+                    rows = sorted(rows + _query_bill_page(db, schema, where_sql, params, limit + 1),
+                                  key=lambda row: (row['bill_date'], row['id']), reverse=True)[:limit + 1]
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error listing bills: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "success": True,
+        "bills": [dict(row) for row in rows],
+        "next_cursor": f"{rows[-1]['bill_date']}|{rows[-1]['id']}" if has_more else None,
+    })
+
+def _query_bill_page(db, schema, where_sql, params, limit):
+    """One page of bill history from `schema` (main or an attached archive), newest first."""
+    if schema != 'main': # Left behind by an interrupted archive run; main's copy is the one listed
+        where_sql = f"{where_sql} AND b.id NOT IN (SELECT id FROM main.bills)" if where_sql else "WHERE b.id NOT IN (SELECT id FROM main.bills)"
+    return [dict(row) for row in db.execute(f"""
+        SELECT b.id, b.bill_date, b.total_amount, b.billed_from_shop_id, b.customer_id,
+               COALESCE(c.name, b.customer_name_temp) AS customer_name,
+               COALESCE(c.phone_number, b.customer_phone_temp) AS customer_phone,
+               (SELECT COUNT(*) FROM {schema}.bill_items bi WHERE bi.bill_id = b.id) AS item_count
+        FROM {schema}.bills b LEFT JOIN main.customers c ON c.id = b.customer_id
+        {where_sql}
+        ORDER BY b.bill_date DESC, b.id DESC LIMIT ?
+    """, (*params, limit))]
+
+# --- Bill Archive ---
+# Bills older than ARCHIVE_AFTER_DAYS move into one file per month
+# (bills-YYYY-MM.db in archive_dir()), ATTACHed read-only when a query reaches
+# into that month. Rollups keep the full history; archiving is local to a node.
+# A month is copied and committed first, then the matching live rows deleted, so
+# an interrupted run leaves bills in both places (readers prefer the live copy).
+ARCHIVED_TABLES = ('bills', 'bill_items')
+
+def archive_dir():
+    return app.config['ARCHIVE_DIR'] or os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])), 'archive')
+
+def archive_path(month):
+    return os.path.join(archive_dir(), f"bills-{month}.db")
+
+def _month_bounds(month):
+    """'2024-03' -> ('2024-03-01', '2024-04-01')."""
+    year, month_number = map(int, month.split('-'))
+    next_year, next_month = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+    return f"{year:04d}-{month_number:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+@contextmanager
+def attached_archive(db, month, readonly=True):
+    """ATTACHes the archive file of `month` for the duration of the block and yields
+    its schema name, or None if the file is missing. Call it outside a transaction:
+    DETACH cannot run inside one, so a transaction the block leaves open is rolled back."""
+    if db.in_transaction:
+        raise RuntimeError("attached_archive() needs the caller's transaction to be committed first.")
+    path = archive_path(month)
+    if readonly and not os.path.exists(path):
+        app.logger.warning(f"Archive file for {month} is missing: {path}")
+        yield None
+        return
+    schema = f"archive_{month.replace('-', '_')}"
+    db.execute(f"ATTACH DATABASE ? AS {schema}", (f"file:{urllib.parse.quote(path)}?mode={'ro' if readonly else 'rwc'}",))
+    try:
+        yield schema
+    finally:
+        if db.in_transaction:
+            db.rollback()
+        db.execute(f"DETACH DATABASE {schema}")
+
+def archived_months_between(db, date_from=None, date_to=None):
+    """[(month, first day of the next month)] of archived months overlapping
+    [date_from, date_to), newest first."""
+    months = []
+    for (month,) in db.execute("SELECT month FROM bill_archives ORDER BY month DESC"):
+        month_start, month_end = _month_bounds(month)
+        if (date_to and month_start >= date_to) or (date_from and month_end <= date_from):
+            continue
+        months.append((month, month_end))
+    return months
+
+def _create_archive_tables(db, schema):
+    """Same columns as the live tables, without foreign keys (customers and
+    medicines stay in the live database), plus the bill history indexes."""
+    for table in ARCHIVED_TABLES:
+        columns = [f"{row['name']} {row['type']}{' PRIMARY KEY' if row['pk'] else ''}" for row in db.execute(f"PRAGMA main.table_info({table})")]
+        db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} ({', '.join(columns)})")
+    for statement in _split_sql_script(BILL_HISTORY_INDEX_SQL):
+        db.execute(statement.replace("IF NOT EXISTS ", f"IF NOT EXISTS {schema}.", 1))
+
+def _shared_columns(db, schema, table):
+    archived = {row['name'] for row in db.execute(f"PRAGMA {schema}.table_info({table})")}
+    return [row['name'] for row in db.execute(f"PRAGMA main.table_info({table})") if row['name'] in archived]
+
+def archive_month(db, month, cutoff):
+    """Moves the bills of `month` dated before `cutoff` (and their items) into the
+    month's archive file. Returns the number of bills and items moved."""
+    month_start, month_end = _month_bounds(month)
+    range_params = (month_start, min(month_end, cutoff))
+    def in_range(alias):
+        return f"{alias}.bill_date >= ? AND {alias}.bill_date < ?"
+    os.makedirs(archive_dir(), exist_ok=True)
+    with attached_archive(db, month, readonly=False) as schema:
+        _create_archive_tables(db, schema)
+        bill_columns, item_columns = _shared_columns(db, schema, 'bills'), _shared_columns(db, schema, 'bill_items')
+        def same_row(columns, left, right):
+            return f"({', '.join(f'{left}.{c}' for c in columns)}) IS ({', '.join(f'{right}.{c}' for c in columns)})"
+
+        # Step 1: copy, committed in the archive file (only it is written).
+        db.execute("BEGIN")
+        db.execute(f"""
+            INSERT OR REPLACE INTO {schema}.bills ({', '.join(bill_columns)})
+            SELECT {', '.join(bill_columns)} FROM main.bills b WHERE {in_range('b')}
+        """, range_params)
+        db.execute(f"""
+            INSERT OR REPLACE INTO {schema}.bill_items ({', '.join(item_columns)})
+            SELECT {', '.join('bi.' + c for c in item_columns)}
+            FROM main.bill_items bi JOIN main.bills b ON b.id = bi.bill_id WHERE {in_range('b')}
+        """, range_params)
+        db.commit()
+
+        # Step 2: delete the bills whose archived copy, items included, matches.
+        # Bills written since step 1 stay for the next run.
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS archive_moved (id INTEGER PRIMARY KEY)")
+        db.execute("DELETE FROM temp.archive_moved")
+        db.execute(f"""
+            INSERT INTO temp.archive_moved (id)
+            SELECT b.id FROM main.bills b JOIN {schema}.bills a ON a.id = b.id
+            WHERE {in_range('b')} AND {same_row(bill_columns, 'a', 'b')}
+              AND (SELECT COUNT(*) FROM {schema}.bill_items ai WHERE ai.bill_id = b.id)
+                  = (SELECT COUNT(*) FROM main.bill_items bi WHERE bi.bill_id = b.id)
+              AND NOT EXISTS (SELECT 1 FROM main.bill_items bi LEFT JOIN {schema}.bill_items ai ON ai.id = bi.id
+                              WHERE bi.bill_id = b.id AND (ai.id IS NULL OR NOT {same_row(item_columns, 'ai', 'bi')}))
+        """, range_params)
+        items_moved = db.execute("DELETE FROM main.bill_items WHERE bill_id IN (SELECT id FROM temp.archive_moved)").rowcount
+        bills_moved = db.execute("DELETE FROM main.bills WHERE id IN (SELECT id FROM temp.archive_moved)").rowcount
+        db.execute(f"""
+            INSERT INTO bill_archives (month, bill_count, item_count, total_amount, min_bill_id, max_bill_id, archived_at)
+            SELECT ?, COUNT(*), (SELECT COUNT(*) FROM {schema}.bill_items), TOTAL(total_amount), MIN(id), MAX(id), CURRENT_TIMESTAMP
+            FROM {schema}.bills WHERE true
+            ON CONFLICT (month) DO UPDATE SET
+                bill_count = excluded.bill_count, item_count = excluded.item_count, total_amount = excluded.total_amount,
+                min_bill_id = excluded.min_bill_id, max_bill_id = excluded.max_bill_id, archived_at = excluded.archived_at
+        """, (month,))
+        db.commit()
+    return bills_moved, items_moved
+
+def bill_totals(db):
+    """(bills, items, total amount) over the live database and the archive files;
+    a bill in both (after an interrupted run) counts once."""
+    bills, items, total = db.execute("SELECT COUNT(*), (SELECT COUNT(*) FROM bill_items), TOTAL(total_amount) FROM bills").fetchone()
+    for month, _ in archived_months_between(db):
+        with attached_archive(db, month) as schema:
+            if not schema:
+                continue
+            archived = db.execute(f"""
+                SELECT COUNT(*), (SELECT COUNT(*) FROM {schema}.bill_items WHERE bill_id NOT IN (SELECT id FROM main.bills)),
+                       TOTAL(total_amount)
+                FROM {schema}.bills WHERE id NOT IN (SELECT id FROM main.bills)
+            """).fetchone()
+        bills, items, total = bills + archived[0], items + archived[1], total + archived[2]
+    return bills, items, round(total, 2)
+
+def reclaim_free_pages(db):
+    """Returns the pages freed by archiving to the filesystem. The first run switches
+    the database to incremental auto-vacuum, which takes one full VACUUM; later
+    runs only release the free pages."""
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        app.logger.info("Switching the database to incremental auto-vacuum (one-time full VACUUM).")
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+    else:
+        db.executescript("PRAGMA incremental_vacuum") # Stepped to completion; execute() frees a single page
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall() # Truncate the WAL the freed pages went through
+
+def archive_old_bills(db, cutoff=None, vacuum=True):
+    """Archives every month with bills dated before `cutoff` (YYYY-MM-DD; default
+    ARCHIVE_AFTER_DAYS ago). Returns [(month, bills moved, items moved)]."""
+    cutoff = cutoff or (datetime.date.today() - datetime.timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])).isoformat()
+    months = [row[0] for row in db.execute("SELECT DISTINCT substr(bill_date, 1, 7) FROM bills WHERE bill_date < ? ORDER BY 1",
+                                           (cutoff,)).fetchall()]
+    moved = []
+    for month in months:
+        bills_moved, items_moved = archive_month(db, month, cutoff)
+        app.logger.info(f"Archived {bills_moved} bills ({items_moved} items) of {month} to {archive_path(month)}.")
+        moved.append((month, bills_moved, items_moved))
+    if moved and vacuum:
+        reclaim_free_pages(db)
+    return moved
+
+def stage_archived_sales(db):
+    """Sums the archived bills per day into temp tables for
+    rebuild_sales_rollups(with_archives=True). Returns the months read."""
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS archived_sales_shop (sale_date, shop_id, bill_count, items_sold, revenue)")
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS archived_sales_medicine (sale_date, medicine_id, medicine_name, quantity, revenue)")
+    db.execute("DELETE FROM temp.archived_sales_shop")
+    db.execute("DELETE FROM temp.archived_sales_medicine")
+    db.commit()
+    months = [month for month, _ in archived_months_between(db)]
+    for month in months:
+        with attached_archive(db, month) as schema:
+            if not schema:
+                continue
+            not_live = "b.id NOT IN (SELECT id FROM main.bills)"
+            db.execute(f"""
+                INSERT INTO temp.archived_sales_shop
+                SELECT date(b.bill_date), COALESCE(b.billed_from_shop_id, ''), COUNT(*),
+                       TOTAL((SELECT SUM(bi.quantity_billed) FROM {schema}.bill_items bi WHERE bi.bill_id = b.id)), SUM(b.total_amount)
+                FROM {schema}.bills b WHERE {not_live} GROUP BY 1, 2
+            """)
+            db.execute(f"""
+                INSERT INTO temp.archived_sales_medicine
+                SELECT date(b.bill_date), bi.medicine_id, MAX(bi.medicine_name_snapshot), SUM(bi.quantity_billed), SUM(bi.total_price_for_item)
+                FROM {schema}.bill_items bi JOIN {schema}.bills b ON b.id = bi.bill_id WHERE {not_live} GROUP BY 1, 2
+            """)
+            db.commit()
+    return months
+
+@app.cli.command('archive-bills')
+@click.option('--before', help="Archive bills dated before this day (YYYY-MM-DD). Default: ARCHIVE_AFTER_DAYS ago.")
+@click.option('--no-vacuum', is_flag=True, help="Leave the freed pages in the database file.")
+def archive_bills_command(before, no_vacuum):
+    """Moves old bills into per-month archive files next to the database."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        try:
+            cutoff = parse_date(before).isoformat() if before else None
+        except ValueError as e:
+            click.echo(f"Invalid --before date: {e}")
+            return
+        totals_before = bill_totals(db)
+        size_before = os.path.getsize(app.config['DATABASE'])
+        started = time.perf_counter()
+        try:
+            moved = archive_old_bills(db, cutoff, vacuum=not no_vacuum)
+        except sqlite3.Error as e:
+            click.echo(f"Archiving failed: {e}")
+            return
+        totals_after = bill_totals(db)
+        size_after = os.path.getsize(app.config['DATABASE'])
+    for month, bills_moved, items_moved in moved:
+        click.echo(f"{month}: {bills_moved} bills, {items_moved} items")
+    click.echo(f"Archived {sum(m[1] for m in moved)} bills in {time.perf_counter() - started:.1f}s to {archive_dir()}; "
+               f"database {size_before / 2**20:.1f} MiB -> {size_after / 2**20:.1f} MiB.")
+    click.echo(f"Bills, items, total before: {totals_before}; after (live + archived): {totals_after}"
+               + ("" if totals_before == totals_after else "  MISMATCH"))
+
+_archive_thread = None
+
+def start_archive_scheduler():
+    """Runs archive_old_bills() every ARCHIVE_INTERVAL_HOURS in a daemon thread of
+    this process. With several worker processes, prefer cron and `flask archive-bills`."""
+    global _archive_thread
+    if _archive_thread is not None and _archive_thread.is_alive():
+        return
+    interval_seconds = float(app.config['ARCHIVE_INTERVAL_HOURS']) * 3600
+
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                with app.app_context():
+                    archive_old_bills(get_db())
+            except Exception as e:
+                app.logger.error(f"Scheduled bill archiving failed: {e}", exc_info=True)
+
+    _archive_thread = threading.Thread(target=run, name='bill-archiver', daemon=True)
+    _archive_thread.start()
+
+# --- Data Export ---
+# Exports run one SELECT and stream it: rows are pulled in fetchmany() chunks and
+# each chunk is serialized (and optionally gzipped) before the next is read, so
+# memory stays flat however large the table and the first bytes go out at once.
+EXPORT_FETCH_SIZE = 1000
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# dataset -> (SELECT without WHERE/ORDER BY, ORDER BY, supports bill filters)
+EXPORT_DATASETS = {
+    'inventory': ("""
+        SELECT id, barcode, medicineName, batchNo, mrp, sellingPrice, mfgDate, expiryDate, quantity,
+               supplier, shelfNo, boxNo, shop_id, timestamp
+        FROM medicines""", "id", False),
+    'customers': ("""
+        SELECT id, name, phone_number, email, address, registered_at
+        FROM customers""", "id", False),
+    'bills': ("""
+        SELECT b.id, b.bill_date, b.total_amount, b.billed_from_shop_id, b.customer_id,
+               COALESCE(c.name, b.customer_name_temp) AS customer_name,
+               COALESCE(c.phone_number, b.customer_phone_temp) AS customer_phone
+        FROM bills b LEFT JOIN customers c ON c.id = b.customer_id""", "b.bill_date, b.id", True),
+    'bill_items': ("""
+        SELECT bi.id, bi.bill_id, b.bill_date, b.billed_from_shop_id, bi.medicine_id, bi.medicine_name_snapshot,
+               bi.quantity_billed, bi.price_per_unit_at_billing, bi.total_price_for_item
+        FROM bills b JOIN bill_items bi ON bi.bill_id = b.id""", "b.bill_date, b.id, bi.id", True),
+    'stock_adjustments': ("""
+        SELECT a.id, a.reference, a.created_at, a.user_id, a.medicine_id, m.medicineName, m.batchNo, a.kind,
+               a.quantity_before, a.quantity_after, a.quantity_after - a.quantity_before AS delta, a.reason
+        FROM stock_adjustments a LEFT JOIN medicines m ON m.id = a.medicine_id""", "a.id", False),
+}
+
+def export_query(dataset, date_from=None, date_to=None, shop_id=None):
+    """Builds (sql, params) for a dataset. Dates are inclusive YYYY-MM-DD strings;
+    the bill filters are ignored for datasets that have no bills."""
+    select_sql, order_by, has_bill_filters = EXPORT_DATASETS[dataset]
+    clauses, params = [], []
+    if has_bill_filters:
+        if date_from:
+            clauses.append("b.bill_date >= ?"); params.append(parse_date(date_from).isoformat())
+        if date_to:
+            clauses.append("b.bill_date < ?"); params.append((parse_date(date_to) + datetime.timedelta(days=1)).isoformat())
+        if shop_id is not None:
+            clauses.append("COALESCE(b.billed_from_shop_id, '') = ?"); params.append(shop_id)
+    where_sql = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return f"{select_sql}{where_sql} ORDER BY {order_by}", params
+
+def iter_export_chunks(db, sql, params, file_format, fetch_size=EXPORT_FETCH_SIZE):
+    """Yields the serialized export as str chunks, one per fetchmany() batch."""
+    cursor = db.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if file_format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if writer:
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), separators=(',', ':')))
+                buffer.write('\n')
+        chunk = buffer.getvalue()
+        if chunk:
+            yield chunk
+            buffer.seek(0); buffer.truncate()
+        if len(rows) < fetch_size:
+            break
+
+def iter_encoded_export(chunks, use_gzip=False):
+    """Encodes str chunks to UTF-8, gzipping them as a single stream when asked."""
+    compressor = zlib.compressobj(wbits=31) if use_gzip else None
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+@app.route('/export/<dataset>', methods=['GET'])
+@login_required(role='admin')
+def export_dataset(dataset):
+    """Streams a dataset as CSV or JSONL. Bills and bill_items accept ?from=&to= (YYYY-MM-DD)
+    and ?shop_id=; add ?gzip=1 for a compressed download."""
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"success": False, "message": f"Unknown export dataset: {dataset}."}), 404
+    file_format = request.args.get('format', 'csv').lower()
+    if file_format not in EXPORT_FORMATS:
+        return jsonify({"success": False, "message": "Unsupported export format. Use csv or jsonl."}), 400
+    try:
+        sql, params = export_query(dataset, request.args.get('from', '').strip(), request.args.get('to', '').strip(),
+                                   request.args.get('shop_id'))
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Invalid export filter: {e}"}), 400
+    use_gzip = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f"{dataset}-{datetime.date.today().isoformat()}.{file_format}{'.gz' if use_gzip else ''}"
+    app.logger.info(f"Export of {dataset} ({file_format}) started by user {session.get('user_id')}.")
+    body = iter_encoded_export(iter_export_chunks(get_db(), sql, params, file_format), use_gzip)
+    response = app.response_class(stream_with_context(body),
+                                  mimetype='application/gzip' if use_gzip else EXPORT_FORMATS[file_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@app.cli.command('export')
+@click.argument('dataset', type=click.Choice(list(EXPORT_DATASETS)))
+@click.option('--format', 'file_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), help="Defaults to stdout.")
+@click.option('--gzip', 'use_gzip', is_flag=True, help="Gzip the output.")
+@click.option('--from', 'date_from', help="Bills on or after this date (YYYY-MM-DD).")
+@click.option('--to', 'date_to', help="Bills on or before this date (YYYY-MM-DD).")
+@click.option('--shop-id', help="Only bills from this shop/terminal ('' for bills without one).")
+def export_command(dataset, file_format, output, use_gzip, date_from, date_to, shop_id):
+    """Streams a dataset to a CSV or JSONL file."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.", err=True)
+            return
+        try:
+            sql, params = export_query(dataset, date_from, date_to, shop_id)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+        with click.open_file(output or '-', 'wb') as out:
+            for data in iter_encoded_export(iter_export_chunks(db, sql, params, file_format), use_gzip):
+                out.write(data)
+
+# --- Sales Reports ---
+# All reports read the daily rollup tables, so their cost depends on the date
+# range and catalogue size, not on how many bills have been written.
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_TOP_N = 100
+
+def _report_date_range():
+    """Parses ?from=&to= (inclusive, YYYY-MM-DD); defaults to the last REPORT_DEFAULT_DAYS days."""
+    today = datetime.date.today()
+    date_from = request.args.get('from', '').strip()
+    date_to = request.args.get('to', '').strip()
+    date_from = parse_date(date_from) if date_from else today - datetime.timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    date_to = parse_date(date_to) if date_to else today
+    if date_from > date_to:
+        raise ValueError("'from' date cannot be after 'to' date.")
+    return date_from.isoformat(), date_to.isoformat()
+
+@app.route('/reports/revenue_by_day', methods=['GET'])
+@login_required(role='admin')
+@conditional('bills', daily=True)
+def report_revenue_by_day():
+    try:
+        date_from, date_to = _report_date_range()
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Invalid date range: {e}"}), 400
+    shop_id = request.args.get('shop_id')
+    shop_clause, params = ("AND shop_id = ?", [shop_id.strip()]) if shop_id is not None else ("", [])
+    try:
+        rows = get_db().execute(f"""
+            SELECT sale_date, SUM(bill_count) AS bill_count, SUM(items_sold) AS items_sold, ROUND(SUM(revenue), 2) AS revenue
+            FROM sales_daily_shop WHERE sale_date BETWEEN ? AND ? {shop_clause}
+            GROUP BY sale_date ORDER BY sale_date
+        """, (date_from, date_to, *params)).fetchall()
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error building revenue report: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "from": date_from, "to": date_to, "days": [dict(row) for row in rows]})
+
+@app.route('/reports/top_medicines', methods=['GET'])
+@login_required(role='admin')
+@conditional('bills', daily=True)
+def report_top_medicines():
+    try:
+        date_from, date_to = _report_date_range()
+        limit = min(max(int(request.args.get('limit', 10)), 1), REPORT_MAX_TOP_N)
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Invalid report parameters: {e}"}), 400
+    order_by = 'quantity' if request.args.get('by') == 'quantity' else 'revenue'
+    # Products, not batches: every batch with the same name counts together, as in product_stock.
+    try:
+        rows = get_db().execute(f"""
+            SELECT lower(trim(medicine_name)) AS product_key, MAX(medicine_name) AS medicine_name,
+                   SUM(quantity) AS quantity, ROUND(SUM(revenue), 2) AS revenue
+            FROM sales_daily_medicine WHERE sale_date BETWEEN ? AND ?
+            GROUP BY 1 ORDER BY {order_by} DESC LIMIT ?
+        """, (date_from, date_to, limit)).fetchall()
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error building top medicines report: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "from": date_from, "to": date_to, "by": order_by, "medicines": [dict(row) for row in rows]})
+
+@app.route('/reports/terminal_totals', methods=['GET'])
+@login_required(role='admin')
+@conditional('bills', daily=True)
+def report_terminal_totals():
+    try:
+        date_from, date_to = _report_date_range()
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Invalid date range: {e}"}), 400
+    try:
+        rows = get_db().execute("""
+            SELECT shop_id, SUM(bill_count) AS bill_count, SUM(items_sold) AS items_sold, ROUND(SUM(revenue), 2) AS revenue
+            FROM sales_daily_shop WHERE sale_date BETWEEN ? AND ?
+            GROUP BY shop_id ORDER BY revenue DESC
+        """, (date_from, date_to)).fetchall()
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error building terminal totals report: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "from": date_from, "to": date_to, "terminals": [dict(row) for row in rows]})
+
+# --- Stock Levels ---
+# Served from product_stock (see PRODUCT_STOCK_SQL): one row per product, so
+# neither endpoint groups or scans the batches in medicines.
+LOW_STOCK_LIMIT = 100
+LOW_STOCK_MAX_LIMIT = 1000
+PRODUCT_STOCK_COLUMNS = """product_key, medicine_name, barcode, batch_count, total_quantity, usable_quantity,
+    total_quantity - usable_quantity AS expired_quantity, reorder_level"""
+_stock_expiry_rolled_for = None
+
+def roll_stock_expiry(db):
+    """Brings product_stock.usable_quantity up to today by taking out the batches
+    that expired since it was last rolled. Checked at most once per day per process."""
+    global _stock_expiry_rolled_for
+    today, _ = expiry_boundaries()
+    if _stock_expiry_rolled_for == today:
+        return
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        as_of = db.execute("SELECT as_of FROM stock_expiry_state").fetchone()[0]
+        if as_of != today:
+            # Normally as_of < today; if the clock went back, the same batches count again.
+            sign, start, end = (-1, as_of, today) if as_of < today else (1, today, as_of)
+            db.execute("""
+                UPDATE product_stock SET usable_quantity = usable_quantity + ? * expired.quantity
+                FROM (SELECT lower(trim(medicineName)) AS product_key, SUM(quantity) AS quantity
+                      FROM medicines WHERE expiryDate >= ? AND expiryDate < ? GROUP BY 1) AS expired
+                WHERE product_stock.product_key = expired.product_key
+            """, (sign, start, end))
+            db.execute("UPDATE stock_expiry_state SET as_of = ?", (today,))
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    _stock_expiry_rolled_for = today
+
+@app.route('/stock/low', methods=['GET'])
+@login_required()
+@conditional('medicines', 'product_stock', daily=True)
+def low_stock():
+    """Products whose usable (non-expired) stock is at or below their reorder level, emptiest first."""
+    try:
+        limit = min(max(int(request.args.get('limit', LOW_STOCK_LIMIT)), 1), LOW_STOCK_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid 'limit'."}), 400
+    default_level = app.config['REORDER_LEVEL_DEFAULT']
+    db = get_db()
+    try:
+        roll_stock_expiry(db)
+        rows = db.execute(f"""
+            SELECT * FROM (
+                SELECT {PRODUCT_STOCK_COLUMNS} FROM product_stock WHERE reorder_level IS NULL AND usable_quantity <= ?
+                UNION ALL
+                SELECT {PRODUCT_STOCK_COLUMNS} FROM product_stock WHERE reorder_level IS NOT NULL AND usable_quantity - reorder_level <= 0
+            ) ORDER BY usable_quantity, product_key LIMIT ?
+        """, (default_level, limit)).fetchall()
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error listing low stock: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "default_reorder_level": default_level, "products": [dict(row) for row in rows]})
+
+@app.route('/stock/product', methods=['GET'])
+@login_required()
+@conditional('medicines', 'product_stock', daily=True)
+def product_stock():
+    """Stock of one product across its batches, by ?name= or ?barcode=."""
+    name, barcode = request.args.get('name', '').strip(), request.args.get('barcode', '').strip()
+    if not name and not barcode:
+        return jsonify({"success": False, "message": "Provide a product name or barcode."}), 400
+    db = get_db()
+    try:
+        roll_stock_expiry(db)
+        if name:
+            row = db.execute(f"SELECT {PRODUCT_STOCK_COLUMNS} FROM product_stock WHERE product_key = lower(?)", (name,)).fetchone()
+        else:
+            row = db.execute(f"SELECT {PRODUCT_STOCK_COLUMNS} FROM product_stock WHERE barcode = ?", (barcode,)).fetchone()
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error reading product stock: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    if not row:
+        return jsonify({"success": False, "message": "Product not found."}), 404
+    product = dict(row)
+    product['effective_reorder_level'] = product['reorder_level'] if product['reorder_level'] is not None else app.config['REORDER_LEVEL_DEFAULT']
+    return jsonify({"success": True, "product": product})
+
+@app.route('/stock/reorder_level', methods=['POST'])
+@login_required(role='admin')
+def set_reorder_level():
+    """Sets a product's own reorder level: {"name": ..., "reorder_level": <int, or null for the default>}."""
+    data = request.get_json(silent=True) or {}
+    name, level = str(data.get('name') or '').strip(), data.get('reorder_level')
+    if not name:
+        return jsonify({"success": False, "message": "Product name is required."}), 400
+    if level is not None and (not isinstance(level, int) or isinstance(level, bool) or level < 0):
+        return jsonify({"success": False, "message": "Reorder level must be a non-negative integer or null."}), 400
+    db = get_db()
+    try:
+        cur = db.execute("UPDATE product_stock SET reorder_level = ? WHERE product_key = lower(?)", (level, name))
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        app.logger.error(f"Database error setting reorder level for '{name}': {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    if cur.rowcount == 0:
+        return jsonify({"success": False, "message": "Product not found."}), 404
+    return jsonify({"success": True, "message": "Reorder level updated."})
+
+# --- Stock Adjustments ---
+# Stock takes and restocks in bulk. Each line names a batch (id, or barcode +
+# batchNo) with a counted quantity or a delta; one request is one transaction and
+# every line goes to the stock_adjustments ledger. The sync log records deltas.
+ADJUSTMENT_MAX_LINES = 100000
+ADJUSTMENT_LOOKUP_CHUNK = 500
+# From this many changed batches (adjustments or bill lines) the quantity triggers
+# run once, set-based; below it the per-row triggers are cheaper.
+STOCK_UPDATE_SET_BASED_MIN_ROWS = 100
+
+def update_stock_quantities(db, updates):
+    """Sets medicines.quantity for [(medicine_id, quantity_before, quantity_after)]
+    inside the caller's transaction, only where the quantity is still quantity_before.
+    Returns how many batches were updated; on a shortfall the caller rolls back."""
+    if len(updates) < STOCK_UPDATE_SET_BASED_MIN_ROWS:
+        return db.executemany("UPDATE medicines SET quantity = ? WHERE id = ? AND quantity = ?",
+                              [(after, medicine_id, before) for medicine_id, before, after in updates]).rowcount
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS stock_updates (id INTEGER PRIMARY KEY, quantity_before INTEGER, quantity_after INTEGER)")
+    db.execute("DELETE FROM temp.stock_updates")
+    db.executemany("INSERT INTO temp.stock_updates (id, quantity_before, quantity_after) VALUES (?, ?, ?)", updates)
+    db.execute("INSERT INTO bulk_write_mode (active) VALUES (1)")
+    updated = db.execute("""
+        UPDATE medicines SET quantity = u.quantity_after FROM temp.stock_updates u
+        WHERE medicines.id = u.id AND medicines.quantity = u.quantity_before
+    """).rowcount
+    db.execute("DELETE FROM bulk_write_mode")
+    for statement in BULK_STOCK_UPDATE_STATEMENTS.values():
+        db.execute(statement)
+    db.execute("DELETE FROM temp.stock_updates")
+    return updated
+
+def parse_adjustment_line(record):
+    """Validates one adjustment line (JSON object, CSV or JSONL row). Returns
+    ((key, kind, amount, reason), None) or (None, error message); key is
+    ('id', id) or ('batch', barcode, batchNo)."""
+    medicine_id, barcode, batch_no = _text_field(record, 'id') or _text_field(record, 'medicine_id'), \
+        _text_field(record, 'barcode'), _text_field(record, 'batchNo')
+    if medicine_id:
+        if not medicine_id.isdigit():
+            return None, f"Invalid medicine id: {medicine_id}."
+        key = ('id', int(medicine_id))
+    elif barcode and batch_no:
+        key = ('batch', barcode, batch_no)
+    else:
+        return None, "Each line needs an id, or a barcode and batchNo."
+    delta, count = _text_field(record, 'delta'), _text_field(record, 'count')
+    if bool(delta) == bool(count):
+        return None, "Give either a delta or a count, not both."
+    try:
+        amount = int(delta or count)
+    except ValueError:
+        return None, "Delta and count must be whole numbers."
+    if count and amount < 0:
+        return None, "Count cannot be negative."
+    return (key, 'count' if count else 'delta', amount, _text_field(record, 'reason') or None), None
+
+def _resolve_adjustment_batches(db, keys):
+    """Maps each line key to its medicines row (id, medicineName, batchNo, quantity),
+    or to an error message when the batch is unknown or ambiguous."""
+    resolved = {}
+    ids = sorted({key[1] for key in keys if key[0] == 'id'})
+    for start in range(0, len(ids), ADJUSTMENT_LOOKUP_CHUNK):
+        chunk = ids[start:start + ADJUSTMENT_LOOKUP_CHUNK]
+        for row in db.execute(f"SELECT id, medicineName, batchNo, quantity FROM medicines WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+            resolved[('id', row['id'])] = row
+    barcodes = sorted({key[1] for key in keys if key[0] == 'batch'})
+    for start in range(0, len(barcodes), ADJUSTMENT_LOOKUP_CHUNK):
+        chunk = barcodes[start:start + ADJUSTMENT_LOOKUP_CHUNK]
+        for row in db.execute(f"SELECT id, barcode, medicineName, batchNo, quantity FROM medicines WHERE barcode IN ({','.join('?' * len(chunk))})", chunk):
+            key = ('batch', row['barcode'], row['batchNo'])
+            resolved[key] = "Barcode and batchNo match more than one batch; use the id." if key in resolved else row
+    return {key: resolved.get(key, "Batch not found.") for key in keys}
+
+def adjust_stock(db, records, reference=None, reason=None, user_id=None, dry_run=False):
+    """Applies adjustment lines in one transaction (rolled back when dry_run).
+    Lines that fail validation, or would take stock below zero, are reported and
+    skipped. Returns the report with a per-line list of stock changes."""
+    lines, errors, failed = [], [], 0
+    for row_number, record, parse_error in records:
+        line, error = (None, parse_error) if parse_error else parse_adjustment_line(record)
+        if not error and len(lines) >= ADJUSTMENT_MAX_LINES:
+            error = f"More than {ADJUSTMENT_MAX_LINES} lines; split the adjustment."
+        if error:
+            failed += 1
+            if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                errors.append({"row": row_number, "message": error})
+            continue
+        lines.append((row_number, *line))
+    reference = reference or f"adj-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.urandom(3).hex()}"
+
+    db.execute("BEGIN IMMEDIATE") # Quantities cannot change between the read and the update
+    try:
+        batches = _resolve_adjustment_batches(db, {line[1] for line in lines})
+        originals, quantities, changes, ledger = {}, {}, [], []
+        for row_number, key, kind, amount, line_reason in lines:
+            batch = batches[key]
+            if isinstance(batch, str):
+                failed += 1
+                if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                    errors.append({"row": row_number, "message": batch})
+                continue
+            originals.setdefault(batch['id'], batch['quantity'])
+            before = quantities.get(batch['id'], batch['quantity']) # Later lines for a batch build on earlier ones
+            after = amount if kind == 'count' else before + amount
+            if after < 0:
+                failed += 1
+                if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                    errors.append({"row": row_number, "message": f"Stock of {batch['medicineName']} ({batch['batchNo']}) would go negative: {before} {amount:+d}."})
+                continue
+            quantities[batch['id']] = after
+            ledger.append((reference, batch['id'], kind, before, after, line_reason or reason, user_id))
+            if after != before:
+                changes.append({"row": row_number, "medicine_id": batch['id'], "medicineName": batch['medicineName'],
+                                "batchNo": batch['batchNo'], "kind": kind, "quantity_before": before,
+                                "quantity_after": after, "delta": after - before})
+        updates = [(medicine_id, originals[medicine_id], quantity) for medicine_id, quantity in quantities.items()
+                   if quantity != originals[medicine_id]]
+        update_stock_quantities(db, updates)
+        db.executemany("""
+            INSERT INTO stock_adjustments (reference, medicine_id, kind, quantity_before, quantity_after, reason, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ledger)
+        if dry_run:
+            db.rollback()
+        else:
+            db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return {"reference": reference, "dry_run": dry_run, "lines": len(ledger), "batches_changed": len(updates),
+            "units_delta": sum(change['delta'] for change in changes), "failed": failed, "errors": errors,
+            "errors_truncated": failed > len(errors), "changes": changes}
+
+def _json_adjustment_records(lines):
+    for row_number, line in enumerate(lines, start=1):
+        yield (row_number, line, None) if isinstance(line, dict) else (row_number, None, "Each line must be an object.")
+
+@app.route('/stock/adjust', methods=['POST'])
+@login_required()
+def adjust_stock_route():
+    """Bulk stock take / restock. JSON {"lines": [{"id" or "barcode"+"batchNo", "count" or "delta",
+    "reason"?}, ...], "reference"?, "reason"?, "dry_run"?}, or an uploaded CSV/JSONL file with
+    those columns (reference, reason and dry_run as form fields)."""
+    upload = request.files.get('file')
+    if upload and upload.filename:
+        file_format = _import_format(upload.filename, request.form.get('format'))
+        if file_format not in ('csv', 'jsonl'):
+            return jsonify({"success": False, "message": "Unsupported adjustment file format. Use csv or jsonl."}), 400
+        options = request.form
+        records = iter_import_records(upload.stream, file_format)
+        dry_run = options.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    else:
+        options = request.get_json(silent=True)
+        if not isinstance(options, dict) or not isinstance(options.get('lines'), list):
+            return jsonify({"success": False, "message": "Send {\"lines\": [...]} or upload a file."}), 400
+        records = _json_adjustment_records(options['lines'])
+        dry_run = options.get('dry_run') is True
+    db = get_db()
+    try:
+        report = adjust_stock(db, records, _text_field(options, 'reference') or None, _text_field(options, 'reason') or None,
+                              session.get('user_id'), dry_run)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"success": False, "message": f"Could not read adjustment file: {e}"}), 400
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error during stock adjustment: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    if not dry_run:
+        app.logger.info(f"Stock adjustment {report['reference']} by {session.get('user_id')}: {report['lines']} lines, "
+                        f"{report['batches_changed']} batches changed ({report['units_delta']:+d} units), {report['failed']} failed.")
+    return jsonify({"success": True, "message": f"{'Checked' if dry_run else 'Applied'} {report['lines']} lines; "
+                                                f"{report['batches_changed']} batches changed, {report['failed']} lines failed.", **report})
+
+@app.cli.command('adjust-stock')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), help="Defaults to the file extension.")
+@click.option('--reference', help="Ledger reference for this adjustment (default: generated).")
+@click.option('--reason', help="Reason recorded for lines without their own.")
+@click.option('--dry-run', is_flag=True, help="Report the changes without applying them.")
+def adjust_stock_command(path, file_format, reference, reason, dry_run):
+    """Applies a stock take or restock file (id or barcode+batchNo, count or delta)."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                report = adjust_stock(db, iter_import_records(f, _import_format(path, file_format)), reference, reason,
+                                      'cli', dry_run)
+        except (UnicodeDecodeError, csv.Error) as e:
+            click.echo(f"Could not read adjustment file: {e}")
+            return
+        except sqlite3.Error as e:
+            click.echo(f"Database error: {e}")
+            return
+        elapsed = time.perf_counter() - started
+    for change in report['changes']:
+        click.echo(f"Row {change['row']}: {change['medicineName']} ({change['batchNo']}) "
+                   f"{change['quantity_before']} -> {change['quantity_after']} ({change['delta']:+d})")
+    for error in report['errors']:
+        click.echo(f"Row {error['row']}: {error['message']}")
+    if report['errors_truncated']:
+        click.echo(f"... {report['failed'] - len(report['errors'])} more failed rows not shown.")
+    click.echo(f"{'Checked (dry run)' if dry_run else 'Applied'} {report['reference']}: {report['lines']} lines, "
+               f"{report['batches_changed']} batches changed ({report['units_delta']:+d} units), "
+               f"{report['failed']} failed, in {elapsed:.2f}s.")
+
+# --- Delta Sync ---
+# Terminals bill offline and exchange change log entries with a peer (another
+# node's /sync endpoints or a database file): `flask sync` pulls the peer's
+# entries after our watermark, then pushes ours. Each node remembers the highest
+# seq it replayed per origin, so relayed changes apply once, and prunes entries
+# every known peer has. To add a terminal, copy a current, migrated database and
+# run `flask sync-node --reset` on the copy before its first sync.
+def new_node_id():
+    return os.urandom(6).hex()
+
+def get_node_id(db):
+    return db.execute("SELECT node_id FROM sync_node").fetchone()[0]
+
+def last_change_seq(db):
+    """Highest seq ever written to the change log, including pruned entries."""
+    return db.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)").fetchone()[0]
+
+def prune_change_log(db):
+    """Deletes the change log entries every known peer already has, inside the
+    caller's transaction. Returns how many were deleted."""
+    return db.execute("DELETE FROM change_log WHERE seq <= (SELECT MIN(pushed_seq) FROM sync_peers)").rowcount
+
+def acknowledge_changes(db, peer_node, seq):
+    """Records that peer_node has our change log up to seq (it asked for the
+    changes after it) and prunes what every peer has."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("""
+            INSERT INTO sync_peers (peer_node, pushed_seq) VALUES (?, ?)
+            ON CONFLICT (peer_node) DO UPDATE SET pushed_seq = MAX(pushed_seq, excluded.pushed_seq)
+        """, (peer_node, min(seq, last_change_seq(db))))
+        prune_change_log(db)
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+def _resolve_uid(db, node_id, table, uid):
+    """Returns the local id of the row known across nodes as uid, or None."""
+    origin, _, row_id = uid.rpartition(':')
+    if origin == node_id:
+        return int(row_id)
+    row = (db.execute(f"SELECT id FROM {table} WHERE sync_uid = ?", (uid,)).fetchone()
+           or db.execute("SELECT local_id FROM sync_uid_alias WHERE table_name = ? AND uid = ?", (table, uid)).fetchone())
+    return row[0] if row else None
+
+def _fetch_sync_rows(db, node_id, table, row_ids):
+    """Replication payloads of the given local rows, with references as uids."""
+    selects, joins = [f"t.{column}" for column in SYNC_COLUMNS[table]], []
+    for index, (column, ref_table) in enumerate(SYNC_REFERENCES.get(table, {}).items()):
+        selects.append(f"CASE WHEN r{index}.id IS NULL THEN NULL ELSE COALESCE(r{index}.sync_uid, ? || ':' || r{index}.id) END AS {column}")
+        joins.append(f"LEFT JOIN {ref_table} r{index} ON r{index}.id = t.{column}")
+    rows, row_ids = {}, list(row_ids)
+    for start in range(0, len(row_ids), 500):
+        chunk = row_ids[start:start + 500]
+        cur = db.execute(f"""
+            SELECT t.id AS _id, {', '.join(selects)} FROM {table} t {' '.join(joins)}
+            WHERE t.id IN ({','.join('?' * len(chunk))})
+        """, [node_id] * len(joins) + chunk)
+        for row in cur:
+            row = dict(row)
+            rows[row.pop('_id')] = row
+    return rows
+
+def export_changes(db, since_seq=0, exclude_origin=None, limit=None):
+    """Returns the next batch of this node's change log after since_seq, leaving
+    out changes that originated at exclude_origin (the peer asking for them).
+    Consecutive stock deltas of a row are summed and repeated updates collapse
+    into the last one, each kept at its last position so every origin's changes
+    stay in seq order."""
+    limit = limit or app.config['SYNC_BATCH_SIZE']
+    db.execute("BEGIN") # One snapshot for the log and the rows it points at
+    try:
+        node_id = get_node_id(db)
+        pruned_through = db.execute("SELECT MIN(seq) - 1 FROM change_log").fetchone()[0]
+        if since_seq < (last_change_seq(db) if pruned_through is None else pruned_through):
+            raise ValueError(f"Changes after seq {since_seq} were already pruned here; copy a current database to add this node.")
+        entries = db.execute("""
+            SELECT seq, table_name, row_id, row_uid, op, qty_delta,
+                   COALESCE(origin_node, ?) AS origin_node, COALESCE(origin_seq, seq) AS origin_seq
+            FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?
+        """, (node_id, since_seq, limit)).fetchall()
+        has_more, last_seq = len(entries) == limit, entries[-1]['seq'] if entries else since_seq
+        entries = [entry for entry in entries if entry['origin_node'] != exclude_origin]
+        last_index, deltas = {}, {}
+        for index, entry in enumerate(entries):
+            if entry['op'] in ('U', 'Q'):
+                key = (entry['op'], entry['origin_node'], entry['table_name'], entry['row_uid'])
+                last_index[key] = index
+                if entry['op'] == 'Q':
+                    deltas[key] = deltas.get(key, 0) + entry['qty_delta']
+        rows = {table: _fetch_sync_rows(db, node_id, table, {e['row_id'] for e in entries if e['table_name'] == table and e['op'] in ('I', 'U')})
+                for table in SYNC_TABLES}
+    finally:
+        db.commit()
+    changes = []
+    for index, entry in enumerate(entries):
+        table, op = entry['table_name'], entry['op']
+        key = (op, entry['origin_node'], table, entry['row_uid'])
+        if key in last_index and last_index[key] != index:
+            continue
+        change = {"t": table, "op": op, "uid": entry['row_uid'], "o": entry['origin_node'], "s": entry['origin_seq']}
+        if op == 'Q':
+            change['delta'] = deltas[key]
+        elif op in ('I', 'U'):
+            row = rows[table].get(entry['row_id'])
+            if row is None: # Deleted since; a later 'D' entry (or nothing, for bills) follows
+                continue
+            change['row'] = row
+            if op == 'I' and table == 'medicines':
+                change['delta'] = entry['qty_delta']
+        changes.append(change)
+    SYNC_CHANGES_TOTAL.inc('out', 'sent', amount=len(changes))
+    return {"node_id": node_id, "changes": changes, "last_seq": last_seq, "has_more": has_more}
+
+def _apply_change(db, node_id, change):
+    table, op, row = change['t'], change['op'], change.get('row')
+    if table not in SYNC_TABLES or op not in ('I', 'U', 'Q', 'D'):
+        raise ValueError(f"Unknown change {table}/{op}")
+    local_id = _resolve_uid(db, node_id, table, change['uid'])
+    if op == 'I':
+        if local_id is not None:
+            return False # Already here, e.g. history shared with the node this one was copied from
+        if table == 'customers':
+            existing = db.execute("SELECT id FROM customers WHERE phone_number = ?", (row['phone_number'],)).fetchone()
+            if existing: # Registered on both nodes while apart: keep ours, remember theirs as an alias
+                db.execute("INSERT OR REPLACE INTO sync_uid_alias (table_name, uid, local_id) VALUES (?, ?, ?)",
+                           (table, change['uid'], existing['id']))
+                return True
+        columns = list(SYNC_COLUMNS[table])
+        values = [row[column] for column in columns]
+        for column, ref_table in SYNC_REFERENCES.get(table, {}).items():
+            columns.append(column)
+            values.append(_resolve_uid(db, node_id, ref_table, row[column]) if row[column] else None)
+        if table == 'bill_items':
+            if values[columns.index('bill_id')] is None:
+                app.logger.warning(f"Sync: skipping bill item {change['uid']}, its bill is unknown here.")
+                return False
+            if values[columns.index('medicine_id')] is None:
+                values[columns.index('medicine_id')] = 0 # Medicine deleted before it reached this node
+        if table == 'medicines':
+            columns.append('quantity')
+            values.append(change['delta'])
+        db.execute(f"INSERT INTO {table} ({', '.join(columns)}, sync_uid) VALUES ({', '.join('?' * len(columns))}, ?)",
+                   (*values, change['uid']))
+        return True
+    if local_id is None:
+        return False # Row never reached this node or was deleted here
+    if op == 'U' and table in ('medicines', 'customers'):
+        columns = SYNC_COLUMNS[table]
+        try:
+            cur = db.execute(f"UPDATE {table} SET {', '.join(c + ' = ?' for c in columns)} WHERE id = ?",
+                             (*(row[c] for c in columns), local_id))
+        except sqlite3.IntegrityError as e:
+            app.logger.warning(f"Sync: not applying update of {table} {change['uid']}: {e}")
+            return False
+    elif op == 'Q' and table == 'medicines':
+        cur = db.execute("UPDATE medicines SET quantity = quantity + ? WHERE id = ?", (change['delta'], local_id))
+    elif op == 'D' and table in ('medicines', 'customers'):
+        cur = db.execute(f"DELETE FROM {table} WHERE id = ?", (local_id,))
+    else:
+        raise ValueError(f"Unknown change {table}/{op}")
+    return cur.rowcount > 0
+
+def apply_changes(db, changes):
+    """Replays a batch from another node's export_changes() inside the caller's
+    write transaction. Changes already seen (by origin and origin seq) and our
+    own changes coming back are skipped. Returns (applied, skipped)."""
+    node_id = get_node_id(db)
+    watermarks = {row['origin_node']: row['applied_seq'] for row in db.execute("SELECT origin_node, applied_seq FROM sync_origins")}
+    advanced, applied, skipped = {}, 0, 0
+    db.execute("DELETE FROM sync_applying")
+    db.execute("INSERT INTO sync_applying (origin_node, origin_seq) VALUES ('', 0)")
+    for change in changes:
+        origin, origin_seq = change['o'], change['s']
+        if origin == node_id or origin_seq <= watermarks.get(origin, 0):
+            skipped += 1
+            continue
+        db.execute("UPDATE sync_applying SET origin_node = ?, origin_seq = ?", (origin, origin_seq))
+        if _apply_change(db, node_id, change):
+            applied += 1
+        else:
+            skipped += 1
+        watermarks[origin] = advanced[origin] = origin_seq
+    db.execute("DELETE FROM sync_applying")
+    db.executemany("""
+        INSERT INTO sync_origins (origin_node, applied_seq) VALUES (?, ?)
+        ON CONFLICT (origin_node) DO UPDATE SET applied_seq = MAX(applied_seq, excluded.applied_seq)
+    """, advanced.items())
+    SYNC_CHANGES_TOTAL.inc('in', 'applied', amount=applied)
+    SYNC_CHANGES_TOTAL.inc('in', 'skipped', amount=skipped)
+    return applied, skipped
+
+def apply_change_batch(db, changes):
+    """apply_changes() in its own write transaction."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        result = apply_changes(db, changes)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+class FileSyncPeer:
+    """A node's database file opened directly, e.g. a second node on the same machine."""
+    def __init__(self, path):
+        self.db = connect_db(path)
+        if get_schema_version(self.db) < LATEST_SCHEMA_VERSION:
+            migrate_db(self.db)
+
+    def node_id(self):
+        return get_node_id(self.db)
+
+    def export(self, since_seq, exclude_origin):
+        batch = export_changes(self.db, since_seq, exclude_origin)
+        acknowledge_changes(self.db, exclude_origin, since_seq)
+        return batch
+
+    def apply(self, changes):
+        return apply_change_batch(self.db, changes)
+
+    def close(self):
+        self.db.close()
+
+class HttpSyncPeer:
+    """A node reached through its /sync endpoints."""
+    def __init__(self, base_url, token):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def _call(self, method, path, **kwargs):
+        response = self.session.request(method, self.base_url + path, timeout=app.config['SYNC_TIMEOUT_SECONDS'], **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def node_id(self):
+        return self._call('GET', '/sync/node')['node_id']
+
+    def export(self, since_seq, exclude_origin):
+        return self._call('GET', '/sync/changes', params={'since': since_seq, 'peer': exclude_origin})
+
+    def apply(self, changes):
+        result = self._call('POST', '/sync/changes', json={"changes": changes})
+        return result['applied'], result['skipped']
+
+    def close(self):
+        self.session.close()
+
+def sync_with_peer(db, peer):
+    """Pulls the peer's new changes, then pushes ours. Each pulled batch and the
+    watermark it advances commit together; a pushed batch whose acknowledgement
+    is lost is simply sent again and skipped by the peer."""
+    node_id, peer_node = get_node_id(db), peer.node_id()
+    if peer_node == node_id:
+        raise ValueError("Peer has this node's id; run 'flask sync-node --reset' on the copied database.")
+    state = db.execute("SELECT pulled_seq, pushed_seq FROM sync_peers WHERE peer_node = ?", (peer_node,)).fetchone()
+    pulled_seq, pushed_seq = (state['pulled_seq'], state['pushed_seq']) if state else (0, 0)
+    stats = {"peer": peer_node, "pulled": 0, "pushed": 0, "skipped": 0, "pruned": 0}
+
+    def save_watermarks():
+        db.execute("""
+            INSERT INTO sync_peers (peer_node, pulled_seq, pushed_seq, last_sync_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (peer_node) DO UPDATE SET pulled_seq = excluded.pulled_seq, pushed_seq = excluded.pushed_seq,
+                last_sync_at = excluded.last_sync_at
+        """, (peer_node, pulled_seq, pushed_seq))
+
+    while True:
+        batch = peer.export(pulled_seq, node_id)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            applied, skipped = apply_changes(db, batch['changes'])
+            pulled_seq = batch['last_seq']
+            save_watermarks()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        stats['pulled'] += applied
+        stats['skipped'] += skipped
+        if not batch['has_more']:
+            break
+    while True:
+        batch = export_changes(db, pushed_seq, peer_node)
+        if batch['changes']:
+            applied, skipped = peer.apply(batch['changes'])
+            stats['pushed'] += applied
+        pushed_seq = batch['last_seq']
+        db.execute("BEGIN IMMEDIATE")
+        save_watermarks()
+        if not batch['has_more']:
+            stats['pruned'] = prune_change_log(db)
+        db.commit()
+        if not batch['has_more']:
+            break
+    return stats
+
+def reset_node_id(db):
+    """Gives a copied database its own node id. Rows and log entries made under
+    the old id keep it (their uids must not change), and the old node is marked
+    as synced up to the copy, so the first sync with it exchanges only new work."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old_node_id, node_id = get_node_id(db), new_node_id()
+        for table in SYNC_TABLES:
+            db.execute(f"UPDATE {table} SET sync_uid = ? || ':' || id WHERE sync_uid IS NULL", (old_node_id,))
+        db.execute("UPDATE change_log SET origin_node = ?, origin_seq = seq WHERE origin_node IS NULL", (old_node_id,))
+        last_seq = last_change_seq(db)
+        db.execute("""
+            INSERT INTO sync_origins (origin_node, applied_seq) VALUES (?, ?)
+            ON CONFLICT (origin_node) DO UPDATE SET applied_seq = MAX(applied_seq, excluded.applied_seq)
+        """, (old_node_id, last_seq))
+        db.execute("INSERT OR REPLACE INTO sync_peers (peer_node, pulled_seq, pushed_seq) VALUES (?, ?, ?)",
+                   (old_node_id, last_seq, last_seq))
+        db.execute("UPDATE sync_node SET node_id = ?", (node_id,))
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return old_node_id, node_id
+
+def _check_sync_token():
+    token = app.config['SYNC_TOKEN']
+    if not token:
+        return jsonify({"success": False, "message": "Sync is disabled on this node."}), 404
+    if request.headers.get('Authorization') != f"Bearer {token}":
+        return jsonify({"success": False, "message": "Invalid sync token."}), 401
+    return None
+
+@app.route('/sync/node', methods=['GET'])
+def sync_node():
+    error = _check_sync_token()
+    if error:
+        return error
+    db = get_db()
+    last_seq = last_change_seq(db)
+    return jsonify({"success": True, "node_id": get_node_id(db), "last_seq": last_seq})
+
+@app.route('/sync/changes', methods=['GET', 'POST'])
+def sync_changes():
+    """GET ?since=<seq>&peer=<node id>: our next batch of changes for that peer.
+    POST {"changes": [...]}: replay a batch from another node."""
+    error = _check_sync_token()
+    if error:
+        return error
+    db = get_db()
+    if request.method == 'GET':
+        try:
+            since_seq = int(request.args.get('since', 0))
+            limit = min(max(int(request.args.get('limit', app.config['SYNC_BATCH_SIZE'])), 1), app.config['SYNC_BATCH_SIZE'])
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid 'since' or 'limit'."}), 400
+        peer_node = request.args.get('peer')
+        try:
+            batch = export_changes(db, since_seq, peer_node, limit)
+            if peer_node:
+                acknowledge_changes(db, peer_node, since_seq)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 409
+        except sqlite3.Error as e:
+            app.logger.error(f"Database error exporting sync batch: {e}", exc_info=True)
+            return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+        return jsonify({"success": True, **batch})
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('changes'), list):
+        return jsonify({"success": False, "message": "Expected a JSON object with a 'changes' list."}), 400
+    try:
+        applied, skipped = apply_change_batch(db, data['changes'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"success": False, "message": f"Malformed change: {e}"}), 400
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error applying sync batch: {e}", exc_info=True)
+        return jsonify({"success": False, "message": f"Database error: {e}"}), 500
+    return jsonify({"success": True, "node_id": get_node_id(db), "applied": applied, "skipped": skipped})
+
+@app.cli.command('sync')
+@click.argument('peer')
+@click.option('--token', envvar='FLASK_SYNC_TOKEN', help="The peer's SYNC_TOKEN (for http(s) peers).")
+def sync_command(peer, token):
+    """Exchanges changes with PEER: a node's base URL or a database file."""
+    import requests
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        if peer.startswith(('http://', 'https://')):
+            sync_peer = HttpSyncPeer(peer, token or '')
+        elif os.path.exists(peer):
+            sync_peer = FileSyncPeer(peer)
+        else:
+            raise click.BadParameter(f"'{peer}' is neither a URL nor an existing database file.")
+        started = time.perf_counter()
+        try:
+            stats = sync_with_peer(db, sync_peer)
+        except (ValueError, requests.exceptions.RequestException, sqlite3.Error) as e:
+            click.echo(f"Sync failed: {e}")
+            return
+        finally:
+            sync_peer.close()
+    click.echo(f"Synced with node {stats['peer']} in {time.perf_counter() - started:.2f}s: "
+               f"{stats['pulled']} changes pulled, {stats['pushed']} pushed, {stats['skipped']} already known, "
+               f"{stats['pruned']} acknowledged log entries pruned.")
+
+@app.cli.command('sync-node')
+@click.option('--reset', is_flag=True, help="Assign a new node id (run once on a copied database).")
+def sync_node_command(reset):
+    """Shows this database's sync node id and peers."""
+    with app.app_context():
+        db = get_db()
+        if not check_schema(db):
+            click.echo("Database not initialized. Run 'flask init-db' first.")
+            return
+        if reset:
+            old_node_id, node_id = reset_node_id(db)
+            click.echo(f"Node id changed from {old_node_id} to {node_id}.")
+        click.echo(f"Node id: {get_node_id(db)}")
+        for peer in db.execute("SELECT * FROM sync_peers ORDER BY peer_node"):
+            click.echo(f"  peer {peer['peer_node']}: pulled up to {peer['pulled_seq']}, pushed up to {peer['pushed_seq']}, "
+                       f"last sync {peer['last_sync_at'] or 'never'}")
+
+# --- Metrics Endpoint ---
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({"success": False, "message": "Metrics are disabled."}), 404
+    token = app.config['METRICS_TOKEN']
+    if not (app.config['METRICS_PUBLIC'] or session.get('role') == 'admin'
+            or (token and request.headers.get('Authorization') == f"Bearer {token}")):
+        return jsonify({"success": False, "message": "A metrics token or an admin login is required."}), 401
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    qr_cache = render_upi_qr_code.cache_info()
+    lines += ["# HELP pharmabill_qr_cache_lookups_total UPI QR cache lookups by result.",
+              "# TYPE pharmabill_qr_cache_lookups_total counter",
+              f'pharmabill_qr_cache_lookups_total{{result="hit"}} {qr_cache.hits}',
+              f'pharmabill_qr_cache_lookups_total{{result="miss"}} {qr_cache.misses}']
+    return app.response_class('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- Application Factory ---
+def create_app(config=None):
+    """Returns the configured application; wsgi.py serves it in production.
+    `config` overrides the defaults and FLASK_* environment variables. Routes are
+    registered when this module is imported, so each process has one app and
+    calling this again reconfigures it. An existing database is checked (and
+    migrated) here rather than on the first request."""
+    global _schema_ready
+    if config:
+        app.config.update(config)
+        _schema_ready = False
+        _search_cache.clear() # Generations of another database would look current
+    if os.path.exists(app.config['DATABASE']):
+        with app.app_context():
+            check_schema(get_db())
+    if app.config['ARCHIVE_INTERVAL_HOURS']:
+        start_archive_scheduler()
+    return app
+
 # --- Main Execution ---
+# Development server only; production runs wsgi.py under a WSGI server.
 if __name__ == '__main__':
     with app.app_context():
-        db_exists = os.path.exists(DATABASE)
+        database = app.config['DATABASE']
+        db_exists = os.path.exists(database)
         if not db_exists:
-            app.logger.info(f"Database file '{DATABASE}' not found. Initializing database...")
+            app.logger.info(f"Database file '{database}' not found. Initializing database...")
             init_db()
         else:
-            app.logger.info(f"Database file '{DATABASE}' found.")
-            required_tables = ['medicines', 'customers', 'bills', 'bill_items', 'app_settings'] 
-            all_tables_exist = all(table_exists(t) for t in required_tables)
-            if not all_tables_exist:
-                app.logger.warning(f"Database '{DATABASE}' exists, but one or more required tables are missing. Re-initializing...")
+            app.logger.info(f"Database file '{database}' found.")
+            if not check_schema(get_db()):
+                app.logger.warning(f"Database '{database}' exists, but one or more required tables are missing. Re-initializing...")
                 init_db() 
+    create_app()
     app.run(debug=True, host='0.0.0.0', port=5000)
-
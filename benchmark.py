@@ -0,0 +1,1607 @@
+# benchmark.py
+"""Load benchmark for the billing counter workload.
+
+Generates a synthetic pharmacy (medicine batches, customers, bill history) into a
+scratch database, then drives the real Flask app with a mixed workload and
+reports p50/p95/p99 latency and throughput per endpoint.
+
+    python benchmark.py                                   # defaults, in-process test client
+    python benchmark.py --medicines 50000 --bills 200000 --workers 4 --duration 30
+    python benchmark.py --mode server --output before.json
+    python benchmark.py --db /tmp/bench.db --reuse-db --output after.json --compare before.json
+    python benchmark.py --startup --db /tmp/bench.db --reuse-db      # import time and time to first response
+    python benchmark.py --typeahead --db /tmp/bench.db --reuse-db    # billing search replay, cache off vs. on
+    python benchmark.py --search --medicines 500000 --bills 0        # uncached search latency vs. the old LIKE scan
+    python benchmark.py --qr --qr-bills 500                          # bill latency and write-lock hold, QR rendered in vs. after the transaction
+    python benchmark.py --large-carts --cart-lines 150 --terminals 8 # 100+ line bill commit time and an oversell stress test
+    python benchmark.py --barcode --terminals 8                      # barcode cache hits vs. misses and upstream calls saved
+    python benchmark.py --bill-history --db /tmp/history.db         # receipts, bill history and reports over 1M+ bill items
+    python benchmark.py --import --import-rows 100000                # /import_medicines with CSV, JSONL and a file with bad rows
+    python benchmark.py --conditional                                # bytes and server time for plain, compressed and 304 responses
+    python benchmark.py --archive --archive-days 90                  # database size and bill history latency before/after archiving
+    python benchmark.py --concurrency --terminals 6 --duration 5     # terminals reading and billing at once, WAL vs. rollback journal
+
+The UPC API is replaced by a local stub server so barcode lookups never leave
+the machine. Results are written as JSON so runs can be compared across commits.
+"""
+import argparse
+import base64
+import csv
+import datetime
+import gc
+import http.server
+import json
+import logging
+import os
+import platform
+import random
+import re
+import socket
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import requests
+
+import app as pharmacy
+
+# --- Synthetic Data ---
+MEDICINE_STEMS = ['Paracet', 'Amoxi', 'Azithro', 'Cetiri', 'Metfor', 'Atorva', 'Panto', 'Omepra', 'Ibupro', 'Dolo',
+                  'Levo', 'Monte', 'Losar', 'Amlo', 'Telmi', 'Glime', 'Vilda', 'Rosuva', 'Cefix', 'Ondan']
+MEDICINE_SUFFIXES = ['mol', 'cillin', 'mycin', 'zine', 'min', 'statin', 'prazole', 'fen', 'sartan', 'dipine']
+SUPPLIERS = ['Sun Pharma', 'Cipla', 'Lupin', 'Mankind', 'Alkem', 'Zydus', "Dr. Reddy's", 'Torrent']
+SHOP_IDS = ['T1', 'T2', 'T3', None]
+
+def generate_medicines(db, count, rng):
+    """Inserts `count` batches (several batches per medicine name) with ample stock."""
+    today = datetime.date.today()
+    rows = []
+    for i in range(count):
+        name = f"{rng.choice(MEDICINE_STEMS)}{rng.choice(MEDICINE_SUFFIXES)} {rng.choice([250, 500, 650, 10, 20, 40])}mg"
+        expiry = today + datetime.timedelta(days=rng.randint(-60, 900))
+        price = round(rng.uniform(5, 500), 2)
+        rows.append((f"89{i:011d}", name, f"B{rng.randint(1000, 9999)}", round(price * 1.2, 2), price,
+                     (expiry - datetime.timedelta(days=730)).isoformat(), expiry.isoformat(), 1_000_000,
+                     rng.choice(SUPPLIERS), f"S{rng.randint(1, 40)}", f"X{rng.randint(1, 200)}", f"SKU{i}"))
+        if len(rows) >= pharmacy.IMPORT_BATCH_SIZE:
+            pharmacy.bulk_insert_medicines(db, rows)
+            rows = []
+    if rows:
+        pharmacy.bulk_insert_medicines(db, rows)
+
+def generate_customers(db, count, rng):
+    rows = []
+    for i in range(count):
+        name = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))).title() + ' ' + rng.choice(
+            ['Rao', 'Kumar', 'Reddy', 'Shah', 'Iyer', 'Singh', 'Das', 'Nair'])
+        phone = f"9{i:09d}"
+        rows.append((name, phone, pharmacy.normalize_phone(phone)))
+    db.execute("BEGIN IMMEDIATE")
+    db.executemany("INSERT INTO customers (name, phone_number, phone_normalized) VALUES (?, ?, ?)", rows)
+    db.commit()
+
+def generate_bill_history(db, count, rng, customer_count):
+    """Inserts `count` past bills (1-6 lines each) spread over the last year."""
+    medicines = db.execute("SELECT id, medicineName, sellingPrice FROM medicines").fetchall()
+    now = datetime.datetime.now()
+    db.execute("BEGIN IMMEDIATE")
+    for start in range(0, count, 5000):
+        bills, items = [], []
+        for _ in range(min(5000, count - start)):
+            lines = [(rng.choice(medicines), rng.randint(1, 5)) for _ in range(rng.randint(1, 6))]
+            customer_id = rng.randint(1, customer_count) if customer_count and rng.random() < 0.6 else None
+            bill_date = now - datetime.timedelta(seconds=rng.randint(3600, 365 * 86400))
+            bills.append((customer_id, None if customer_id else f"8{rng.randint(0, 10**9 - 1):09d}",
+                          round(sum(m['sellingPrice'] * q for m, q in lines), 2), bill_date, rng.choice(SHOP_IDS)))
+            items.append(lines)
+        first_id = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM bills").fetchone()[0]
+        db.executemany("INSERT INTO bills (customer_id, customer_phone_temp, total_amount, bill_date, billed_from_shop_id) VALUES (?, ?, ?, ?, ?)", bills)
+        db.executemany("""
+            INSERT INTO bill_items (bill_id, medicine_id, medicine_name_snapshot, quantity_billed, price_per_unit_at_billing, total_price_for_item)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, ((first_id + n, m['id'], m['medicineName'], q, m['sellingPrice'], round(m['sellingPrice'] * q, 2))
+              for n, lines in enumerate(items) for m, q in lines))
+    db.commit()
+
+def build_dataset(args):
+    """Creates (or reuses) the scratch database and returns what the workload needs to know about it."""
+    pharmacy.app.config['DATABASE'] = args.db
+    pharmacy.app.config['SECRET_KEY'] = 'benchmark'
+    with pharmacy.app.app_context():
+        if args.reuse_db and os.path.exists(args.db):
+            db = pharmacy.get_db()
+            if not pharmacy.check_schema(db):
+                sys.exit(f"{args.db} is not an initialized database.")
+            print(f"Reusing {args.db}")
+        else:
+            rng = random.Random(args.seed)
+            pharmacy.close_db()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(args.db + suffix):
+                    os.remove(args.db + suffix)
+            started = time.perf_counter()
+            pharmacy.init_db()
+            db = pharmacy.get_db()
+            generate_medicines(db, args.medicines, rng)
+            generate_customers(db, args.customers, rng)
+            generate_bill_history(db, args.bills, rng, args.customers)
+            db.execute("ANALYZE")
+            print(f"Generated {args.medicines} batches, {args.customers} customers, {args.bills} bills "
+                  f"into {args.db} in {time.perf_counter() - started:.1f}s")
+        pharmacy.update_app_setting('upi_id', 'bench@upi')
+        pharmacy.update_app_setting('payee_name', 'Bench Pharmacy')
+        today = datetime.date.today().isoformat()
+        billable = db.execute("""
+            SELECT id, medicineName, sellingPrice FROM medicines
+            WHERE sellingPrice > 0 AND quantity > 1000 AND expiryDate >= ? ORDER BY id
+        """, (today,)).fetchall()
+        dataset = {
+            'billable': [(row['id'], row['sellingPrice']) for row in billable],
+            'names': sorted({row['medicineName'] for row in billable}),
+            'phones': [row[0] for row in db.execute("SELECT phone_number FROM customers ORDER BY id")],
+            'barcodes': [row[0] for row in db.execute("SELECT barcode FROM medicines WHERE barcode IS NOT NULL ORDER BY id LIMIT 5000")],
+        }
+    if not dataset['billable']:
+        sys.exit("The dataset has no billable medicines; increase --medicines.")
+    return dataset
+
+# --- UPC API Stub ---
+class UpcStubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers like the UPCitemdb trial API: even UPCs are found, odd ones are not."""
+    latency_seconds = 0.0
+    calls = 0
+    calls_lock = threading.Lock()
+
+    def do_GET(self):
+        with self.calls_lock:
+            UpcStubHandler.calls += 1
+        upc = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('upc', [''])[0]
+        time.sleep(self.latency_seconds)
+        if upc[-1:].isdigit() and int(upc[-1]) % 2 == 0:
+            payload = {"code": "OK", "items": [{"title": f"Stub product {upc}", "brand": "Stub", "manufacturer": "Stub Labs"}]}
+        else:
+            payload = {"code": "OK", "items": [], "message": "No match"}
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_upc_stub(latency_ms):
+    UpcStubHandler.latency_seconds = latency_ms / 1000
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UpcStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pharmacy.UPCITEMDB_TRIAL_BASE_URL = f"http://127.0.0.1:{server.server_port}/lookup"
+    return server
+
+# --- Clients ---
+class TestClientDriver:
+    """Drives the app in-process through Flask's test client (no network stack)."""
+
+    def __init__(self, base_url=None):
+        self.client = pharmacy.app.test_client()
+
+    def login(self, user_id, password):
+        self.client.post('/login', data={'user_id': user_id, 'password': password})
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.data
+
+    def post_json(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.data
+
+class HttpDriver:
+    """Drives a real WSGI server over HTTP, one keep-alive session per worker."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def login(self, user_id, password):
+        self.session.post(self.base_url + '/login', data={'user_id': user_id, 'password': password}, allow_redirects=False)
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, allow_redirects=False)
+        return response.status_code, response.content
+
+    def post_json(self, path, payload):
+        response = self.session.post(self.base_url + path, json=payload, allow_redirects=False)
+        return response.status_code, response.content
+
+def start_wsgi_server():
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, pharmacy.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+# --- Workload ---
+# Each scenario issues one request and returns the endpoint name it is reported under.
+CART_SIZES = [1, 1, 2, 2, 3, 3, 4, 5, 6, 8, 10, 15, 25]
+
+def scenario_search(driver, rng, dataset):
+    name = rng.choice(dataset['names'])
+    query = name[:rng.randint(2, 6)] if rng.random() < 0.8 else name[2:7]  # prefix typing vs. mid-word
+    return 'search', driver.get(f"/search_medicines_for_billing?query={urllib.parse.quote(query)}")
+
+def scenario_customer_lookup(driver, rng, dataset):
+    phone = rng.choice(dataset['phones'])
+    if rng.random() < 0.5:
+        return 'customer_lookup', driver.get(f"/get_customer_for_billing?phone={phone}")
+    return 'customer_search', driver.get(f"/customers/search?q={phone[:rng.randint(3, 7)]}&limit=8")
+
+def scenario_generate_bill(driver, rng, dataset):
+    size = min(rng.choice(CART_SIZES), len(dataset['billable']))
+    cart = [{"medicine_id": medicine_id, "quantity_billed": rng.randint(1, 3), "price_per_unit_at_billing": price}
+            for medicine_id, price in rng.sample(dataset['billable'], size)]
+    total = round(sum(item['quantity_billed'] * item['price_per_unit_at_billing'] for item in cart), 2)
+    payload = {"cart": cart, "total_amount": total, "billed_from_shop_id": rng.choice(['T1', 'T2', 'T3'])}
+    if rng.random() < 0.5:
+        payload["customer_phone_temp"] = f"7{rng.randint(0, 10**9 - 1):09d}"
+    bucket = 'small' if size <= 3 else 'medium' if size <= 9 else 'large'
+    return f'generate_bill_{bucket}', driver.post_json('/generate_bill', payload)
+
+def scenario_inventory(driver, rng, dataset):
+    if rng.random() < 0.2:
+        return 'inventory_page', driver.get('/inventory')
+    status = rng.choice(['all', 'all', 'expired', 'soon', 'good'])
+    name = rng.choice(dataset['names'])[:3] if rng.random() < 0.3 else ''
+    return 'inventory_data', driver.get(f"/inventory_data?status={status}&name={urllib.parse.quote(name)}")
+
+def scenario_barcode(driver, rng, dataset):
+    # Mostly scans of stocked items (served from the cache), some unknown UPCs that hit the stub.
+    upc = rng.choice(dataset['barcodes']) if rng.random() < 0.8 else f"{rng.randint(10**11, 10**12 - 1)}"
+    return 'barcode_lookup', driver.get(f"/fetch_barcode_details?upc={upc}")
+
+# name -> (default weight, scenario)
+SCENARIOS = {
+    'search': (40, scenario_search),
+    'customer': (15, scenario_customer_lookup),
+    'bill': (20, scenario_generate_bill),
+    'inventory': (15, scenario_inventory),
+    'barcode': (10, scenario_barcode),
+}
+
+def parse_mix(mix):
+    """Parses 'search=40,bill=20' into scenario weights; unlisted scenarios keep their defaults."""
+    weights = {name: weight for name, (weight, _) in SCENARIOS.items()}
+    for part in filter(None, (mix or '').split(',')):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}.")
+        weights[name.strip()] = float(weight)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+def run_worker(worker_id, args, dataset, weights, driver_factory, deadline, samples, errors):
+    rng = random.Random(args.seed * 1000 + worker_id)
+    driver = driver_factory()
+    driver.login('admin', 'admin')
+    names, scenario_weights = list(weights), list(weights.values())
+    issued = 0
+    while True:
+        if args.requests and issued >= args.requests // args.workers + (worker_id < args.requests % args.workers):
+            break
+        if not args.requests and time.perf_counter() >= deadline:
+            break
+        scenario = SCENARIOS[rng.choices(names, scenario_weights)[0]][1]
+        started = time.perf_counter()
+        endpoint, (status, _) = scenario(driver, rng, dataset)
+        elapsed = time.perf_counter() - started
+        issued += 1
+        samples.setdefault(endpoint, []).append(elapsed)
+        if status >= 400:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))]
+
+def summarize(samples, errors, wall_seconds):
+    def stats(values, error_count):
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "errors": error_count,
+            "throughput_rps": round(len(values) / wall_seconds, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    endpoints = {name: stats(values, errors.get(name, 0)) for name, values in sorted(samples.items())}
+    everything = [value for values in samples.values() for value in values]
+    return endpoints, stats(everything, sum(errors.values())) if everything else None
+
+def millisecond_stats(values):
+    values = sorted(values)
+    return {"count": len(values), "mean_ms": round(sum(values) / len(values), 3), "p50_ms": round(percentile(values, 0.5), 3),
+            "p95_ms": round(percentile(values, 0.95), 3), "p99_ms": round(percentile(values, 0.99), 3),
+            "max_ms": round(values[-1], 3)} if values else None
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    dataset = build_dataset(args)
+    stub = start_upc_stub(args.stub_latency_ms)
+    weights = parse_mix(args.mix)
+    pharmacy.app.config['BILL_WRITER_ENABLED'] = args.bill_writer
+    server = None
+    if args.mode == 'server':
+        server, base_url = start_wsgi_server()
+        driver_factory = lambda: HttpDriver(base_url)
+    else:
+        driver_factory = TestClientDriver
+
+    if args.warmup:
+        warmup_args = argparse.Namespace(**{**vars(args), 'requests': args.warmup, 'workers': 1})
+        run_worker(0, warmup_args, dataset, weights, driver_factory, 0, {}, {})
+
+    samples_by_worker = [{} for _ in range(args.workers)]
+    errors_by_worker = [{} for _ in range(args.workers)]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=run_worker, args=(i, args, dataset, weights, driver_factory, deadline,
+                                                         samples_by_worker[i], errors_by_worker[i]))
+               for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+    if server:
+        server.shutdown()
+    stub.shutdown()
+
+    samples, errors = {}, {}
+    for worker_samples, worker_errors in zip(samples_by_worker, errors_by_worker):
+        for name, values in worker_samples.items():
+            samples.setdefault(name, []).extend(values)
+        for name, count in worker_errors.items():
+            errors[name] = errors.get(name, 0) + count
+    endpoints, total = summarize(samples, errors, wall_seconds)
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "mode": args.mode,
+            "workers": args.workers,
+            "seed": args.seed,
+            "scale": {"medicines": args.medicines, "customers": args.customers, "bills": args.bills},
+            "mix": weights,
+            "bill_writer": args.bill_writer,
+            "stub_latency_ms": args.stub_latency_ms,
+            "wall_seconds": round(wall_seconds, 3),
+        },
+        "endpoints": endpoints,
+        "total": total,
+    }
+
+# --- Startup ---
+# Cold start of a fresh worker process: `python -X importtime -c "import app"`, and
+# the time from spawning a server process to its first successful response. Both
+# run against --app-dir, so an older checkout can be measured the same way.
+STARTUP_SERVER = (
+    "import sys\n"
+    "from werkzeug.serving import make_server\n"
+    "import app\n"
+    "application = app.create_app() if hasattr(app, 'create_app') else app.app\n"
+    "make_server('127.0.0.1', int(sys.argv[1]), application).serve_forever()\n"
+)
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+def measure_import(app_dir, env):
+    """Returns (cumulative ms to import app, [(module, ms)] of what app itself imported)."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=app_dir, env=env,
+                            capture_output=True, text=True, check=True).stderr
+    children = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms, depth, name = int(match.group(2)) / 1000, len(match.group(3)) // 2, match.group(4)
+        if depth == 0 and name == 'app':
+            return cumulative_ms, sorted(children, key=lambda child: -child[1])
+        if depth == 0:
+            children = []
+        elif depth == 1:
+            children.append((name, cumulative_ms))
+    raise RuntimeError("'import app' did not appear in the -X importtime output.")
+
+def measure_first_response(app_dir, env):
+    """Milliseconds from spawning a server process until GET /login answers 200."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', STARTUP_SERVER, str(port)], cwd=app_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/login", timeout=5).status_code == 200:
+                    return (time.perf_counter() - started) * 1000
+            except requests.exceptions.ConnectionError:
+                pass
+            if process.poll() is not None:
+                raise RuntimeError(f"Server process exited with status {process.returncode} before responding.")
+            time.sleep(0.002)
+    finally:
+        process.terminate()
+        process.wait()
+
+def run_startup_benchmark(args):
+    build_dataset(args)
+    with pharmacy.app.app_context():
+        pharmacy.close_db()
+    env = {**os.environ, 'FLASK_DATABASE': os.path.abspath(args.db), 'FLASK_SECRET_KEY': 'startup-benchmark'}
+    app_dir = os.path.abspath(args.app_dir)
+    measure_import(app_dir, env) # Unrecorded: writes bytecode caches
+    imports, first_responses, children = [], [], []
+    for _ in range(args.startup_runs):
+        import_ms, children = measure_import(app_dir, env)
+        imports.append(import_ms)
+        first_responses.append(measure_first_response(app_dir, env))
+
+    def stats(values):
+        values = sorted(values)
+        return {"p50_ms": round(percentile(values, 0.5), 1), "min_ms": round(values[0], 1), "max_ms": round(values[-1], 1)}
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "app_dir": app_dir,
+            "runs": args.startup_runs,
+        },
+        "startup": {
+            "import_app": stats(imports),
+            "first_response": stats(first_responses),
+            "app_imports": [{"module": name, "ms": round(ms, 1)} for name, ms in children[:10]],
+        },
+    }
+
+def print_startup_report(results, baseline=None):
+    startup = results['startup']
+    base = baseline.get('startup') if baseline else None
+    header = f"{'cold start':<24}{'p50 ms':>10}{'min ms':>10}{'max ms':>10}" + (f"{'p50 vs base':>14}" if base else '')
+    print(header)
+    print('-' * len(header))
+    for key in ('import_app', 'first_response'):
+        stats = startup[key]
+        line = f"{key:<24}{stats['p50_ms']:>10.1f}{stats['min_ms']:>10.1f}{stats['max_ms']:>10.1f}"
+        if base:
+            line += f"{_relative_change(stats['p50_ms'], base[key]['p50_ms']):>14}"
+        print(line)
+    print("Slowest imports made by app: " + ', '.join(f"{item['module']} {item['ms']:.1f} ms" for item in startup['app_imports']))
+
+# --- Typeahead ---
+# Replays a cashier keystroke trace against /search_medicines_for_billing, once
+# with the search cache disabled and once enabled. Popular names are typed a
+# character at a time (Zipf-weighted, so the same prefixes recur), and a bill is
+# issued every --typeahead-bill-every searches so stock changes keep invalidating
+# the cache as they would at a real counter.
+def build_keystroke_trace(dataset, rng, length, bill_every):
+    names = list(dataset['names'])
+    rng.shuffle(names) # Popularity rank unrelated to alphabetical order
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    trace, searches = [], 0
+    while searches < length:
+        name = rng.choices(names, weights)[0].lower()
+        typed = rng.randint(2, min(len(name), 8))
+        for end in range(1, typed + 1):
+            trace.append(('search', name[:end]))
+            searches += 1
+            if bill_every and searches % bill_every == 0:
+                trace.append(('bill', None))
+    return trace
+
+def replay_keystroke_trace(trace, dataset, seed):
+    driver = TestClientDriver()
+    driver.login('admin', 'admin')
+    rng = random.Random(seed)
+    timings, errors, bills = [], 0, 0
+    hits, misses = pharmacy.SEARCH_CACHE_LOOKUPS.value('hit'), pharmacy.SEARCH_CACHE_LOOKUPS.value('miss')
+    started = time.perf_counter()
+    for action, query in trace:
+        if action == 'bill':
+            status, _ = scenario_generate_bill(driver, rng, dataset)[1]
+            bills += 1
+        else:
+            request_started = time.perf_counter()
+            status, _ = driver.get(f"/search_medicines_for_billing?query={urllib.parse.quote(query)}")
+            timings.append((time.perf_counter() - request_started) * 1000)
+        errors += status >= 400
+    wall_seconds = time.perf_counter() - started
+    timings.sort()
+    hits, misses = pharmacy.SEARCH_CACHE_LOOKUPS.value('hit') - hits, pharmacy.SEARCH_CACHE_LOOKUPS.value('miss') - misses
+    return {
+        "searches": len(timings), "bills": bills, "errors": errors, "wall_seconds": round(wall_seconds, 3),
+        "mean_ms": round(sum(timings) / len(timings), 3), "p50_ms": round(percentile(timings, 0.5), 3),
+        "p95_ms": round(percentile(timings, 0.95), 3), "p99_ms": round(percentile(timings, 0.99), 3),
+        "cache_hits": hits, "cache_misses": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+def run_typeahead_benchmark(args):
+    dataset = build_dataset(args)
+    trace = build_keystroke_trace(dataset, random.Random(args.seed), args.typeahead_searches, args.typeahead_bill_every)
+    cache_size = pharmacy.app.config['SEARCH_CACHE_SIZE']
+    runs = {}
+    try:
+        for label, size in (('uncached', 0), ('cached', cache_size)):
+            pharmacy.app.config['SEARCH_CACHE_SIZE'] = size
+            pharmacy._search_cache.clear()
+            runs[label] = replay_keystroke_trace(trace, dataset, args.seed)
+    finally:
+        pharmacy.app.config['SEARCH_CACHE_SIZE'] = cache_size
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "scale": {"medicines": args.medicines, "customers": args.customers, "bills": args.bills},
+            "seed": args.seed,
+            "bill_every": args.typeahead_bill_every,
+            "cache_size": cache_size,
+        },
+        "typeahead": runs,
+    }
+
+def print_typeahead_report(results, baseline=None):
+    runs = results['typeahead']
+    base = baseline.get('typeahead') if baseline else None
+    header = (f"{'typeahead':<12}{'searches':>10}{'bills':>7}{'err':>5}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'hit rate':>10}"
+              + (f"{'p50 vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for label, stats in runs.items():
+        hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else '-'
+        line = (f"{label:<12}{stats['searches']:>10}{stats['bills']:>7}{stats['errors']:>5}{stats['mean_ms']:>10.3f}"
+                f"{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}{hit_rate:>10}")
+        if base and label in base:
+            line += f"{_relative_change(stats['p50_ms'], base[label]['p50_ms']):>14}"
+        print(line)
+
+# --- Search ---
+# Uncached latency of /search_medicines_for_billing over a large catalogue, for
+# the query shapes a counter sees: name prefixes, mid-word fragments, strengths,
+# shop IDs and barcode prefixes. A sample of the same queries also runs as the
+# original LIKE scan, for comparison.
+LIKE_SCAN_SQL = """
+    SELECT id, medicineName, batchNo, sellingPrice, quantity, shop_id
+    FROM medicines
+    WHERE (LOWER(medicineName) LIKE LOWER(?) OR LOWER(shop_id) LIKE LOWER(?))
+      AND sellingPrice IS NOT NULL AND sellingPrice > 0 AND quantity > 0 AND expiryDate >= ?
+    ORDER BY medicineName LIMIT 10
+"""
+
+def build_search_queries(dataset, rng, count):
+    shapes = [
+        lambda: rng.choice(dataset['names'])[:rng.randint(2, 6)],
+        lambda: rng.choice(dataset['names'])[2:7],
+        lambda: f"{rng.choice([250, 500, 650, 10, 20, 40])}mg",
+        lambda: f"SKU{rng.randint(1, 99999)}",
+        lambda: rng.choice(dataset['barcodes'])[:rng.randint(4, 13)],
+    ]
+    return [rng.choice(shapes)() for _ in range(count)]
+
+def run_search_benchmark(args):
+    dataset = build_dataset(args)
+    queries = build_search_queries(dataset, random.Random(args.seed), args.search_queries)
+    cache_size = pharmacy.app.config['SEARCH_CACHE_SIZE']
+    pharmacy.app.config['SEARCH_CACHE_SIZE'] = 0
+    try:
+        driver = TestClientDriver()
+        driver.login('admin', 'admin')
+        for query in queries[:50]: # Warm the page cache
+            driver.get(f"/search_medicines_for_billing?query={urllib.parse.quote(query)}")
+        timings, errors, empty = [], 0, 0
+        for query in queries:
+            started = time.perf_counter()
+            status, body = driver.get(f"/search_medicines_for_billing?query={urllib.parse.quote(query)}")
+            timings.append((time.perf_counter() - started) * 1000)
+            errors += status >= 400
+            empty += status == 200 and body.strip() == b'[]'
+    finally:
+        pharmacy.app.config['SEARCH_CACHE_SIZE'] = cache_size
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        batches = db.execute("SELECT COUNT(*) FROM medicines").fetchone()[0]
+        today = datetime.date.today().isoformat()
+        scan_timings = []
+        for query in queries[:args.search_scan_queries]:
+            started = time.perf_counter()
+            db.execute(LIKE_SCAN_SQL, (f'%{query}%', f'%{query}%', today)).fetchall()
+            scan_timings.append((time.perf_counter() - started) * 1000)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "batches": batches,
+            "seed": args.seed,
+            "target_ms": args.search_target_ms,
+        },
+        "search": {"indexed": {**millisecond_stats(timings), "errors": errors, "empty_results": empty},
+                   "like_scan": millisecond_stats(scan_timings)},
+    }
+
+def print_search_report(results, baseline=None):
+    runs, target = results['search'], results['meta']['target_ms']
+    base = baseline.get('search') if baseline else None
+    print(f"Billing search over {results['meta']['batches']} batches (search cache off)")
+    header = (f"{'search':<12}{'queries':>9}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+              + (f"{'p95 vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for label, stats in runs.items():
+        if not stats:
+            continue
+        line = (f"{label:<12}{stats['count']:>9}{stats['mean_ms']:>10.3f}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}"
+                f"{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+        if base and base.get(label):
+            line += f"{_relative_change(stats['p95_ms'], base[label]['p95_ms']):>14}"
+        print(line)
+    indexed = runs['indexed']
+    print(f"{indexed['errors']} errors, {indexed['empty_results']} queries without results. "
+          f"p95 {indexed['p95_ms']:.2f} ms against a {target:g} ms target: {'PASS' if indexed['p95_ms'] < target else 'FAIL'}")
+
+# --- UPI QR ---
+# The same carts are billed twice in-process: as before, with the PNG QR rendered
+# and base64-inlined while the write transaction is open, and as now, committing
+# first and leaving the QR to /bill/<id>/upi_qr. The write lock is held from BEGIN
+# IMMEDIATE to COMMIT. The QR endpoint is then timed cold, cached and revalidated.
+def bill_with_qr(db, cart, total, qr_in_transaction):
+    upi_id, payee_name = pharmacy.get_app_setting('upi_id'), pharmacy.get_app_setting('payee_name')
+    started = time.perf_counter()
+    db.execute("BEGIN IMMEDIATE")
+    locked = time.perf_counter()
+    bill_id, amount = pharmacy.write_bill(db, cart, total)
+    response = {"success": True, "bill_id": bill_id, "total_amount": amount}
+    if qr_in_transaction:
+        png = pharmacy.render_upi_qr_code.__wrapped__(upi_id, payee_name, f"{amount:.2f}", bill_id)
+        response["qr_code_image"] = base64.b64encode(png).decode('utf-8')
+    db.commit()
+    committed = time.perf_counter()
+    if not qr_in_transaction:
+        response["qr_code_url"] = f"/bill/{bill_id}/upi_qr"
+    body = json.dumps(response)
+    return bill_id, (committed - locked) * 1000, (time.perf_counter() - started) * 1000, len(body)
+
+def run_qr_benchmark(args):
+    dataset = build_dataset(args)
+    rng = random.Random(args.seed)
+    carts = []
+    for _ in range(args.qr_bills):
+        lines = rng.sample(dataset['billable'], min(rng.choice(CART_SIZES), len(dataset['billable'])))
+        cart = [{"medicine_id": medicine_id, "quantity_billed": 1, "price_per_unit_at_billing": price} for medicine_id, price in lines]
+        carts.append((cart, round(sum(price for _, price in lines), 2)))
+    runs, bill_ids = {}, []
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        for label, qr_in_transaction in (('qr_in_transaction', True), ('qr_after_commit', False)):
+            lock_ms, latency_ms, response_bytes = [], [], []
+            for cart, total in carts:
+                bill_id, held, elapsed, size = bill_with_qr(db, cart, total, qr_in_transaction)
+                lock_ms.append(held)
+                latency_ms.append(elapsed)
+                response_bytes.append(size)
+                if not qr_in_transaction:
+                    bill_ids.append(bill_id)
+            runs[label] = {"write_lock": millisecond_stats(lock_ms), "bill": millisecond_stats(latency_ms),
+                           "mean_response_bytes": round(sum(response_bytes) / len(response_bytes))}
+
+    pharmacy.render_upi_qr_code.cache_clear()
+    client = pharmacy.app.test_client()
+    client.post('/login', data={'user_id': 'admin', 'password': 'admin'})
+    endpoint, errors = {'first': [], 'cached': [], 'not_modified': []}, 0
+    for bill_id in bill_ids:
+        for label in endpoint:
+            headers = {'If-None-Match': etag} if label == 'not_modified' else {}
+            started = time.perf_counter()
+            response = client.get(f"/bill/{bill_id}/upi_qr", headers=headers)
+            endpoint[label].append((time.perf_counter() - started) * 1000)
+            errors += response.status_code != (304 if label == 'not_modified' else 200)
+            etag = response.headers.get('ETag')
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "scale": {"medicines": args.medicines, "customers": args.customers, "bills": args.bills},
+            "qr_bills": args.qr_bills,
+        },
+        "qr": {**runs, "endpoint": {label: millisecond_stats(values) for label, values in endpoint.items()}, "endpoint_errors": errors},
+    }
+
+def print_qr_report(results, baseline=None):
+    runs = results['qr']
+    base = baseline.get('qr') if baseline else None
+    print(f"{results['meta']['qr_bills']} bills, each written with the QR in the transaction, then after the commit")
+    header = (f"{'pipeline':<20}{'lock p50 ms':>13}{'lock p95 ms':>13}{'bill p50 ms':>13}{'bill p95 ms':>13}{'response B':>12}"
+              + (f"{'lock p95 vs base':>18}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for label in ('qr_in_transaction', 'qr_after_commit'):
+        run = runs[label]
+        line = (f"{label:<20}{run['write_lock']['p50_ms']:>13.3f}{run['write_lock']['p95_ms']:>13.3f}"
+                f"{run['bill']['p50_ms']:>13.3f}{run['bill']['p95_ms']:>13.3f}{run['mean_response_bytes']:>12}")
+        if base:
+            line += f"{_relative_change(run['write_lock']['p95_ms'], base[label]['write_lock']['p95_ms']):>18}"
+        print(line)
+    before, after = runs['qr_in_transaction'], runs['qr_after_commit']
+    print(f"Committing before the QR: write lock p95 {_relative_change(after['write_lock']['p95_ms'], before['write_lock']['p95_ms'])}, "
+          f"bill p95 {_relative_change(after['bill']['p95_ms'], before['bill']['p95_ms'])}, "
+          f"response {_relative_change(after['mean_response_bytes'], before['mean_response_bytes'])}")
+    print("/bill/<id>/upi_qr: " + ", ".join(f"{label} p50 {stats['p50_ms']:.3f} ms" for label, stats in runs['endpoint'].items())
+          + f"; {runs['endpoint_errors']} errors")
+
+# --- Large Carts ---
+# Bills of --cart-lines distinct batches go through /generate_bill, timing the
+# request and, in-process, BEGIN IMMEDIATE to COMMIT. Then --terminals terminals
+# race to bill one batch with --stress-stock units left until it is sold out; the
+# batch must end at its starting stock minus exactly what the accepted bills sold.
+def run_large_cart_benchmark(args):
+    dataset = build_dataset(args)
+    pharmacy.app.config['BILL_WRITER_ENABLED'] = args.bill_writer
+    if len(dataset['billable']) < args.cart_lines + 1:
+        sys.exit(f"Need at least {args.cart_lines + 1} billable batches; increase --medicines.")
+    rng = random.Random(args.seed)
+
+    def large_cart():
+        lines = rng.sample(dataset['billable'][1:], args.cart_lines)
+        cart = [{"medicine_id": medicine_id, "quantity_billed": 1, "price_per_unit_at_billing": price} for medicine_id, price in lines]
+        return cart, round(sum(price for _, price in lines), 2)
+
+    driver = TestClientDriver()
+    driver.login('admin', 'admin')
+    request_ms, commit_ms, errors = [], [], 0
+    for _ in range(args.large_cart_bills):
+        cart, total = large_cart()
+        started = time.perf_counter()
+        status, _ = driver.post_json('/generate_bill', {"cart": cart, "total_amount": total})
+        request_ms.append((time.perf_counter() - started) * 1000)
+        errors += status != 200
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        for _ in range(args.large_cart_bills):
+            cart, total = large_cart()
+            started = time.perf_counter()
+            db.execute("BEGIN IMMEDIATE")
+            pharmacy.write_bill(db, cart, total)
+            db.commit()
+            commit_ms.append((time.perf_counter() - started) * 1000)
+
+        # The contested batch is kept out of the large carts above.
+        medicine_id, price = dataset['billable'][0]
+        db.execute("UPDATE medicines SET quantity = ? WHERE id = ?", (args.stress_stock, medicine_id))
+        db.commit()
+        last_bill_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM bills").fetchone()[0]
+
+    outcomes = [{} for _ in range(args.terminals)]
+    def terminal(worker_id):
+        worker_rng = random.Random(args.seed * 1000 + worker_id)
+        worker = TestClientDriver()
+        worker.login('admin', 'admin')
+        rejected_in_a_row = 0
+        while rejected_in_a_row < 3: # Sold out once the smallest request is refused repeatedly
+            quantity = worker_rng.randint(1, 3) if rejected_in_a_row == 0 else 1
+            status, body = worker.post_json('/generate_bill', {"total_amount": quantity * price, "cart": [
+                {"medicine_id": medicine_id, "quantity_billed": quantity, "price_per_unit_at_billing": price}]})
+            outcomes[worker_id][status] = outcomes[worker_id].get(status, 0) + 1
+            if status == 200:
+                outcomes[worker_id]['units_sold'] = outcomes[worker_id].get('units_sold', 0) + quantity
+                rejected_in_a_row = 0
+            else:
+                rejected_in_a_row += 1
+    started = time.perf_counter()
+    threads = [threading.Thread(target=terminal, args=(i,)) for i in range(args.terminals)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stress_seconds = time.perf_counter() - started
+
+    statuses = {}
+    for outcome in outcomes:
+        for key, count in outcome.items():
+            statuses[str(key)] = statuses.get(str(key), 0) + count
+    units_sold = statuses.pop('units_sold', 0)
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        final_quantity = db.execute("SELECT quantity FROM medicines WHERE id = ?", (medicine_id,)).fetchone()[0]
+        units_billed = db.execute("SELECT COALESCE(SUM(quantity_billed), 0) FROM bill_items WHERE bill_id > ? AND medicine_id = ?",
+                                  (last_bill_id, medicine_id)).fetchone()[0]
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "scale": {"medicines": args.medicines, "customers": args.customers, "bills": args.bills},
+            "bill_writer": args.bill_writer,
+            "cart_lines": args.cart_lines,
+            "terminals": args.terminals,
+        },
+        "large_carts": {"request": {**millisecond_stats(request_ms), "errors": errors}, "commit": millisecond_stats(commit_ms)},
+        "oversell": {"starting_stock": args.stress_stock, "final_quantity": final_quantity, "units_sold": units_sold,
+                     "units_billed": units_billed, "statuses": statuses, "seconds": round(stress_seconds, 3)},
+    }
+
+def print_large_cart_report(results, baseline=None):
+    carts = results['large_carts']
+    base = baseline.get('large_carts') if baseline else None
+    print(f"Bills of {results['meta']['cart_lines']} lines")
+    header = f"{'timing':<10}{'bills':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}" + (f"{'p95 vs base':>14}" if base else '')
+    print(header)
+    print('-' * len(header))
+    for label in ('request', 'commit'):
+        stats = carts[label]
+        line = f"{label:<10}{stats['count']:>7}{stats['mean_ms']:>10.3f}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['max_ms']:>10.3f}"
+        if base:
+            line += f"{_relative_change(stats['p95_ms'], base[label]['p95_ms']):>14}"
+        print(line)
+    print(f"{carts['request']['errors']} failed bills")
+    oversell = results['oversell']
+    consistent = (oversell['final_quantity'] >= 0 and oversell['units_sold'] == oversell['units_billed']
+                  and oversell['final_quantity'] == oversell['starting_stock'] - oversell['units_billed'])
+    print(f"Oversell stress, {results['meta']['terminals']} terminals on one batch of {oversell['starting_stock']}: "
+          f"responses {oversell['statuses']}, {oversell['units_sold']} units sold, {oversell['units_billed']} in bill items, "
+          f"{oversell['final_quantity']} left: {'PASS' if consistent else 'FAIL'}")
+
+# --- Barcode Cache ---
+# Against the stub UPC API, which counts the calls it answers: --terminals terminals
+# scan each of --barcode-upcs new UPCs at the same moment (one upstream call each
+# if lookups coalesce), every UPC is re-scanned from the cache, and a day of
+# --barcode-scans scans with repeats is replayed. API answers are dropped from the
+# cache first, so every run starts from inventory-seeded entries only.
+def run_barcode_benchmark(args):
+    dataset = build_dataset(args)
+    stub = start_upc_stub(args.stub_latency_ms)
+    rng = random.Random(args.seed)
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        db.execute("DELETE FROM barcode_cache WHERE source = 'api'")
+        db.commit()
+        known = {row[0] for row in db.execute("SELECT upc FROM barcode_cache")}
+    new_upcs = set()
+    while len(new_upcs) < args.barcode_upcs:
+        upc = f"{rng.randint(10**11, 10**12 - 1)}"
+        if upc not in known:
+            new_upcs.add(upc)
+    new_upcs = sorted(new_upcs)
+
+    drivers = [TestClientDriver() for _ in range(args.terminals)]
+    for driver in drivers:
+        driver.login('admin', 'admin')
+    def scan(driver, upc, timings, errors):
+        started = time.perf_counter()
+        status, _ = driver.get(f"/fetch_barcode_details?upc={upc}")
+        timings.append((time.perf_counter() - started) * 1000)
+        if status != 200:
+            errors.append(upc)
+
+    try:
+        UpcStubHandler.calls = 0
+        miss_ms, errors = [], []
+        for upc in new_upcs:
+            start_together = threading.Barrier(args.terminals)
+            def terminal(driver):
+                start_together.wait()
+                scan(driver, upc, miss_ms, errors)
+            threads = [threading.Thread(target=terminal, args=(driver,)) for driver in drivers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        coalesced_calls = UpcStubHandler.calls
+
+        hit_ms, seeded_ms = [], []
+        for upc in new_upcs:
+            scan(drivers[0], upc, hit_ms, errors)
+        for upc in rng.sample(dataset['barcodes'], min(len(dataset['barcodes']), len(new_upcs))):
+            scan(drivers[0], upc, seeded_ms, errors)
+        rescan_calls = UpcStubHandler.calls - coalesced_calls
+
+        # Mostly stocked products, some new UPCs, each re-scanned a few times over the day.
+        pool = rng.sample(dataset['barcodes'], min(len(dataset['barcodes']), args.barcode_scans // 10)) + \
+            [f"{rng.randint(10**11, 10**12 - 1)}" for _ in range(args.barcode_scans // 40)]
+        day_started_calls, day_ms = UpcStubHandler.calls, []
+        for _ in range(args.barcode_scans):
+            scan(drivers[0], rng.choice(pool), day_ms, errors)
+        day_calls = UpcStubHandler.calls - day_started_calls
+    finally:
+        stub.shutdown()
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "stub_latency_ms": args.stub_latency_ms,
+            "terminals": args.terminals,
+        },
+        "barcode": {
+            "coalescing": {"upcs": len(new_upcs), "scans": len(new_upcs) * args.terminals, "upstream_calls": coalesced_calls},
+            "latency": {"miss": millisecond_stats(miss_ms), "api_hit": millisecond_stats(hit_ms),
+                        "inventory_hit": millisecond_stats(seeded_ms), "rescan_upstream_calls": rescan_calls},
+            "day": {"scans": args.barcode_scans, "distinct_upcs": len(set(pool)), "upstream_calls": day_calls,
+                    "latency": millisecond_stats(day_ms)},
+            "errors": len(errors),
+        },
+    }
+
+def print_barcode_report(results, baseline=None):
+    runs = results['barcode']
+    base = baseline.get('barcode') if baseline else None
+    coalescing, latency, day = runs['coalescing'], runs['latency'], runs['day']
+    print(f"Stub UPC API at {results['meta']['stub_latency_ms']:g} ms, {results['meta']['terminals']} terminals")
+    print(f"Simultaneous scans: {coalescing['scans']} scans of {coalescing['upcs']} new UPCs -> "
+          f"{coalescing['upstream_calls']} upstream calls ({_relative_change(coalescing['upstream_calls'], coalescing['scans'])})")
+    header = f"{'lookup':<15}{'scans':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}" + (f"{'p95 vs base':>14}" if base else '')
+    print(header)
+    print('-' * len(header))
+    for label in ('miss', 'api_hit', 'inventory_hit'):
+        stats = latency[label]
+        line = f"{label:<15}{stats['count']:>7}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['max_ms']:>10.3f}"
+        if base:
+            line += f"{_relative_change(stats['p95_ms'], base['latency'][label]['p95_ms']):>14}"
+        print(line)
+    print(f"Re-scans from the cache made {latency['rescan_upstream_calls']} upstream calls.")
+    print(f"Day of {day['scans']} scans over {day['distinct_upcs']} UPCs: {day['upstream_calls']} upstream calls "
+          f"({_relative_change(day['upstream_calls'], day['scans'])} vs. one per scan), p50 {day['latency']['p50_ms']:.3f} ms, "
+          f"p95 {day['latency']['p95_ms']:.3f} ms; {runs['errors']} errors")
+
+# --- Bill History ---
+# --history-bills past bills (1-6 lines each, so the default makes over 1M
+# bill_items), then receipts, a customer's bills by registered and walk-in phone,
+# a week's bills (first page and the next), each --history-queries times, and the
+# three reports over the year, each --history-report-queries times.
+def time_requests(driver, paths):
+    timings, errors = [], 0
+    for path in paths:
+        started = time.perf_counter()
+        status, _ = driver.get(path)
+        timings.append((time.perf_counter() - started) * 1000)
+        errors += status != 200
+    return {**millisecond_stats(timings), "errors": errors}
+
+def run_bill_history_benchmark(args):
+    dataset = build_dataset(argparse.Namespace(**{**vars(args), 'bills': args.history_bills}))
+    rng = random.Random(args.seed)
+    count = args.history_queries
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        bills, items, max_id = db.execute("SELECT COUNT(*), (SELECT COUNT(*) FROM bill_items), MAX(id) FROM bills").fetchone()
+        walk_in_phones = [row[0] for row in db.execute(
+            "SELECT customer_phone_temp FROM bills WHERE customer_phone_temp IS NOT NULL ORDER BY random() LIMIT ?", (count,))]
+    if not bills:
+        sys.exit("The database has no bills; increase --history-bills.")
+    today = datetime.date.today()
+    year_ago = (today - datetime.timedelta(days=364)).isoformat()
+    weeks = [today - datetime.timedelta(days=rng.randint(7, 364)) for _ in range(count)]
+    driver = TestClientDriver()
+    driver.login('admin', 'admin')
+    next_pages = []
+    for week in weeks:
+        status, body = driver.get(f"/bills?from={week.isoformat()}&to={(week + datetime.timedelta(days=6)).isoformat()}")
+        cursor = json.loads(body).get('next_cursor') if status == 200 else None
+        if cursor:
+            next_pages.append(f"/bills?from={week.isoformat()}&to={(week + datetime.timedelta(days=6)).isoformat()}"
+                              f"&cursor={urllib.parse.quote(cursor)}")
+    queries = {
+        'receipt': [f"/bill/{rng.randint(1, max_id)}" for _ in range(count)],
+        'customer_bills': [f"/bills?phone={rng.choice(dataset['phones'])}" for _ in range(count)],
+        'walk_in_bills': [f"/bills?phone={phone}" for phone in walk_in_phones],
+        'week_first_page': [f"/bills?from={week.isoformat()}&to={(week + datetime.timedelta(days=6)).isoformat()}" for week in weeks],
+        'week_next_page': next_pages,
+        'revenue_by_day': [f"/reports/revenue_by_day?from={year_ago}"] * args.history_report_queries,
+        'top_medicines': [f"/reports/top_medicines?from={year_ago}"] * args.history_report_queries,
+        'terminal_totals': [f"/reports/terminal_totals?from={year_ago}"] * args.history_report_queries,
+    }
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "bills": bills,
+            "bill_items": items,
+            "target_ms": args.history_target_ms,
+        },
+        "bill_history": {name: time_requests(driver, paths) for name, paths in queries.items() if paths},
+    }
+
+def print_bill_history_report(results, baseline=None):
+    runs, meta = results['bill_history'], results['meta']
+    base = baseline.get('bill_history') if baseline else None
+    print(f"{meta['bills']} bills, {meta['bill_items']} bill items")
+    header = (f"{'query':<17}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+              + (f"{'p95 vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for name, stats in runs.items():
+        line = f"{name:<17}{stats['count']:>9}{stats['errors']:>8}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['max_ms']:>10.3f}"
+        if base and base.get(name):
+            line += f"{_relative_change(stats['p95_ms'], base[name]['p95_ms']):>14}"
+        print(line)
+    receipt = runs['receipt']
+    print(f"Receipt p95 {receipt['p95_ms']:.2f} ms against a {meta['target_ms']:g} ms target: "
+          f"{'PASS' if receipt['p95_ms'] < meta['target_ms'] and not receipt['errors'] else 'FAIL'}")
+
+# --- Import ---
+# Uploads --import-rows medicines to /import_medicines as CSV, as JSONL, and as
+# CSV with --import-error-rate of the rows invalid (bad date, negative quantity or
+# no name), then checks the stock aggregate and change log still match medicines.
+IMPORT_FIELDS = ['barcode', 'medicineName', 'batchNo', 'mrp', 'sellingPrice', 'mfgDate', 'expiryDate', 'quantity',
+                 'supplier', 'shelfNo', 'boxNo', 'shopId']
+
+def write_import_file(path, file_format, count, rng, error_rate, barcode_prefix):
+    today = datetime.date.today()
+    invalid = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, IMPORT_FIELDS) if file_format == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for i in range(count):
+            expiry = today + datetime.timedelta(days=rng.randint(-60, 900))
+            price = round(rng.uniform(5, 500), 2)
+            record = {
+                'barcode': f"{barcode_prefix}{i:010d}",
+                'medicineName': f"{rng.choice(MEDICINE_STEMS)}{rng.choice(MEDICINE_SUFFIXES)} {rng.choice([250, 500, 650, 10, 20, 40])}mg",
+                'batchNo': f"I{rng.randint(1000, 9999)}", 'mrp': round(price * 1.2, 2), 'sellingPrice': price,
+                'mfgDate': (expiry - datetime.timedelta(days=730)).isoformat(), 'expiryDate': expiry.isoformat(),
+                'quantity': rng.randint(10, 500), 'supplier': rng.choice(SUPPLIERS), 'shelfNo': f"S{rng.randint(1, 40)}",
+                'boxNo': f"X{rng.randint(1, 200)}", 'shopId': rng.choice(SHOP_IDS) or '',
+            }
+            if rng.random() < error_rate:
+                invalid += 1
+                field, value = rng.choice([('expiryDate', '2025-13-40'), ('quantity', -5), ('medicineName', '')])
+                record[field] = value
+            if writer:
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + '\n')
+    return invalid
+
+def import_consistency(db):
+    return db.execute("""
+        SELECT (SELECT COUNT(*) FROM medicines), (SELECT TOTAL(batch_count) FROM product_stock),
+               (SELECT TOTAL(quantity) FROM medicines), (SELECT TOTAL(total_quantity) FROM product_stock),
+               (SELECT COUNT(*) FROM change_log WHERE table_name = 'medicines' AND op = 'I')
+    """).fetchone()
+
+def run_import_benchmark(args):
+    build_dataset(args)
+    rng = random.Random(args.seed)
+    client = pharmacy.app.test_client()
+    client.post('/login', data={'user_id': 'admin', 'password': 'admin'})
+    runs = {}
+    with tempfile.TemporaryDirectory(prefix='pharmabench-import-') as work_dir:
+        for number, (label, file_format, error_rate) in enumerate((('csv', 'csv', 0.0), ('jsonl', 'jsonl', 0.0),
+                                                                    ('csv_with_errors', 'csv', args.import_error_rate))):
+            path = os.path.join(work_dir, f"{label}.{file_format}")
+            invalid = write_import_file(path, file_format, args.import_rows, rng, error_rate, f"7{number}")
+            with pharmacy.app.app_context():
+                medicines_before = pharmacy.get_db().execute("SELECT COUNT(*) FROM medicines").fetchone()[0]
+            with open(path, 'rb') as f:
+                started = time.perf_counter()
+                response = client.post('/import_medicines', data={'file': (f, os.path.basename(path))}, content_type='multipart/form-data')
+                seconds = time.perf_counter() - started
+            report = response.get_json() or {}
+            with pharmacy.app.app_context():
+                batches, aggregated_batches, quantity, aggregated_quantity, logged = import_consistency(pharmacy.get_db())
+            runs[label] = {
+                "rows": args.import_rows, "invalid_rows": invalid, "file_bytes": os.path.getsize(path),
+                "status": response.status_code, "imported": report.get('imported'), "failed": report.get('failed'),
+                "seconds": round(seconds, 3), "rows_per_second": round(args.import_rows / seconds),
+                "consistent": (batches - medicines_before == report.get('imported') and batches == aggregated_batches == logged
+                               and quantity == aggregated_quantity),
+            }
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "batch_size": pharmacy.IMPORT_BATCH_SIZE,
+            "target_seconds": args.import_target_seconds,
+        },
+        "import": runs,
+    }
+
+def print_import_report(results, baseline=None):
+    runs, target = results['import'], results['meta']['target_seconds']
+    base = baseline.get('import') if baseline else None
+    header = (f"{'file':<17}{'rows':>8}{'MiB':>7}{'status':>8}{'imported':>10}{'failed':>8}{'seconds':>9}{'rows/s':>9}{'consistent':>12}"
+              + (f"{'time vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for label, run in runs.items():
+        line = (f"{label:<17}{run['rows']:>8}{run['file_bytes'] / 2**20:>7.1f}{run['status']:>8}{run['imported']:>10}"
+                f"{run['failed']:>8}{run['seconds']:>9.2f}{run['rows_per_second']:>9}{str(run['consistent']):>12}")
+        if base and base.get(label):
+            line += f"{_relative_change(run['seconds'], base[label]['seconds']):>14}"
+        print(line)
+    errors = runs['csv_with_errors']
+    print(f"The file with bad rows reported {errors['failed']} of {errors['invalid_rows']} invalid rows and imported the rest.")
+    slowest = max(run['seconds'] for run in runs.values())
+    print(f"Slowest import {slowest:.2f}s against a {target:g}s target: "
+          f"{'PASS' if slowest < target and all(run['consistent'] for run in runs.values()) else 'FAIL'}")
+
+# --- Conditional Responses ---
+# Requests each page --conditional-requests times three ways: without compression,
+# with compression accepted, and revalidated with the ETag of an earlier response
+# (a 304 while nothing changed). Reports body bytes and server time per way.
+CONDITIONAL_VARIANTS = {
+    'identity': lambda etag: {'Accept-Encoding': 'identity'},
+    'compressed': lambda etag: {'Accept-Encoding': 'gzip, br'},
+    'revalidated': lambda etag: {'Accept-Encoding': 'gzip, br', 'If-None-Match': etag},
+}
+
+def run_conditional_benchmark(args):
+    dataset = build_dataset(args)
+    rng = random.Random(args.seed)
+    client = pharmacy.app.test_client()
+    client.post('/login', data={'user_id': 'admin', 'password': 'admin'})
+    client.get('/', follow_redirects=True) # Shows the login flash message; pages with pending flashes are never answered with 304
+    pages = {
+        'inventory': '/inventory',
+        'inventory_data': '/inventory_data?status=all',
+        'customers': '/customers',
+        'customers_search': f"/customers/search?q={rng.choice(dataset['phones'])[:4]}",
+        'billing_search': f"/search_medicines_for_billing?query={rng.choice(MEDICINE_STEMS)[:3]}",
+    }
+    results = {}
+    for name, path in pages.items():
+        etag = client.get(path).headers.get('ETag')
+        results[name] = {}
+        for variant, headers in CONDITIONAL_VARIANTS.items():
+            timings, sizes, statuses = [], [], set()
+            for _ in range(args.conditional_requests):
+                started = time.perf_counter()
+                response = client.get(path, headers=headers(etag))
+                timings.append((time.perf_counter() - started) * 1000)
+                sizes.append(len(response.data))
+                statuses.add(response.status_code)
+            results[name][variant] = {**millisecond_stats(timings), "bytes": max(sizes), "statuses": sorted(statuses),
+                                      "encoding": response.headers.get('Content-Encoding', 'identity')}
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "medicines": args.medicines,
+            "customers": args.customers,
+            "compress_min_bytes": pharmacy.app.config['COMPRESS_MIN_BYTES'],
+        },
+        "conditional": results,
+    }
+
+def print_conditional_report(results, baseline=None):
+    pages = results['conditional']
+    base = baseline.get('conditional') if baseline else None
+    header = (f"{'page':<18}{'response':<13}{'status':>8}{'encoding':>10}{'bytes':>11}{'p50 ms':>10}{'p95 ms':>10}"
+              + (f"{'p50 vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for name, variants in pages.items():
+        for variant, stats in variants.items():
+            line = (f"{name:<18}{variant:<13}{'/'.join(map(str, stats['statuses'])):>8}{stats['encoding']:>10}{stats['bytes']:>11}"
+                    f"{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}")
+            if base and base.get(name, {}).get(variant):
+                line += f"{_relative_change(stats['p50_ms'], base[name][variant]['p50_ms']):>14}"
+            print(line)
+    print('-' * len(header))
+    for name, variants in pages.items():
+        plain, compressed, revalidated = variants['identity'], variants['compressed'], variants['revalidated']
+        print(f"{name}: compression saves {1 - compressed['bytes'] / plain['bytes']:.0%} of the bytes, "
+              f"a 304 saves {compressed['bytes'] - revalidated['bytes']} bytes and "
+              f"{compressed['p50_ms'] - revalidated['p50_ms']:.3f} ms of server time at p50 over a compressed 200")
+    ok = all(variants['revalidated']['statuses'] == [304] for variants in pages.values())
+    print(f"Unchanged pages revalidate with 304: {'PASS' if ok else 'FAIL'}")
+
+# --- Archive ---
+# Times bill history queries, archives the bills older than --archive-days into a
+# scratch archive folder, and times them again; reports the database and archive
+# sizes and checks bill_totals() is unchanged.
+def database_size(db, path):
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return os.path.getsize(path)
+
+def archive_queries(rng, count, old_ids, recent_ids, phones, old_week):
+    week = f"/bills?from={old_week.isoformat()}&to={(old_week + datetime.timedelta(days=6)).isoformat()}"
+    return {
+        'recent_receipt': [f"/bill/{rng.choice(recent_ids)}" for _ in range(count)],
+        'archived_receipt': [f"/bill/{rng.choice(old_ids)}" for _ in range(count)],
+        'latest_bills': ["/bills"] * count,
+        'customer_bills': [f"/bills?phone={rng.choice(phones)}" for _ in range(count)],
+        'archived_week': [week] * count,
+    }
+
+def run_archive_benchmark(args):
+    dataset = build_dataset(argparse.Namespace(**{**vars(args), 'bills': args.archive_bills}))
+    rng = random.Random(args.seed)
+    cutoff = (datetime.date.today() - datetime.timedelta(days=args.archive_days)).isoformat()
+    with pharmacy.app.app_context():
+        db = pharmacy.get_db()
+        old_ids = [row[0] for row in db.execute("SELECT id FROM bills WHERE bill_date < ? ORDER BY random() LIMIT ?",
+                                                (cutoff, args.archive_queries))]
+        recent_ids = [row[0] for row in db.execute("SELECT id FROM bills WHERE bill_date >= ? ORDER BY random() LIMIT ?",
+                                                   (cutoff, args.archive_queries))]
+    if not old_ids or not recent_ids:
+        sys.exit("Need bills on both sides of the cutoff; check --archive-bills and --archive-days (under 365).")
+    old_week = datetime.date.fromisoformat(cutoff) - datetime.timedelta(days=30)
+    driver = TestClientDriver()
+    driver.login('admin', 'admin')
+    queries = archive_queries(rng, args.archive_queries, old_ids, recent_ids, dataset['phones'], old_week)
+    with tempfile.TemporaryDirectory(prefix='pharmabench-archive-') as archive_folder:
+        pharmacy.app.config['ARCHIVE_DIR'] = archive_folder
+        with pharmacy.app.app_context():
+            db = pharmacy.get_db()
+            totals_before = pharmacy.bill_totals(db)
+            size_before = database_size(db, args.db)
+        before = {name: time_requests(driver, paths) for name, paths in queries.items()}
+        with pharmacy.app.app_context():
+            db = pharmacy.get_db()
+            started = time.perf_counter()
+            moved = pharmacy.archive_old_bills(db, cutoff)
+            archive_seconds = time.perf_counter() - started
+            totals_after = pharmacy.bill_totals(db)
+            size_after = database_size(db, args.db)
+        archive_bytes = sum(os.path.getsize(os.path.join(archive_folder, name)) for name in os.listdir(archive_folder))
+        after = {name: time_requests(driver, paths) for name, paths in queries.items()}
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "cutoff": cutoff,
+        },
+        "archive": {
+            "months": len(moved),
+            "bills_moved": sum(m[1] for m in moved),
+            "items_moved": sum(m[2] for m in moved),
+            "seconds": round(archive_seconds, 2),
+            "database_bytes_before": size_before,
+            "database_bytes_after": size_after,
+            "archive_bytes": archive_bytes,
+            "totals_before": list(totals_before),
+            "totals_after": list(totals_after),
+        },
+        "before": before,
+        "after": after,
+    }
+
+def print_archive_report(results, baseline=None):
+    archive = results['archive']
+    print(f"Archived {archive['bills_moved']} bills ({archive['items_moved']} items) dated before {results['meta']['cutoff']} "
+          f"into {archive['months']} monthly files in {archive['seconds']:.1f}s")
+    print(f"Database {archive['database_bytes_before'] / 2**20:.1f} MiB -> {archive['database_bytes_after'] / 2**20:.1f} MiB, "
+          f"archive files {archive['archive_bytes'] / 2**20:.1f} MiB")
+    base = baseline.get('after') if baseline else None
+    header = (f"{'query':<18}{'p50 before':>12}{'p50 after':>11}{'p95 before':>12}{'p95 after':>11}{'errors':>8}"
+              + (f"{'p95 vs base':>14}" if base else ''))
+    print(header)
+    print('-' * len(header))
+    for name, after in results['after'].items():
+        before = results['before'][name]
+        line = (f"{name:<18}{before['p50_ms']:>12.3f}{after['p50_ms']:>11.3f}{before['p95_ms']:>12.3f}{after['p95_ms']:>11.3f}"
+                f"{before['errors'] + after['errors']:>8}")
+        if base and base.get(name):
+            line += f"{_relative_change(after['p95_ms'], base[name]['p95_ms']):>14}"
+        print(line)
+    same = archive['totals_before'] == archive['totals_after']
+    print(f"Bills, items, total before {tuple(archive['totals_before'])}, after {tuple(archive['totals_after'])}: {'PASS' if same else 'FAIL'}")
+
+# --- Concurrency ---
+# Several terminals run the mixed workload (searches, lookups, inventory reads and
+# bills) at once, first against a rollback journal and then in WAL mode, each with
+# one terminal and with --terminals. Any "database is locked" the app answers or
+# logs is counted.
+class LockedErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 'database is locked' in record.getMessage()
+
+def run_terminals(args, dataset, weights, driver_factory, terminals):
+    counter = LockedErrorCounter()
+    pharmacy.app.logger.addHandler(counter)
+    samples_by_worker, errors_by_worker = [{} for _ in range(terminals)], [{} for _ in range(terminals)]
+    run_args = argparse.Namespace(**{**vars(args), 'requests': 0, 'workers': terminals})
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_worker, args=(i, run_args, dataset, weights, driver_factory, started + args.duration,
+                                                         samples_by_worker[i], errors_by_worker[i]))
+               for i in range(terminals)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+    pharmacy.app.logger.removeHandler(counter)
+    samples, errors = {}, {}
+    for worker_samples, worker_errors in zip(samples_by_worker, errors_by_worker):
+        for name, values in worker_samples.items():
+            samples.setdefault('bill' if name.startswith('generate_bill') else 'read', []).extend(values)
+        for name, count in worker_errors.items():
+            kind = 'bill' if name.startswith('generate_bill') else 'read'
+            errors[kind] = errors.get(kind, 0) + count
+    kinds, total = summarize(samples, errors, wall_seconds)
+    return {"terminals": terminals, "total": total, "bills": kinds.get('bill'), "reads": kinds.get('read'),
+            "locked_errors": counter.count}
+
+def run_concurrency_benchmark(args):
+    dataset = build_dataset(args)
+    stub = start_upc_stub(args.stub_latency_ms)
+    weights = parse_mix(args.mix)
+    pharmacy.app.config['BILL_WRITER_ENABLED'] = args.bill_writer
+    journal_mode = pharmacy.app.config['SQLITE_JOURNAL_MODE']
+    server = None
+    if args.mode == 'server':
+        server, base_url = start_wsgi_server()
+        driver_factory = lambda: HttpDriver(base_url)
+    else:
+        driver_factory = TestClientDriver
+    runs = {}
+    try:
+        for mode in ('DELETE', 'WAL'):
+            pharmacy.app.config['SQLITE_JOURNAL_MODE'] = mode
+            with pharmacy.app.app_context():
+                pharmacy.close_db() # The mode can only change once no other connection is open
+                gc.collect() # including those pooled by finished terminal threads
+                actual_mode = pharmacy.get_db().execute("PRAGMA journal_mode").fetchone()[0].upper()
+            if actual_mode != mode:
+                sys.exit(f"Could not switch {args.db} to {mode} mode (still {actual_mode}); is another process using it?")
+            runs[mode] = [run_terminals(args, dataset, weights, driver_factory, terminals)
+                          for terminals in sorted({1, args.terminals})]
+    finally:
+        pharmacy.app.config['SQLITE_JOURNAL_MODE'] = journal_mode
+        if server:
+            server.shutdown()
+        stub.shutdown()
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "mode": args.mode,
+            "seed": args.seed,
+            "scale": {"medicines": args.medicines, "customers": args.customers, "bills": args.bills},
+            "mix": weights,
+            "bill_writer": args.bill_writer,
+            "seconds_per_run": args.duration,
+        },
+        "concurrency": runs,
+    }
+
+def print_concurrency_report(results, baseline=None):
+    runs = results['concurrency']
+    header = (f"{'journal':<9}{'terminals':>10}{'requests':>10}{'rps':>9}{'errors':>8}{'locked':>8}"
+              f"{'read p95 ms':>13}{'bill p50 ms':>13}{'bill p95 ms':>13}")
+    print(header)
+    print('-' * len(header))
+    for mode, mode_runs in runs.items():
+        for run in mode_runs:
+            reads, bills = run['reads'] or {}, run['bills'] or {}
+            print(f"{mode:<9}{run['terminals']:>10}{run['total']['count']:>10}{run['total']['throughput_rps']:>9.1f}"
+                  f"{run['total']['errors']:>8}{run['locked_errors']:>8}{reads.get('p95_ms', 0):>13.2f}"
+                  f"{bills.get('p50_ms', 0):>13.2f}{bills.get('p95_ms', 0):>13.2f}")
+    busiest = {mode: mode_runs[-1] for mode, mode_runs in runs.items()}
+    wal, rollback = busiest['WAL'], busiest['DELETE']
+    print(f"WAL vs. rollback journal with {wal['terminals']} terminals: "
+          f"{_relative_change(wal['total']['throughput_rps'], rollback['total']['throughput_rps'])} throughput; "
+          f"{sum(run['locked_errors'] for mode_runs in runs.values() for run in mode_runs)} 'database is locked' errors in all runs.")
+    if baseline and baseline.get('concurrency'):
+        base = baseline['concurrency']['WAL'][-1]
+        print(f"WAL throughput vs. base: {_relative_change(wal['total']['throughput_rps'], base['total']['throughput_rps'])}")
+
+# --- Reporting ---
+def print_report(results, baseline=None):
+    header = f"{'endpoint':<24}{'count':>8}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'p50 vs base':>14}{'p95 vs base':>14}"
+    print(header)
+    print('-' * len(header))
+    rows = list(results['endpoints'].items()) + ([('TOTAL', results['total'])] if results['total'] else [])
+    for name, stats in rows:
+        line = (f"{name:<24}{stats['count']:>8}{stats['errors']:>6}{stats['throughput_rps']:>10.1f}"
+                f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+        if baseline:
+            base = baseline['total'] if name == 'TOTAL' else baseline['endpoints'].get(name)
+            for key in ('p50_ms', 'p95_ms'):
+                line += f"{_relative_change(stats[key], base[key]) if base else 'n/a':>14}"
+        print(line)
+
+def _relative_change(value, base_value):
+    if not base_value:
+        return 'n/a'
+    return f"{(value - base_value) / base_value * 100:+.1f}%"
+
+# Benchmarks other than the default load run: option name -> (run, print report).
+BENCHMARK_MODES = {
+    'startup': (run_startup_benchmark, print_startup_report),
+    'typeahead': (run_typeahead_benchmark, print_typeahead_report),
+    'search': (run_search_benchmark, print_search_report),
+    'qr': (run_qr_benchmark, print_qr_report),
+    'large_carts': (run_large_cart_benchmark, print_large_cart_report),
+    'barcode': (run_barcode_benchmark, print_barcode_report),
+    'bill_history': (run_bill_history_benchmark, print_bill_history_report),
+    'import': (run_import_benchmark, print_import_report),
+    'conditional': (run_conditional_benchmark, print_conditional_report),
+    'archive': (run_archive_benchmark, print_archive_report),
+    'concurrency': (run_concurrency_benchmark, print_concurrency_report),
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the billing counter workload against a synthetic database.")
+    data = parser.add_argument_group('dataset')
+    data.add_argument('--db', help="Scratch database path (default: a new temporary file).")
+    data.add_argument('--reuse-db', action='store_true', help="Reuse --db if it exists instead of regenerating it.")
+    data.add_argument('--medicines', type=int, default=5000, help="Medicine batches to generate (default: %(default)s).")
+    data.add_argument('--customers', type=int, default=20000, help="Customers to generate (default: %(default)s).")
+    data.add_argument('--bills', type=int, default=50000, help="Historical bills to generate (default: %(default)s).")
+    data.add_argument('--seed', type=int, default=42, help="Seed for data and request generation (default: %(default)s).")
+    load = parser.add_argument_group('workload')
+    load.add_argument('--mode', choices=['client', 'server'], default='client',
+                      help="'client' uses Flask's test client in-process; 'server' runs a local threaded WSGI server.")
+    load.add_argument('--workers', type=int, default=1, help="Concurrent workers (default: %(default)s).")
+    load.add_argument('--duration', type=float, default=10.0, help="Seconds to run (default: %(default)s).")
+    load.add_argument('--requests', type=int, default=0, help="Stop after this many requests instead of --duration.")
+    load.add_argument('--warmup', type=int, default=50, help="Unrecorded warm-up requests (default: %(default)s).")
+    load.add_argument('--mix', help=f"Scenario weights, e.g. 'search=40,bill=20' (scenarios: {', '.join(SCENARIOS)}).")
+    load.add_argument('--bill-writer', action='store_true', help="Enable BILL_WRITER_ENABLED (group-committed bill writes).")
+    load.add_argument('--stub-latency-ms', type=float, default=50.0, help="Latency of the stub UPC API (default: %(default)s).")
+    cold = parser.add_argument_group('startup')
+    cold.add_argument('--startup', action='store_true', help="Measure import time and time to first response instead of load.")
+    cold.add_argument('--startup-runs', type=int, default=10, help="Cold starts to measure (default: %(default)s).")
+    cold.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                      help="Checkout whose app.py is started (default: this one).")
+    typeahead = parser.add_argument_group('typeahead')
+    typeahead.add_argument('--typeahead', action='store_true', help="Replay a billing search keystroke trace with the search cache off, then on.")
+    typeahead.add_argument('--typeahead-searches', type=int, default=5000, help="Keystrokes (searches) in the trace (default: %(default)s).")
+    typeahead.add_argument('--typeahead-bill-every', type=int, default=20,
+                           help="Issue a bill after every N searches; 0 for none (default: %(default)s).")
+    qr = parser.add_argument_group('UPI QR')
+    qr.add_argument('--qr', action='store_true',
+                    help="Compare bill latency and write-lock hold with the QR rendered in vs. after the transaction.")
+    qr.add_argument('--qr-bills', type=int, default=300, help="Bills to write per pipeline (default: %(default)s).")
+    carts = parser.add_argument_group('large carts')
+    carts.add_argument('--large-carts', action='store_true',
+                       help="Time bills of --cart-lines lines, then race --terminals terminals to oversell one batch.")
+    carts.add_argument('--cart-lines', type=int, default=100, help="Lines per large cart (default: %(default)s).")
+    carts.add_argument('--large-cart-bills', type=int, default=100, help="Large bills to time each way (default: %(default)s).")
+    carts.add_argument('--stress-stock', type=int, default=200, help="Units of the contested batch (default: %(default)s).")
+    barcode = parser.add_argument_group('barcode cache')
+    barcode.add_argument('--barcode', action='store_true',
+                         help="Measure barcode cache hits vs. misses and upstream calls against the stub UPC API.")
+    barcode.add_argument('--barcode-upcs', type=int, default=50,
+                         help="New UPCs scanned by all --terminals at once (default: %(default)s).")
+    barcode.add_argument('--barcode-scans', type=int, default=2000, help="Scans in the replayed day (default: %(default)s).")
+    history = parser.add_argument_group('bill history')
+    history.add_argument('--bill-history', action='store_true',
+                         help="Time receipts, bill history pages and reports over a large bill history (uses --history-bills, not --bills).")
+    history.add_argument('--history-bills', type=int, default=300000,
+                         help="Past bills to generate; about 3.5 items each (default: %(default)s).")
+    history.add_argument('--history-queries', type=int, default=200, help="Requests per bill query (default: %(default)s).")
+    history.add_argument('--history-report-queries', type=int, default=20, help="Requests per report (default: %(default)s).")
+    history.add_argument('--history-target-ms', type=float, default=10.0, help="Receipt p95 to pass (default: %(default)s).")
+    bulk_import = parser.add_argument_group('import')
+    bulk_import.add_argument('--import', action='store_true',
+                             help="Time /import_medicines uploads of CSV, JSONL and a CSV with invalid rows.")
+    bulk_import.add_argument('--import-rows', type=int, default=100000, help="Rows per uploaded file (default: %(default)s).")
+    bulk_import.add_argument('--import-error-rate', type=float, default=0.02,
+                             help="Share of invalid rows in the last file (default: %(default)s).")
+    bulk_import.add_argument('--import-target-seconds', type=float, default=10.0, help="Slowest import to pass (default: %(default)s).")
+    conditional = parser.add_argument_group('conditional responses')
+    conditional.add_argument('--conditional', action='store_true',
+                             help="Compare bytes and server time of plain, compressed and revalidated (304) responses.")
+    conditional.add_argument('--conditional-requests', type=int, default=200, help="Requests per page and way (default: %(default)s).")
+    archive = parser.add_argument_group('archive')
+    archive.add_argument('--archive', action='store_true',
+                         help="Compare database size and bill history latency before and after archiving old bills.")
+    archive.add_argument('--archive-bills', type=int, default=100000, help="Past bills to generate (default: %(default)s).")
+    archive.add_argument('--archive-days', type=int, default=90, help="Archive bills older than this many days (default: %(default)s).")
+    archive.add_argument('--archive-queries', type=int, default=200, help="Requests per query (default: %(default)s).")
+    concurrency = parser.add_argument_group('concurrency')
+    concurrency.add_argument('--concurrency', action='store_true',
+                             help="Run the workload from several terminals at once, rollback journal vs. WAL; each run lasts --duration.")
+    concurrency.add_argument('--terminals', type=int, default=4, help="Concurrent terminals (default: %(default)s).")
+    search = parser.add_argument_group('search')
+    search.add_argument('--search', action='store_true', help="Measure uncached billing search latency against the old LIKE scan.")
+    search.add_argument('--search-queries', type=int, default=2000, help="Searches to time (default: %(default)s).")
+    search.add_argument('--search-scan-queries', type=int, default=20,
+                        help="Of those, how many also run as the old LIKE scan; 0 to skip (default: %(default)s).")
+    search.add_argument('--search-target-ms', type=float, default=10.0, help="p95 latency to pass (default: %(default)s).")
+    out = parser.add_argument_group('output')
+    out.add_argument('--output', '-o', help="Write JSON results to this file.")
+    out.add_argument('--compare', help="Earlier JSON results to compare p50/p95 against.")
+    out.add_argument('--app-log-level', default='ERROR', help="Log level for the app while benchmarking (default: %(default)s).")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.terminals < 1:
+        parser.error("--workers and --terminals must be at least 1.")
+    if args.startup_runs < 1:
+        parser.error("--startup-runs must be at least 1.")
+    if sum(bool(getattr(args, mode)) for mode in BENCHMARK_MODES) > 1:
+        parser.error(f"{', '.join('--' + mode.replace('_', '-') for mode in BENCHMARK_MODES)} are separate benchmarks; pick one.")
+    if args.typeahead_searches < 1 or args.typeahead_bill_every < 0:
+        parser.error("--typeahead-searches must be at least 1 and --typeahead-bill-every not negative.")
+    if args.search_queries < 1 or args.search_scan_queries < 0:
+        parser.error("--search-queries must be at least 1 and --search-scan-queries not negative.")
+    try:
+        parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.app_log_level)
+    pharmacy.app.logger.setLevel(args.app_log_level)
+    logging.getLogger('werkzeug').setLevel(args.app_log_level)
+    scratch_dir = None
+    if not args.db:
+        scratch_dir = tempfile.TemporaryDirectory(prefix='pharmabench-')
+        args.db = os.path.join(scratch_dir.name, 'bench.db')
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    run, report = next((modes for mode, modes in BENCHMARK_MODES.items() if getattr(args, mode)), (run_benchmark, print_report))
+    try:
+        results = run(args)
+    finally:
+        with pharmacy.app.app_context():
+            pharmacy.close_db()
+        if scratch_dir:
+            scratch_dir.cleanup()
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
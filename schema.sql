@@ -1,9 +1,26 @@
 -- schema.sql
+DROP TABLE IF EXISTS medicines_fts; -- Search index, recreated by the migrations in app.py
+DROP TABLE IF EXISTS sales_daily_medicine; -- Rollups, recreated and backfilled by the migrations in app.py
+DROP TABLE IF EXISTS sales_daily_shop;
+DROP TABLE IF EXISTS product_stock; -- Stock aggregate, recreated and backfilled by the migrations in app.py
+DROP TABLE IF EXISTS stock_expiry_state;
+DROP TABLE IF EXISTS change_log; -- Delta sync bookkeeping, recreated by the migrations in app.py
+DROP TABLE IF EXISTS sync_node;
+DROP TABLE IF EXISTS sync_applying;
+DROP TABLE IF EXISTS sync_peers;
+DROP TABLE IF EXISTS sync_origins;
+DROP TABLE IF EXISTS sync_uid_alias;
+DROP TABLE IF EXISTS bill_archives; -- Archive catalogue; files already in the archive folder are not removed
+DROP TABLE IF EXISTS stock_adjustments; -- Stock adjustment ledger, recreated by the migrations in app.py
+DROP TABLE IF EXISTS change_counters; -- Cache generations, recreated by the migrations in app.py
+DROP TABLE IF EXISTS barcode_cache; -- UPC lookup cache, recreated and seeded by the migrations in app.py
+DROP TABLE IF EXISTS bulk_write_mode; -- Bulk write flag, recreated by the migrations in app.py
 DROP TABLE IF EXISTS medicines;
 DROP TABLE IF EXISTS customers;
 DROP TABLE IF EXISTS bills;
 DROP TABLE IF EXISTS bill_items;
 DROP TABLE IF EXISTS app_settings; -- New table for application settings
+DROP TABLE IF EXISTS schema_version; -- Migration bookkeeping, see MIGRATIONS in app.py
 
 CREATE TABLE medicines (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
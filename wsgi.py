@@ -0,0 +1,18 @@
+# wsgi.py
+"""Production entry point. Serve `wsgi:app` with several worker processes, e.g.
+
+    FLASK_DATABASE=/srv/pharmacy/inventory.db gunicorn --workers 4 --bind 0.0.0.0:8000 wsgi:app
+    waitress-serve --threads 8 --listen 0.0.0.0:8000 wsgi:app
+
+Every worker shares the session key (FLASK_SECRET_KEY, or the one generated
+once in the instance folder), so logins work whichever worker answers and
+survive restarts. Each worker keeps its own pooled SQLite connection, settings
+cache, UPI QR cache and metrics (scrape /metrics on every worker, with
+FLASK_METRICS_TOKEN as a bearer token); WAL mode lets them all read while one
+writes. The schema is checked once at startup, and with gunicorn --preload
+only once for all workers.
+Create the database first with `flask --app app init-db`.
+"""
+from app import create_app
+
+app = create_app()